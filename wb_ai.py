@@ -0,0 +1,910 @@
+"""
+Генерация ответов через Groq (OpenAI-совместимый API).
+
+Клиент OpenAI создаётся один раз на ключ и переиспользует соединения;
+сам пакет openai импортируется при первом запросе, а не при старте UI.
+Запросы идут через планировщик (LlmScheduler): бюджеты запросов и
+токенов по заголовкам x-ratelimit-* Groq, параллельность по AIMD,
+выбор модели по сложности записи и запасная модель при 429.
+Готовые ответы кэшируются (LRU + TTL, по желанию ещё и в SQLite-файле
+из переменной окружения WB_ANSWER_CACHE), чтобы одинаковые отзывы и
+вопросы не гонять через Groq повторно.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from wb_metrics import (
+    LLM_CONCURRENCY,
+    LLM_FIRST_TOKEN,
+    LLM_REQUESTS,
+    LLM_SECONDS,
+    LLM_TOKENS,
+    LLM_WAIT,
+)
+
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+MODEL_LARGE = "llama-3.3-70b-versatile"
+MODEL_SMALL = "llama-3.1-8b-instant"
+GROQ_MODEL = MODEL_LARGE
+FALLBACK = {MODEL_LARGE: MODEL_SMALL, MODEL_SMALL: MODEL_LARGE}  # при 429
+
+SHORT_TEXT = 200  # символов: короче — малой модели
+NEGATIVE_MAX = 3  # оценки 1..3 — негатив
+
+CONCURRENCY_START = 4  # одновременных запросов к модели на старте
+CONCURRENCY_MAX = 16
+LLM_RETRIES = 3  # повторов после 429/5xx/сбоя сети
+FALLBACK_WAIT = 5  # сек: ждать лимит своей модели дольше — идём в запасную
+PROBE_WAIT = 1  # сек: после сброса лимита ждём заголовки первого запроса
+
+CACHE_SIZE = 5000  # ответов в памяти
+CACHE_TTL = 7 * 24 * 3600  # сек
+CACHE_VARIANTS = 2  # разных формулировок на один ключ
+GREETING_MARK = "{greeting}"
+
+# ==========================================
+# КЛИЕНТ
+# ==========================================
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _openai():
+    # Импорт openai — около 0.7 с, поэтому при первом запросе
+    import openai
+
+    return openai
+
+
+def get_llm_client(api_key):
+    """
+    Один клиент OpenAI на ключ на весь процесс. Свои повторы клиента
+    выключены — повторяет планировщик, с учётом лимитов.
+    """
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = _openai().OpenAI(
+                api_key=api_key, base_url=GROQ_BASE_URL, max_retries=0
+            )
+        return _clients[api_key]
+
+
+# ==========================================
+# ПЛАНИРОВЩИК
+# ==========================================
+
+
+def pick_model(text, rating=None):
+    """
+    Модель по сложности записи: короткие и положительные — малой,
+    длинные негативные (и длинные вопросы) — большой.
+    """
+    if len(text or "") <= SHORT_TEXT or (rating or 0) > NEGATIVE_MAX:
+        return MODEL_SMALL
+    return MODEL_LARGE
+
+
+def parse_reset(value):
+    """Длительность Groq ("7.66s", "2m59.56s", "120ms") -> сек."""
+    if not value:
+        return 0.0
+    total = 0.0
+    for num, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", str(value)):
+        total += float(num) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    if not total:
+        try:
+            return float(value)
+        except ValueError:
+            return 0.0
+    return total
+
+
+class ModelBudget:
+    """
+    Лимиты одной модели (на ключ): остаток запросов и токенов из
+    заголовков x-ratelimit-*, пауза после 429 и окно параллельных
+    запросов по AIMD — +1/окно за успех, вдвое меньше за 429.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.limit = float(CONCURRENCY_START)
+        self.active = 0
+        self.requests_left = None
+        self.requests_reset = 0.0  # monotonic
+        self.tokens_left = None
+        self.tokens_reset = 0.0
+        self.blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def wait_time(self, tokens):
+        """Сколько ждать бюджет под запрос на tokens токенов."""
+        now = time.monotonic()
+        wait = self.blocked_until - now
+        if self.tokens_left is not None and now < self.tokens_reset and self.tokens_left < tokens:
+            wait = max(wait, self.tokens_reset - now)
+        if self.requests_left is not None and now < self.requests_reset and self.requests_left < 1:
+            wait = max(wait, self.requests_reset - now)
+        return max(wait, 0.0)
+
+    def acquire(self, tokens, max_wait=None):
+        """
+        Слот под запрос. False — бюджет модели освободится позже, чем
+        через max_wait сек (слота ждём без ограничения).
+        """
+        with self._cond:
+            while True:
+                wait = self.wait_time(tokens)
+                if max_wait is not None and wait > max_wait:
+                    return False
+                if wait <= 0 and self.active < int(self.limit):
+                    self.active += 1
+                    self._reserve(tokens)
+                    return True
+                self._cond.wait(wait or 1.0)
+
+    def _reserve(self, tokens):
+        # Резерв до свежих заголовков, чтобы соседние потоки не проскочили.
+        # После reset остаток неизвестен: пропускаем один запрос-пробу,
+        # остальные ждут его заголовков (или PROBE_WAIT сек).
+        now = time.monotonic()
+        if self.tokens_left is not None:
+            if now >= self.tokens_reset and self.tokens_left < tokens:
+                self.tokens_left, self.tokens_reset = tokens, now + PROBE_WAIT
+            self.tokens_left -= tokens
+        if self.requests_left is not None:
+            if now >= self.requests_reset and self.requests_left < 1:
+                self.requests_left, self.requests_reset = 1, now + PROBE_WAIT
+            self.requests_left -= 1
+
+    def release(self, headers=None, throttled=False):
+        with self._cond:
+            self.active -= 1
+            if headers is not None:
+                self.update(headers)
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                retry = parse_reset((headers or {}).get("retry-after")) or 1.0
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry)
+            else:
+                self.limit = min(float(CONCURRENCY_MAX), self.limit + 1 / self.limit)
+            LLM_CONCURRENCY.set(round(self.limit, 2), model=self.model)
+            self._cond.notify_all()
+
+    def update(self, headers):
+        now = time.monotonic()
+        for kind in ("requests", "tokens"):
+            left = headers.get(f"x-ratelimit-remaining-{kind}")
+            if left is None or not headers.get(f"x-ratelimit-limit-{kind}"):
+                continue
+            try:
+                setattr(self, f"{kind}_left", int(float(left)))
+            except ValueError:
+                continue
+            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            setattr(self, f"{kind}_reset", now + reset)
+
+
+class LlmScheduler:
+    """Бюджеты по (ключ, модель) на весь процесс — общие для UI, авто-режима и потоков."""
+
+    def __init__(self):
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def budget(self, api_key, model):
+        with self._lock:
+            key = (api_key, model)
+            if key not in self._budgets:
+                self._budgets[key] = ModelBudget(model)
+            return self._budgets[key]
+
+    def acquire(self, api_key, model, tokens):
+        """
+        Слот под запрос: своя модель, а если её бюджет исчерпан надолго —
+        запасная, когда та свободнее. Возвращает (модель, ModelBudget).
+        """
+        started = time.monotonic()
+        budget = self.budget(api_key, model)
+        if not budget.acquire(tokens, FALLBACK_WAIT):
+            alt = FALLBACK.get(model)
+            if alt and self.budget(api_key, alt).wait_time(tokens) < budget.wait_time(tokens):
+                model, budget = alt, self.budget(api_key, alt)
+            budget.acquire(tokens)
+        LLM_WAIT.observe(time.monotonic() - started, model=model)
+        return model, budget
+
+    def stats(self):
+        with self._lock:
+            budgets = list(self._budgets.values())
+        return [
+            {
+                "model": b.model,
+                "concurrency": round(b.limit, 2),
+                "active": b.active,
+                "requests_left": b.requests_left,
+                "tokens_left": b.tokens_left,
+            }
+            for b in budgets
+        ]
+
+
+scheduler = LlmScheduler()
+
+
+def _status(exc):
+    return "429" if isinstance(exc, _openai().RateLimitError) else "error"
+
+
+def _retryable(exc):
+    openai = _openai()
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, openai.APIConnectionError)
+
+
+def _open(api_key, model, kind, tokens, **params):
+    """
+    Запрос через планировщик с повторами: при 429 — пауза модели и
+    запасная модель, при 5xx и сбое сети — backoff. Возвращает (сырой
+    ответ, модель, ModelBudget); слот освобождает вызывающий (release).
+    """
+    for attempt in range(LLM_RETRIES + 1):
+        model, budget = scheduler.acquire(api_key, model, tokens)
+        started = time.monotonic()
+        try:
+            raw = get_llm_client(api_key).chat.completions.with_raw_response.create(
+                model=model, **params
+            )
+            return raw, model, budget
+        except Exception as e:
+            throttled = isinstance(e, _openai().RateLimitError)
+            response = getattr(e, "response", None)
+            budget.release(getattr(response, "headers", None), throttled=throttled)
+            LLM_REQUESTS.inc(kind=kind, model=model, status=_status(e))
+            LLM_SECONDS.observe(time.monotonic() - started, kind=kind, model=model)
+            if attempt >= LLM_RETRIES or not _retryable(e):
+                raise
+            if throttled:
+                model = FALLBACK.get(model, model)
+            else:
+                time.sleep(random.uniform(0, 2**attempt))
+
+
+# ==========================================
+# КЭШ ОТВЕТОВ
+# ==========================================
+
+
+def _norm(value):
+    return re.sub(r"\s+", " ", str(value or "")).strip().lower()
+
+
+def cache_key(text, item_name, instructions, signature, greeting, rating=None, nm_id=None):
+    """
+    Ключ кэша по нормализованным полям. Вместо самого приветствия —
+    только его вид (с именем или без), имя подставляется при выдаче.
+    Оценка и артикул — в ключе: одинаковый текст при другой оценке или
+    на другой товар — другой отзыв.
+    """
+    kind = "plain" if greeting == "Здравствуйте!" else "named"
+    raw = "\x1f".join(
+        _norm(v) for v in (text, item_name, instructions, signature, kind, rating, nm_id)
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    LRU-кэш ответов с TTL. На ключ хранится до variants формулировок,
+    при попадании они выдаются по очереди. path — файл SQLite, чтобы
+    кэш переживал перезапуск.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, variants=CACHE_VARIANTS, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+        self._mem = OrderedDict()  # key -> [created, [(текст, сек, токены)], следующий]
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT, answer TEXT, seconds REAL, tokens INTEGER, created REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS answers_key ON answers(key)")
+            self._db.commit()
+
+    def _load(self, key):
+        # Запись из памяти, при промахе — из файла
+        entry = self._mem.get(key)
+        if entry is None and self._db is not None:
+            rows = self._db.execute(
+                "SELECT answer, seconds, tokens, created FROM answers "
+                "WHERE key = ? ORDER BY created",
+                (key,),
+            ).fetchall()
+            if rows:
+                entry = [rows[0][3], [r[:3] for r in rows], 0]
+                self._mem[key] = entry
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            self._drop(key)
+            entry = None
+        return entry
+
+    def _drop(self, key):
+        self._mem.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._db.commit()
+
+    def get(self, key):
+        """Готовый ответ или None, если нужно сгенерировать новый."""
+        with self._lock:
+            entry = self._load(key)
+            if entry is None or len(entry[1]) < self.variants:
+                self.misses += 1
+                return None
+            self._mem.move_to_end(key)
+            text, seconds, tokens = entry[1][entry[2] % len(entry[1])]
+            entry[2] += 1
+            self.hits += 1
+            self.saved_seconds += seconds or 0
+            self.saved_tokens += tokens or 0
+            return text
+
+    def put(self, key, text, seconds=0.0, tokens=0):
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                entry = [time.time(), [], 0]
+                self._mem[key] = entry
+            if len(entry[1]) >= self.variants:
+                return
+            entry[1].append((text, seconds, tokens))
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_size:
+                self._mem.popitem(last=False)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT INTO answers VALUES (?, ?, ?, ?, ?)",
+                    (key, text, seconds, tokens, entry[0]),
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "saved_tokens": self.saved_tokens,
+            "size": len(self._mem),
+        }
+
+
+answer_cache = AnswerCache(path=os.environ.get("WB_ANSWER_CACHE") or None)
+
+
+# ==========================================
+# ГЕНЕРАЦИЯ
+# ==========================================
+
+
+def review_text(rev):
+    """
+    Текст отзыва для ИИ: плюсы, минусы и комментарий.
+    Пустая строка, если покупатель поставил только оценку.
+    """
+    pros = rev.get("pros", "")
+    cons = rev.get("cons", "")
+    comment = rev.get("text", "")
+    if not (pros or cons or comment):
+        return ""
+    return f"Плюсы: {pros}. Минусы: {cons}. Текст: {comment}"
+
+
+def make_greeting(user_name):
+    safe_user = user_name if user_name else "Покупатель"
+    return (
+        f"Здравствуйте, {safe_user}!"
+        if len(safe_user) > 2 and safe_user.lower() != "клиент"
+        else "Здравствуйте!"
+    )
+
+
+def _chat(api_key, kind, model, messages, max_tokens, **params):
+    """Запрос chat.completions через планировщик. Возвращает (ответ, сек, токены)."""
+    tokens = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+    started = time.monotonic()
+    raw, model, budget = _open(
+        api_key, model, kind, tokens, messages=messages, max_tokens=max_tokens, **params
+    )
+    try:
+        response = raw.parse()
+    finally:
+        budget.release(raw.headers)
+    seconds = time.monotonic() - started
+    usage = getattr(response, "usage", None)
+    LLM_REQUESTS.inc(kind=kind, model=model, status="ok")
+    LLM_SECONDS.observe(seconds, kind=kind, model=model)
+    for name in ("prompt", "completion"):
+        LLM_TOKENS.inc(
+            getattr(usage, f"{name}_tokens", 0) or 0, kind=kind, model=model, type=name
+        )
+    return response, seconds, getattr(usage, "total_tokens", 0) or 0
+
+
+def _prompt_one(user_msg, item_name, greeting, instructions, signature):
+    return f"""
+    Ты менеджер Wildberries.
+    ТОВАР: {item_name}
+    СООБЩЕНИЕ: "{user_msg}"
+    ИНСТРУКЦИЯ: "{instructions}"
+    
+    ПРАВИЛА:
+    1. НЕ используй нумерацию.
+    2. Начни с: "{greeting}"
+    3. Разделяй абзацы пустой строкой.
+    4. В конце: "{signature}"
+    """
+
+
+def _generate_one(
+    api_key, user_msg, item_name, greeting, instructions, signature, model=GROQ_MODEL
+):
+    """Один запрос к Groq. Возвращает (ответ, сек, токены)."""
+    prompt = _prompt_one(user_msg, item_name, greeting, instructions, signature)
+    response, seconds, tokens = _chat(
+        api_key,
+        "one",
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.6,
+        max_tokens=500,
+    )
+    return response.choices[0].message.content, seconds, tokens
+
+
+def paraphrase_ai(api_key, answer, question, item_name, signature):
+    """
+    Готовый ответ на похожий вопрос (wb_faq), переписанный под новый
+    вопрос малой моделью — короче и дешевле полной генерации.
+    """
+    if not api_key:
+        return "Нет ключа Groq"
+    greeting = make_greeting("Покупатель")
+    prompt = f"""
+    Ты менеджер Wildberries. Перепиши ответ своими словами под новый вопрос.
+    Факты из ответа не меняй и не добавляй новых.
+    ТОВАР: {item_name}
+    ВОПРОС: "{question}"
+    ОТВЕТ: "{answer}"
+
+    ПРАВИЛА:
+    1. НЕ используй нумерацию.
+    2. Начни с: "{greeting}"
+    3. В конце: "{signature}"
+    """
+    try:
+        response, _, _ = _chat(
+            api_key,
+            "paraphrase",
+            model=MODEL_SMALL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.7,
+            max_tokens=ANSWER_TOKENS,
+        )
+    except Exception as e:
+        return f"Ошибка AI: {e}"
+    return finish_answer(response.choices[0].message.content.strip(), greeting, signature)
+
+
+class AiStream:
+    """
+    Потоковая генерация одного ответа (stream=True): итерация отдаёт
+    куски текста по мере прихода токенов, text — уже пришедшее.
+    result() — итог с приветствием и подписью, как у пакетных ответов.
+    cancel() (из любого потока) или close() останавливают поток и
+    закрывают соединение; пришедший текст остаётся в text.
+    rating — оценка отзыва, для выбора модели (pick_model); rating и
+    nm_id — часть ключа кэша.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        text,
+        item_name,
+        user_name,
+        instructions,
+        signature,
+        use_cache=True,
+        rating=None,
+        nm_id=None,
+    ):
+        self.api_key = api_key
+        self.model = pick_model(text, rating)
+        self.rating = rating
+        self.nm_id = nm_id
+        self.user_name = user_name
+        self.item_name = item_name
+        self.instructions = instructions
+        self.signature = signature
+        self.use_cache = use_cache
+        self.greeting = make_greeting(user_name)
+        self.user_msg = text if text else "Без текста."
+        self.parts = []
+        self.error = None
+        self.done = False
+        self.first_token = None  # сек до первого куска текста
+        self._cancel = threading.Event()
+        self._stream = None
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def result(self):
+        """Итоговый текст; оборванный поток — как есть, для правки вручную."""
+        if self.error:
+            return self.error
+        text = self.text.strip()
+        if not text or not self.done:
+            return text
+        return finish_answer(text, self.greeting, self.signature)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def close(self):
+        self._cancel.set()
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def __iter__(self):
+        if not self.api_key:
+            self.error = "Нет ключа Groq"
+            return
+        key = cache_key(
+            self.user_msg,
+            self.item_name,
+            self.instructions,
+            self.signature,
+            self.greeting,
+            self.rating,
+            self.nm_id,
+        )
+        if self.use_cache:
+            cached = answer_cache.get(key)
+            if cached is not None:
+                self.parts = [cached.replace(GREETING_MARK, self.greeting, 1)]
+                self.first_token = 0.0
+                self.done = True
+                yield self.parts[0]
+                return
+
+        prompt = _prompt_one(
+            self.user_msg, self.item_name, self.greeting, self.instructions, self.signature
+        )
+        started = time.monotonic()
+        tokens = 0
+        status = "ok"
+        budget = headers = None
+        try:
+            raw, self.model, budget = _open(
+                self.api_key,
+                self.model,
+                "stream",
+                estimate_tokens(prompt) + 500,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.6,
+                max_tokens=500,
+                stream=True,
+            )
+            headers = raw.headers
+            self._stream = raw.parse()
+            for chunk in self._stream:
+                if self._cancel.is_set():
+                    status = "cancelled"
+                    break
+                tokens = _stream_tokens(chunk) or tokens
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if self.first_token is None:
+                    self.first_token = time.monotonic() - started
+                    LLM_FIRST_TOKEN.observe(self.first_token, kind="stream", model=self.model)
+                self.parts.append(delta)
+                yield delta
+            else:
+                self.done = True
+        except Exception as e:
+            if self._cancel.is_set():
+                status = "cancelled"
+            else:
+                status = _status(e)
+                self.error = f"Ошибка AI: {e}"
+        finally:
+            if status == "ok" and not self.done:
+                status = "cancelled"  # поток бросили, не дочитав
+            self.close()
+            if budget is not None:
+                # Ошибки открытия _open уже учёл сам
+                budget.release(headers)
+                LLM_REQUESTS.inc(kind="stream", model=self.model, status=status)
+                LLM_SECONDS.observe(time.monotonic() - started, kind="stream", model=self.model)
+            if tokens:
+                LLM_TOKENS.inc(tokens, kind="stream", model=self.model, type="total")
+
+        if self.done and self.use_cache:
+            _remember(
+                key,
+                self.result(),
+                self.greeting,
+                self.user_name,
+                time.monotonic() - started,
+                tokens,
+            )
+
+
+def _stream_tokens(chunk):
+    # usage приходит в последнем куске: у OpenAI — chunk.usage, у Groq — x_groq.usage
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        extra = getattr(chunk, "x_groq", None)
+        usage = extra.get("usage") if isinstance(extra, dict) else getattr(extra, "usage", None)
+    if isinstance(usage, dict):
+        return usage.get("total_tokens") or 0
+    return getattr(usage, "total_tokens", 0) or 0
+
+
+GENERIC_NAMES = {"покупатель", "клиент"}
+
+
+def _remember(key, answer, greeting, user_name, seconds, tokens):
+    # В кэш — только ответы, где приветствие можно заменить на другое имя
+    # и имя покупателя больше нигде не встречается («Анна, спасибо…»):
+    # иначе оно уйдёт другим покупателям с тем же отзывом
+    if not answer or not answer.lstrip().startswith(greeting):
+        return
+    templated = answer.lstrip().replace(greeting, GREETING_MARK, 1)
+    name = (user_name or "").strip()
+    if name and name.lower() not in GENERIC_NAMES:
+        if re.search(rf"(?<!\w){re.escape(name)}(?!\w)", templated, re.IGNORECASE):
+            return
+    answer_cache.put(key, templated, seconds, tokens)
+
+
+# ==========================================
+# ПАКЕТНАЯ ГЕНЕРАЦИЯ
+# ==========================================
+
+BATCH_MAX = 10  # записей в одном запросе
+BATCH_TOKEN_BUDGET = 6000  # токенов на запрос (вход + ответы)
+ANSWER_TOKENS = 250  # примерно на один ответ
+
+
+def estimate_tokens(text):
+    """Грубая оценка: ~3 символа кириллицы на токен."""
+    return len(text or "") // 3 + 1
+
+
+def ai_item(item, mode="feedbacks"):
+    """
+    Отзыв/вопрос WB -> {"id", "text", "product", "user", "rating", "nm_id"}
+    для генерации.
+    """
+    details = item.get("productDetails", {})
+    if mode == "feedbacks":
+        text = review_text(item)
+        user = item.get("userName", "")
+    else:
+        text = item.get("text", "")
+        user = "Покупатель"
+    return {
+        "id": item["id"],
+        "text": text,
+        "product": details.get("productName", ""),
+        "user": user,
+        "rating": item.get("productValuation") if mode == "feedbacks" else None,
+        "nm_id": details.get("nmId"),
+    }
+
+
+def plan_batches(items, instructions, budget=BATCH_TOKEN_BUDGET, max_size=BATCH_MAX):
+    """
+    Делит записи на пакеты так, чтобы каждый запрос укладывался в
+    бюджет токенов: длинные отзывы — пакеты меньше.
+    """
+    base = estimate_tokens(instructions) + 200
+    batches, cur, used = [], [], base
+    for it in items:
+        cost = estimate_tokens(it["text"]) + estimate_tokens(it["product"]) + ANSWER_TOKENS
+        if cur and (used + cost > budget or len(cur) >= max_size):
+            batches.append(cur)
+            cur, used = [], base
+        cur.append(it)
+        used += cost
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _parse_batch(content):
+    """{"answers": [{"id": ..., "answer": ...}]} -> {id: текст}."""
+    content = (content or "").strip()
+    start, end = content.find("{"), content.rfind("}")
+    if start < 0 or end < start:
+        return {}
+    try:
+        data = json.loads(content[start : end + 1])
+    except ValueError:
+        return {}
+    answers = data.get("answers") if isinstance(data, dict) else None
+    result = {}
+    for row in answers or []:
+        if not isinstance(row, dict):
+            continue
+        text = row.get("answer")
+        if isinstance(text, str) and len(text.strip()) >= 10:
+            result[str(row.get("id"))] = text.strip()
+    return result
+
+
+def finish_answer(answer, greeting, signature):
+    """Приветствие в начале и подпись в конце, как в одиночной генерации."""
+    if not answer.startswith(greeting):
+        answer = f"{greeting}\n\n{answer}"
+    if signature and not answer.rstrip().endswith(signature):
+        answer = f"{answer.rstrip()}\n\n{signature}"
+    return answer
+
+
+def _generate_batch_once(api_key, batch, instructions, signature, model=GROQ_MODEL):
+    """Один запрос на пакет. Возвращает ({id: ответ}, сек, токены)."""
+    rows = [
+        {
+            "id": str(it["id"]),
+            "product": it["product"],
+            "message": it["text"] or "Без текста.",
+            "greeting": make_greeting(it["user"]),
+        }
+        for it in batch
+    ]
+    prompt = f"""
+    Ты менеджер Wildberries. Ответь на каждое сообщение покупателя отдельно.
+    ИНСТРУКЦИЯ: "{instructions}"
+
+    ПРАВИЛА для каждого ответа:
+    1. НЕ используй нумерацию.
+    2. Начни с приветствия из поля greeting.
+    3. Разделяй абзацы пустой строкой.
+    4. В конце: "{signature}"
+
+    СООБЩЕНИЯ (JSON):
+    {json.dumps(rows, ensure_ascii=False)}
+
+    Верни только JSON вида {{"answers": [{{"id": "...", "answer": "..."}}]}}
+    с ответом для каждого id.
+    """
+    response, seconds, tokens = _chat(
+        api_key,
+        "batch",
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.6,
+        max_tokens=min(ANSWER_TOKENS * len(batch) + 200, 8000),
+        response_format={"type": "json_object"},
+    )
+    return _parse_batch(response.choices[0].message.content), seconds, tokens
+
+
+def generate_ai_batch(api_key, items, instructions, signature, use_cache=True):
+    """
+    Ответы на много записей за меньшее число запросов.
+
+    items: [{"id", "text", "product", "user", "rating"}] (см. ai_item)
+    Возвращает {id: ответ}. Пакеты собираются отдельно для каждой модели
+    (pick_model). Записи, для которых пакетный ответ не пришёл или не
+    прошёл проверку, генерируются по одной.
+    """
+    if not api_key:
+        return {it["id"]: "Нет ключа Groq" for it in items}
+
+    answers = {}
+    todo = []
+    for it in items:
+        greeting = make_greeting(it["user"])
+        key = cache_key(
+            it["text"] or "Без текста.",
+            it["product"],
+            instructions,
+            signature,
+            greeting,
+            it.get("rating"),
+            it.get("nm_id"),
+        )
+        cached = answer_cache.get(key) if use_cache else None
+        if cached is not None:
+            answers[it["id"]] = cached.replace(GREETING_MARK, greeting, 1)
+        else:
+            todo.append((it, key, greeting))
+
+    by_id = {str(it["id"]): (it, key, greeting) for it, key, greeting in todo}
+    by_model = {}
+    for it, _, _ in todo:
+        by_model.setdefault(pick_model(it["text"], it.get("rating")), []).append(it)
+    batches = [
+        (model, batch)
+        for model, group in by_model.items()
+        for batch in plan_batches(group, instructions)
+    ]
+    for model, batch in batches:
+        if len(batch) == 1:
+            continue  # одиночный — обычным запросом ниже
+        try:
+            parsed, seconds, tokens = _generate_batch_once(
+                api_key, batch, instructions, signature, model
+            )
+        except Exception:
+            continue
+        for sid, text in parsed.items():
+            if sid not in by_id:
+                continue
+            it, key, greeting = by_id[sid]
+            answer = finish_answer(text, greeting, signature)
+            answers[it["id"]] = answer
+            if use_cache:
+                _remember(
+                    key, answer, greeting, it["user"], seconds / len(batch), tokens // len(batch)
+                )
+
+    # Запасной путь: по одной
+    for it, key, greeting in todo:
+        if it["id"] in answers:
+            continue
+        try:
+            answer, seconds, tokens = _generate_one(
+                api_key,
+                it["text"] or "Без текста.",
+                it["product"],
+                greeting,
+                instructions,
+                signature,
+                pick_model(it["text"], it.get("rating")),
+            )
+        except Exception as e:
+            answers[it["id"]] = f"Ошибка AI: {e}"
+            continue
+        answers[it["id"]] = answer
+        if use_cache:
+            _remember(key, answer, greeting, it["user"], seconds, tokens)
+    return answers
@@ -0,0 +1,232 @@
+"""
+Аналитика по выгруженному архиву отзывов (wb_archive).
+
+Считается колоночно (pandas/numpy) и инкрементально: по каждой новой
+части выгрузки считаются суммируемые агрегаты и прибавляются к уже
+накопленным, которые хранятся рядом с выгрузкой (analytics.pkl). Поэтому
+обновление дашборда стоит столько, сколько новых частей, а не весь архив.
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from wb_archive import archive_path, arrow, load_state
+from wb_store import get_db
+
+NEGATIVE_MAX = 3  # оценки 1..3 — негатив
+TOP_TERMS = 30
+
+# Границы корзин задержки ответа, часы
+LATENCY_BINS = np.array([0, 1, 2, 4, 8, 12, 24, 48, 72, 168, 336, 720, np.inf])
+
+STOP_WORDS = {
+    "что", "это", "как", "для", "все", "нет", "очень", "так", "был", "была",
+    "были", "было", "его", "она", "они", "при", "или", "уже", "еще", "ещё",
+    "только", "чем", "где", "когда", "там", "тоже", "мне", "меня", "вот",
+    "недостатков", "недостатки", "минусы", "минусов", "нету",
+}
+
+COLUMNS = ["id", "nm_id", "product", "rating", "created_ts", "answer_ts", "cons"]
+
+_memo = {}  # магазин -> (частей учтено, агрегаты)
+
+
+def empty_aggregates():
+    return {
+        "parts": 0,
+        "rows": 0,
+        "ratings": pd.DataFrame(columns=[1, 2, 3, 4, 5], dtype="int64"),
+        "products": {},
+        "daily": pd.DataFrame(columns=["total", "negative"], dtype="int64"),
+        "latency_hist": np.zeros(len(LATENCY_BINS) - 1, dtype="int64"),
+        "latency_sum": 0.0,
+        "latency_count": 0,
+        "terms": pd.Series(dtype="int64"),
+    }
+
+
+def read_part_frame(path, part, fmt):
+    file = os.path.join(path, part["file"])
+    if fmt == "parquet":
+        return arrow()[1].read_table(file, columns=COLUMNS).to_pandas()
+    return pd.read_json(file, lines=True, compression="gzip")[COLUMNS]
+
+
+def sent_times(ids):
+    """Время наших ответов из локальной базы (если в архиве его нет)."""
+    if len(ids) == 0:
+        return pd.Series(dtype="float64")
+    db = get_db()
+    rows = []
+    ids = list(ids)
+    for i in range(0, len(ids), 900):  # лимит параметров SQLite
+        chunk = ids[i : i + 900]
+        marks = ",".join("?" * len(chunk))
+        rows += db.execute(
+            f"SELECT id, sent_at FROM answers WHERE mode = 'feedbacks' AND id IN ({marks})",
+            chunk,
+        ).fetchall()
+    return pd.Series({r[0]: r[1] for r in rows}, dtype="float64")
+
+
+def part_aggregates(df):
+    """Суммируемые агрегаты по одной части выгрузки."""
+    df = df.copy()
+    df["rating"] = pd.to_numeric(df["rating"], errors="coerce")
+    df["nm_id"] = pd.to_numeric(df["nm_id"], errors="coerce")
+
+    ratings = (
+        df.dropna(subset=["nm_id", "rating"])
+        .astype({"nm_id": "int64", "rating": "int64"})
+        .groupby(["nm_id", "rating"])
+        .size()
+        .unstack(fill_value=0)
+        .reindex(columns=[1, 2, 3, 4, 5], fill_value=0)
+    )
+
+    day = (df["created_ts"] // 86400).dropna().astype("int64")
+    negative = (df["rating"] <= NEGATIVE_MAX).astype("int64")
+    daily = pd.DataFrame(
+        {"total": 1, "negative": negative}, index=df.index
+    ).loc[day.index].groupby(day).sum()
+
+    answered = df["answer_ts"].copy()
+    missing = answered.isna()
+    if missing.any():
+        answered[missing] = df.loc[missing, "id"].map(sent_times(df.loc[missing, "id"]))
+    hours = ((answered - df["created_ts"]) / 3600).dropna()
+    hours = hours[hours >= 0].to_numpy()
+    hist, _ = np.histogram(hours, bins=LATENCY_BINS)
+
+    words = (
+        df["cons"]
+        .fillna("")
+        .str.lower()
+        .str.findall(r"[a-zа-яё]{3,}")
+        .explode()
+        .dropna()
+    )
+    terms = words[~words.isin(STOP_WORDS)].value_counts()
+
+    products = (
+        df.dropna(subset=["nm_id"])
+        .drop_duplicates("nm_id", keep="last")
+        .set_index("nm_id")["product"]
+    )
+
+    return {
+        "rows": len(df),
+        "ratings": ratings,
+        "products": {int(k): v for k, v in products.items()},
+        "daily": daily,
+        "latency_hist": hist,
+        "latency_sum": float(hours.sum()),
+        "latency_count": int(hours.size),
+        "terms": terms,
+    }
+
+
+def merge(agg, part):
+    agg["rows"] += part["rows"]
+    agg["ratings"] = agg["ratings"].add(part["ratings"], fill_value=0).astype("int64")
+    agg["products"].update(part["products"])
+    agg["daily"] = agg["daily"].add(part["daily"], fill_value=0).astype("int64")
+    agg["latency_hist"] = agg["latency_hist"] + part["latency_hist"]
+    agg["latency_sum"] += part["latency_sum"]
+    agg["latency_count"] += part["latency_count"]
+    agg["terms"] = agg["terms"].add(part["terms"], fill_value=0).astype("int64")
+    return agg
+
+
+def update_analytics(shop):
+    """
+    Догоняет агрегаты до текущей выгрузки магазина (только новые части)
+    и возвращает их.
+    """
+    path = archive_path(shop)
+    state = load_state(path)
+    parts = state["parts"]
+    memo = _memo.get(shop)
+    if memo is not None and memo[0] == len(parts):
+        return memo[1]
+
+    store_file = os.path.join(path, "analytics.pkl")
+    agg = None
+    if memo is not None:
+        agg = memo[1]
+    elif os.path.exists(store_file):
+        try:
+            with open(store_file, "rb") as f:
+                agg = pickle.load(f)
+        except Exception:
+            agg = None
+    if agg is None or agg["parts"] > len(parts):
+        agg = empty_aggregates()
+
+    fmt = state.get("format", "jsonl")
+    for part in parts[agg["parts"] :]:
+        merge(agg, part_aggregates(read_part_frame(path, part, fmt)))
+        agg["parts"] += 1
+
+    if parts:
+        tmp = store_file + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(agg, f)
+        os.replace(tmp, store_file)
+    _memo[shop] = (len(parts), agg)
+    return agg
+
+
+# ==========================================
+# ОТЧЁТЫ
+# ==========================================
+
+
+def rating_table(agg, top=20):
+    """Распределение оценок по артикулам (самые обсуждаемые сверху)."""
+    table = agg["ratings"].copy()
+    if table.empty:
+        return table
+    table["всего"] = table.sum(axis=1)
+    weights = np.array([1, 2, 3, 4, 5])
+    table["средняя"] = (table[[1, 2, 3, 4, 5]].to_numpy() @ weights) / table["всего"]
+    table["товар"] = table.index.map(lambda nm: agg["products"].get(int(nm), ""))
+    table = table.rename(columns={r: f"{r}★" for r in range(1, 6)})
+    return table.sort_values("всего", ascending=False).head(top)
+
+
+def negative_rate(agg, freq="W"):
+    """Доля негатива по неделям (freq — правило pandas resample)."""
+    daily = agg["daily"]
+    if daily.empty:
+        return pd.DataFrame(columns=["total", "negative", "rate"])
+    daily = daily.copy()
+    daily.index = pd.to_datetime(daily.index.astype("int64") * 86400, unit="s")
+    out = daily.sort_index().resample(freq).sum()
+    out["rate"] = out["negative"] / out["total"].replace(0, np.nan)
+    return out
+
+
+def latency_summary(agg):
+    """Средняя и перцентили (по корзинам) задержки ответа, часы."""
+    count = agg["latency_count"]
+    if not count:
+        return {"count": 0, "mean": None, "p50": None, "p90": None}
+    cum = np.cumsum(agg["latency_hist"]) / count
+    upper = LATENCY_BINS[1:]
+
+    def pct(q):
+        return float(upper[np.searchsorted(cum, q)])
+
+    return {
+        "count": count,
+        "mean": agg["latency_sum"] / count,
+        "p50": pct(0.5),
+        "p90": pct(0.9),
+    }
+
+
+def top_terms(agg, top=TOP_TERMS):
+    return agg["terms"].sort_values(ascending=False).head(top)
@@ -0,0 +1,474 @@
+"""
+Работа с API Wildberries (feedbacks-api): отзывы, вопросы, архив, ответы.
+
+Все запросы идут через wb_request(): одна keep-alive сессия на токен,
+лимит запросов на токен (token bucket) и повторы при 429/5xx.
+"""
+import email.utils
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from wb_metrics import WB_REQUESTS, WB_RETRIES, WB_SECONDS, WB_WAIT, shop_label
+
+# Переопределяется для тестовых стендов (см. wb_bench.py)
+WB_API_URL = os.environ.get("WB_API_URL", "https://feedbacks-api.wildberries.ru")
+
+# Лимит feedbacks-api: 3 запроса в секунду на продавца, всплеск до 6
+RATE_PER_SEC = 3
+RATE_BURST = 6
+
+RETRIES = 4  # повторов после первой попытки
+BACKOFF_BASE = 0.5  # сек, удваивается с каждой попыткой
+BACKOFF_MAX = 30
+TIMEOUT = 15
+
+# ==========================================
+# КЛИЕНТ
+# ==========================================
+
+
+class WbResult:
+    """
+    Результат запроса к WB.
+
+    status:
+      "ok"        — успех, data содержит ответ
+      "empty"     — успех, но записей нет
+      "throttled" — WB вернул 429 и повторы не помогли
+      "error"     — прочие ошибки (4xx, 5xx, сеть)
+    """
+
+    OK = "ok"
+    EMPTY = "empty"
+    THROTTLED = "throttled"
+    ERROR = "error"
+
+    def __init__(self, status, data=None, code=None, error="", meta=None):
+        self.status = status
+        self.data = data
+        self.code = code
+        self.error = error
+        self.meta = meta or {}
+
+    @property
+    def ok(self):
+        return self.status in (self.OK, self.EMPTY)
+
+    @property
+    def uncertain(self):
+        """Запрос мог дойти до WB (5xx, обрыв после отправки): итог неизвестен."""
+        return bool(self.meta.get("uncertain"))
+
+    @property
+    def retryable(self):
+        """Имеет смысл повторить позже: лимит, 5xx или сбой сети."""
+        return (
+            self.status == self.THROTTLED
+            or (self.code or 0) >= 500
+            or bool(self.meta.get("network"))
+        )
+
+    def __repr__(self):
+        return f"WbResult({self.status!r}, code={self.code!r})"
+
+
+class WbApiError(Exception):
+    """Страница не загрузилась после всех повторов."""
+
+    def __init__(self, result):
+        super().__init__(result.error or result.status)
+        self.result = result
+
+
+class TokenBucket:
+    """Token bucket: rate запросов в секунду, запас до capacity."""
+
+    def __init__(self, rate=RATE_PER_SEC, capacity=RATE_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """После 429 — не пускать запросы этого токена seconds секунд."""
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.updated = time.monotonic()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(wb_token):
+    """
+    (сессия, лимитер) для токена. Создаются один раз на процесс,
+    соединения переиспользуются между запросами и перезапусками UI.
+    """
+    with _clients_lock:
+        if wb_token not in _clients:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Authorization"] = wb_token
+            _clients[wb_token] = (session, TokenBucket(RATE_PER_SEC, RATE_BURST))
+        return _clients[wb_token]
+
+
+def retry_delay(res, attempt):
+    """
+    Пауза перед повтором: Retry-After / X-Ratelimit-Retry из ответа,
+    иначе экспоненциальный backoff с jitter.
+    """
+    if res is not None:
+        for name in ("Retry-After", "X-Ratelimit-Retry"):
+            value = res.headers.get(name)
+            if not value:
+                continue
+            try:
+                return min(float(value), BACKOFF_MAX)
+            except ValueError:
+                pass
+            try:
+                when = email.utils.parsedate_to_datetime(value).timestamp()
+                return min(max(when - time.time(), 0), BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def connect_failed(exc):
+    """Соединение с WB не установлено — запрос точно не ушёл."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(exc, requests.exceptions.ConnectionError) or not exc.args:
+        return False
+    reason = getattr(exc.args[0], "reason", None)
+    return isinstance(
+        reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)
+    )
+
+
+def wb_request(
+    method, path, wb_token, params=None, json=None, retries=RETRIES, idempotent=True
+):
+    """
+    Запрос к feedbacks-api с лимитом и повторами. Возвращает WbResult,
+    data — разобранный JSON (или None для пустого ответа).
+
+    idempotent=False (отправка ответа): повтор только после 429 и сбоя
+    соединения. 5xx и обрыв после отправки не повторяются — WB мог
+    принять ответ; WbResult.uncertain, проверка — по get_wb_item.
+    """
+    if not wb_token:
+        return WbResult(WbResult.ERROR, error="Нет токена WB")
+    session, bucket = get_client(wb_token)
+    url = WB_API_URL + path
+    shop, endpoint = shop_label(wb_token), f"{method} {path}"
+    res = None
+    error = ""
+
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        bucket.acquire()
+        WB_WAIT.observe(time.monotonic() - started, shop=shop)
+        started = time.monotonic()
+        reached = True
+        try:
+            res = session.request(method, url, params=params, json=json, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            res, error = None, f"Сбой сети: {e}"
+            reached = not connect_failed(e)
+        WB_SECONDS.observe(time.monotonic() - started, shop=shop, endpoint=endpoint)
+        WB_REQUESTS.inc(
+            shop=shop, endpoint=endpoint, code=res.status_code if res is not None else "network"
+        )
+        if res is not None:
+            if res.status_code in (200, 201, 204):
+                try:
+                    data = res.json() if res.content else None
+                except ValueError:
+                    data = None
+                return WbResult(WbResult.OK, data, res.status_code)
+            error = f"Ошибка {res.status_code}: {res.text}"
+            if res.status_code != 429 and res.status_code < 500:
+                return WbResult(WbResult.ERROR, code=res.status_code, error=error)
+
+        if not idempotent and reached and (res is None or res.status_code != 429):
+            return WbResult(
+                WbResult.ERROR,
+                code=res.status_code if res is not None else None,
+                error=error,
+                meta={"network": res is None, "uncertain": True},
+            )
+
+        if attempt < retries:
+            WB_RETRIES.inc(
+                shop=shop,
+                endpoint=endpoint,
+                reason=res.status_code if res is not None else "network",
+            )
+            delay = retry_delay(res, attempt)
+            if res is not None and res.status_code == 429:
+                # Пауза для всех потоков этого токена, ждём в acquire()
+                bucket.pause(delay)
+            else:
+                time.sleep(delay)
+
+    if res is not None and res.status_code == 429:
+        return WbResult(WbResult.THROTTLED, code=429, error="Лимит запросов WB (429)")
+    if res is None:
+        return WbResult(WbResult.ERROR, error=error, meta={"network": True})
+    return WbResult(WbResult.ERROR, code=res.status_code, error=error)
+
+
+# ==========================================
+# ОТЗЫВЫ И ВОПРОСЫ
+# ==========================================
+
+PAGE_SIZE = 100  # записей за запрос (WB допускает take до 5000)
+MAX_ITEMS = 1000  # по умолчанию не больше стольких записей за скан
+PAGE_WORKERS = 4  # одновременных запросов страниц
+
+
+def get_wb_page(wb_token, mode="feedbacks", take=PAGE_SIZE, skip=0, date_from=None):
+    """
+    Одна страница НЕОТВЕЧЕННЫХ отзывов/вопросов.
+    date_from — unix time, только записи новее.
+    WbResult: data — список записей, meta["total"] — всего неотвеченных.
+    """
+    params = {
+        "isAnswered": "false",
+        "take": take,
+        "skip": skip,
+        "order": "dateDesc",
+    }
+    if date_from:
+        params["dateFrom"] = int(date_from)
+    res = wb_request("GET", f"/api/v1/{mode}", wb_token, params=params)
+    if not res.ok:
+        return res
+    data = (res.data or {}).get("data") or {}
+    items = data.get(mode) or []
+    return WbResult(
+        WbResult.OK if items else WbResult.EMPTY,
+        items,
+        res.code,
+        meta={"total": data.get("countUnanswered")},
+    )
+
+
+def get_unanswered_count(wb_token, mode="feedbacks"):
+    """
+    Число неотвеченных отзывов/вопросов — дешёвая проверка изменений
+    без загрузки страниц: /api/v1/{mode}/count-unanswered
+    WbResult: data — число.
+    """
+    res = wb_request("GET", f"/api/v1/{mode}/count-unanswered", wb_token)
+    if not res.ok:
+        return res
+    count = ((res.data or {}).get("data") or {}).get("countUnanswered")
+    if count is None:
+        return WbResult(WbResult.ERROR, code=res.code, error="Нет countUnanswered в ответе")
+    return WbResult(WbResult.OK, int(count), res.code)
+
+
+def _page_or_raise(wb_token, mode, take, skip, date_from=None):
+    res = get_wb_page(wb_token, mode, take, skip, date_from)
+    if not res.ok:
+        raise WbApiError(res)
+    return res.data, res.meta.get("total")
+
+
+def iter_wb_data(
+    wb_token,
+    mode="feedbacks",
+    limit=MAX_ITEMS,
+    page_size=PAGE_SIZE,
+    workers=1,
+    date_from=None,
+):
+    """
+    Генератор страниц НЕОТВЕЧЕННЫХ отзывов/вопросов, не больше limit записей.
+
+    Первая страница отдаётся сразу. При workers > 1 остальные страницы
+    запрашиваются параллельно (по countUnanswered из первой), но
+    отдаются по порядку. Если страница не загрузилась после повторов —
+    WbApiError с WbResult внутри (например, status == "throttled").
+    date_from — только записи новее (unix time); countUnanswered тогда
+    не описывает выборку, и страницы идут по одной.
+    """
+    if not wb_token or limit <= 0:
+        return
+    first, total = _page_or_raise(
+        wb_token, mode, min(page_size, limit), 0, date_from
+    )
+    if first:
+        yield first
+    if len(first) < min(page_size, limit):
+        return
+
+    if date_from:
+        total = None
+    if total is not None:
+        limit = min(limit, total)
+    skips = range(len(first), limit, page_size)
+
+    if workers <= 1 or total is None:
+        for skip in skips:
+            page, _ = _page_or_raise(
+                wb_token, mode, min(page_size, limit - skip), skip, date_from
+            )
+            if page:
+                yield page
+            if len(page) < min(page_size, limit - skip):
+                return
+        return
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [
+            pool.submit(_page_or_raise, wb_token, mode, min(page_size, limit - s), s)
+            for s in skips
+        ]
+        for fut in futures:
+            page, _ = fut.result()
+            if page:
+                yield page
+    finally:
+        # Если потребитель остановился раньше — не ждём лишние страницы
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class WbLoader:
+    """
+    Фоновая загрузка страниц (iter_wb_data или wb_store.iter_sync):
+    items пополняется по мере прихода страниц, поэтому UI может
+    показывать первую страницу, пока грузятся остальные.
+    """
+
+    def __init__(self, pages):
+        self.items = []
+        self.done = False
+        self.error = None  # WbResult, если загрузка оборвалась
+        self._first = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(pages,), daemon=True)
+        self._thread.start()
+
+    def _run(self, pages):
+        try:
+            for page in pages:
+                self.items.extend(page)
+                self._first.set()
+        except WbApiError as e:
+            self.error = e.result
+        except Exception as e:
+            self.error = WbResult(WbResult.ERROR, error=str(e))
+        finally:
+            self.done = True
+            self._first.set()
+
+    def wait_first(self, timeout=30):
+        """Ждёт первую страницу (или конец загрузки)."""
+        self._first.wait(timeout)
+        return self.items
+
+
+def get_wb_archive_page(wb_token, take=50, skip=0, nm_id=None, order="dateDesc"):
+    """
+    Страница архива отзывов: /api/v1/feedbacks/archive
+    WbResult: data — список отзывов.
+    """
+    params = {"take": take, "skip": skip, "order": order}
+    if nm_id:
+        params["nmId"] = nm_id
+    res = wb_request("GET", "/api/v1/feedbacks/archive", wb_token, params=params)
+    if not res.ok:
+        return res
+    items = ((res.data or {}).get("data") or {}).get("feedbacks") or []
+    return WbResult(WbResult.OK if items else WbResult.EMPTY, items, res.code)
+
+
+def get_wb_archive(wb_token, take=50, skip=0, nm_id=None, order="dateDesc"):
+    """
+    Архив отзывов: /api/v1/feedbacks/archive
+    """
+    res = get_wb_archive_page(wb_token, take, skip, nm_id, order)
+    return res.data if res.ok else []
+
+
+def get_wb_item(wb_token, mode, item_id):
+    """
+    Один отзыв/вопрос по id (отвеченный или нет):
+    GET /api/v1/feedback?id=... или /api/v1/question?id=...
+    WbResult: data — запись или None.
+    """
+    path = "/api/v1/feedback" if mode == "feedbacks" else "/api/v1/question"
+    res = wb_request("GET", path, wb_token, params={"id": item_id})
+    if not res.ok:
+        return res
+    item = (res.data or {}).get("data") or None
+    return WbResult(WbResult.OK if item else WbResult.EMPTY, item, res.code)
+
+
+def has_answer(item):
+    """Есть ли у записи WB опубликованный ответ."""
+    answer = (item or {}).get("answer") or {}
+    return bool(answer.get("text"))
+
+
+def send_wb_answer(item_id, text, wb_token, mode="feedbacks"):
+    """
+    Отправка ответа на отзыв/вопрос WB, результат — WbResult.
+
+    feedbacks  -> POST  /api/v1/feedbacks/answer
+    questions  -> PATCH /api/v1/questions (обязателен state="answered")
+    """
+    if not text or len(text.strip()) < 2:
+        return WbResult(WbResult.ERROR, error="Текст пустой")
+
+    if mode == "feedbacks":
+        # Ответ на отзыв
+        payload = {
+            "id": item_id,
+            "text": text,
+        }
+        return wb_request(
+            "POST", "/api/v1/feedbacks/answer", wb_token, json=payload, idempotent=False
+        )
+
+    elif mode == "questions":
+        # Ответ на вопрос (обязательно state="answered")
+        payload = {
+            "id": item_id,
+            "state": "answered",
+            "answer": {
+                "text": text,
+            },
+        }
+        return wb_request("PATCH", "/api/v1/questions", wb_token, json=payload, idempotent=False)
+
+    return WbResult(WbResult.ERROR, error="Неизвестный режим")
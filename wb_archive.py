@@ -0,0 +1,343 @@
+"""
+Выгрузка полного архива отзывов (/api/v1/feedbacks/archive) в файлы.
+
+Страницы запрашиваются параллельно волнами (в пределах лимитов
+wb_request), каждая волна сразу пишется отдельной частью — Parquet, если
+есть pyarrow, иначе JSONL.gz. В памяти не больше одной волны. Прогресс
+хранится в state.json, поэтому прерванная выгрузка продолжается с
+последней записанной части.
+
+Отзыв попадает в архив, когда на него ответили, а архив упорядочен по
+дате отзыва: поздно отвеченный старый отзыв встаёт перед курсором и
+сдвигает его. Поэтому записи не повторяются по id, а перед продолжением
+курсор сверяется с последней выгруженной записью; если она сдвинулась,
+список этого курсора проходится заново (пишется только новое).
+
+Каталог выгрузки магазина: WB_ARCHIVE_DIR/<магазин>/ (по умолчанию
+archive/).
+"""
+import functools
+import gzip
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from wb_api import get_wb_archive_page
+from wb_store import parse_date
+
+ARCHIVE_DIR = os.environ.get("WB_ARCHIVE_DIR", "archive")
+ARCHIVE_PAGE = 5000  # максимум take у архива WB
+ARCHIVE_WORKERS = 3  # страниц в одной волне
+
+
+@functools.lru_cache(maxsize=None)
+def arrow():
+    """
+    (pyarrow, pyarrow.parquet, схема части) или None, если pyarrow нет.
+    Импорт тяжёлый — при первой записи или чтении, а не при старте UI.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    schema = pa.schema(
+        [
+            ("id", pa.string()),
+            ("shop", pa.string()),
+            ("nm_id", pa.int64()),
+            ("product", pa.string()),
+            ("brand", pa.string()),
+            ("article", pa.string()),
+            ("rating", pa.int64()),
+            ("created_at", pa.string()),
+            ("created_ts", pa.float64()),
+            ("user", pa.string()),
+            ("text", pa.string()),
+            ("pros", pa.string()),
+            ("cons", pa.string()),
+            ("answer", pa.string()),
+            ("answer_ts", pa.float64()),
+            ("photos", pa.int64()),
+            ("raw", pa.string()),
+        ]
+    )
+    return pa, pq, schema
+
+
+def archive_path(shop):
+    safe = re.sub(r"[^\w.-]+", "_", shop).strip("_") or "shop"
+    return os.path.join(ARCHIVE_DIR, safe)
+
+
+def flatten(shop, item):
+    """Отзыв из архива WB -> плоская запись для колоночного файла."""
+    details = item.get("productDetails") or {}
+    answer = item.get("answer") or {}
+    created = item.get("createdDate") or ""
+    answer_date = answer.get("createDate") or answer.get("createdDate")
+    return {
+        "id": str(item.get("id", "")),
+        "shop": shop,
+        "nm_id": details.get("nmId"),
+        "product": details.get("productName", ""),
+        "brand": details.get("brandName", ""),
+        "article": details.get("supplierArticle", ""),
+        "rating": item.get("productValuation"),
+        "created_at": created,
+        "created_ts": parse_date(created) or None,
+        "user": item.get("userName", ""),
+        "text": item.get("text", ""),
+        "pros": item.get("pros", ""),
+        "cons": item.get("cons", ""),
+        "answer": answer.get("text", ""),
+        "answer_ts": parse_date(answer_date) or None,
+        "photos": len(item.get("photoLinks") or []),
+        "raw": json.dumps(item, ensure_ascii=False),
+    }
+
+
+# ==========================================
+# СОСТОЯНИЕ ВЫГРУЗКИ
+# ==========================================
+
+
+def load_state(path):
+    try:
+        with open(os.path.join(path, "state.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"cursors": {}, "parts": [], "rows": 0}
+
+
+def save_state(path, state):
+    tmp = os.path.join(path, "state.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(path, "state.json"))
+
+
+def write_part(path, index, rows, fmt):
+    """Пишет часть атомарно, возвращает имя файла."""
+    if fmt == "parquet":
+        name = f"part-{index:05d}.parquet"
+        tmp = os.path.join(path, name + ".tmp")
+        pa, pq, schema = arrow()
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), tmp, compression="zstd")
+    else:
+        name = f"part-{index:05d}.jsonl.gz"
+        tmp = os.path.join(path, name + ".tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp, os.path.join(path, name))
+    return name
+
+
+def exported(path, state):
+    """(id, артикулы) уже выгруженных записей — по колонкам всех частей."""
+    fmt = state.get("format", "jsonl")
+    ids, nm_ids = set(), set()
+    for part in state["parts"]:
+        if fmt == "parquet":
+            table = arrow()[1].read_table(
+                os.path.join(path, part["file"]), columns=["id", "nm_id"]
+            )
+            rows = table.to_pylist()
+        else:
+            rows = list(read_part(path, part, fmt))
+        ids.update(row["id"] for row in rows)
+        nm_ids.update(row["nm_id"] for row in rows if row["nm_id"])
+    return ids, nm_ids
+
+
+# ==========================================
+# ВЫГРУЗКА
+# ==========================================
+
+
+def cursor_in_place(wb_token, nm, cursor):
+    """
+    Последняя выгруженная курсором запись всё ещё на своём месте в
+    списке WB (перед ней ничего не вставилось). Ошибка WB — считаем, что
+    на месте: выгрузка и так остановится на первой странице.
+    """
+    if not cursor.get("last_id"):
+        return False
+    res = get_wb_archive_page(wb_token, 1, cursor["skip"] - 1, nm, "dateAsc")
+    if not res.ok:
+        return True
+    return bool(res.data) and str(res.data[0].get("id", "")) == cursor["last_id"]
+
+
+def export_archive(
+    shop,
+    wb_token,
+    nm_ids=None,
+    fmt=None,
+    workers=ARCHIVE_WORKERS,
+    page_size=ARCHIVE_PAGE,
+    progress=None,
+    stop_event=None,
+):
+    """
+    Выгружает архив магазина; повторный вызов продолжает с места
+    остановки и дописывает новые отзывы. nm_ids — ещё и по каждому
+    артикулу отдельно: у WB ограничен skip, и очень большой архив целиком
+    одним списком не пролистать. Общий проход идёт и тогда, а к nm_ids
+    добавляются артикулы, уже встреченные в выгрузке, — так выгружается
+    не меньше, чем без них. Записи, уже выгруженные любым курсором
+    (общим или по артикулу), второй раз не пишутся.
+
+    progress(state) вызывается после каждой записанной части.
+    Возвращает state; при ошибке WB — state["error"] с текстом.
+    """
+    path = archive_path(shop)
+    os.makedirs(path, exist_ok=True)
+    state = load_state(path)
+    fmt = state.get("format") or fmt or ("parquet" if arrow() else "jsonl")
+    state["format"] = fmt
+    state.pop("error", None)
+    seen, seen_nm = exported(path, state)
+
+    pending = [None]
+    while pending:
+        nm = pending.pop(0)
+        key = str(nm) if nm else "*"
+        cursor = state["cursors"].setdefault(key, {"skip": 0, "done": False})
+        if cursor["skip"] and not cursor_in_place(wb_token, nm, cursor):
+            cursor["skip"] = 0
+        # Повторный запуск дочитывает то, что попало в архив с прошлого раза
+        cursor["done"] = False
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while not cursor["done"]:
+                if stop_event is not None and stop_event.is_set():
+                    save_state(path, state)
+                    return state
+                skips = [cursor["skip"] + i * page_size for i in range(workers)]
+                results = list(
+                    pool.map(
+                        lambda s: get_wb_archive_page(wb_token, page_size, s, nm, "dateAsc"),
+                        skips,
+                    )
+                )
+                rows, fetched = [], []
+                for res in results:
+                    if not res.ok:
+                        state["error"] = res.error or res.status
+                        break
+                    fetched.extend(res.data)
+                    if len(res.data) < page_size:
+                        cursor["done"] = True
+                        break
+                for item in fetched:
+                    row = flatten(shop, item)
+                    if row["id"] not in seen:
+                        seen.add(row["id"])
+                        rows.append(row)
+                        if row["nm_id"]:
+                            seen_nm.add(row["nm_id"])
+                if rows:
+                    state["parts"].append(
+                        {
+                            "file": write_part(path, len(state["parts"]), rows, fmt),
+                            "rows": len(rows),
+                        }
+                    )
+                    state["rows"] += len(rows)
+                if fetched:
+                    cursor["skip"] += len(fetched)
+                    cursor["last_id"] = str(fetched[-1].get("id", ""))
+                save_state(path, state)
+                if progress is not None:
+                    progress(state)
+                if "error" in state:
+                    return state
+        if nm is None and nm_ids is not None:
+            pending = sorted(set(nm_ids) | seen_nm)
+    return state
+
+
+class ArchiveExport:
+    """Выгрузка в фоновом потоке; UI читает rows/done/error."""
+
+    def __init__(self, shop, wb_token, nm_ids=None):
+        self.shop = shop
+        self.rows = load_state(archive_path(shop))["rows"]
+        self.done = False
+        self.error = None
+        self.stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(wb_token, nm_ids), daemon=True
+        )
+        self._thread.start()
+
+    def _progress(self, state):
+        self.rows = state["rows"]
+
+    def _run(self, wb_token, nm_ids):
+        try:
+            state = export_archive(
+                self.shop,
+                wb_token,
+                nm_ids=nm_ids,
+                progress=self._progress,
+                stop_event=self.stop_event,
+            )
+            self.error = state.get("error")
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.done = True
+
+
+# ==========================================
+# ЧТЕНИЕ
+# ==========================================
+
+
+def archive_count(shop):
+    return load_state(archive_path(shop))["rows"]
+
+
+def read_part(path, part, fmt):
+    file = os.path.join(path, part["file"])
+    if fmt == "parquet":
+        return arrow()[1].read_table(file).to_pylist()
+    with gzip.open(file, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def iter_archive(shop, columns=None):
+    """Все записи выгрузки по частям (генератор списков записей)."""
+    path = archive_path(shop)
+    state = load_state(path)
+    fmt = state.get("format", "jsonl")
+    for part in state["parts"]:
+        if fmt == "parquet" and columns:
+            table = arrow()[1].read_table(os.path.join(path, part["file"]), columns=columns)
+            yield table.to_pylist()
+        else:
+            yield read_part(path, part, fmt)
+
+
+def read_archive(shop, offset=0, limit=50):
+    """
+    Записи [offset, offset + limit) в порядке выгрузки. Открывает только
+    нужные части — для постраничного просмотра во вкладке Архив.
+    """
+    path = archive_path(shop)
+    state = load_state(path)
+    fmt = state.get("format", "jsonl")
+    rows, start = [], 0
+    for part in state["parts"]:
+        end = start + part["rows"]
+        if end > offset and start < offset + limit:
+            data = read_part(path, part, fmt)
+            rows.extend(data[max(offset - start, 0) : offset + limit - start])
+        start = end
+        if start >= offset + limit:
+            break
+    return rows
@@ -0,0 +1,382 @@
+"""
+Авто-режим: параллельные ответы на отзывы и вопросы по всем магазинам.
+
+Вместо последовательного обхода с time.sleep() нагрузку ограничивают
+два лимита: общий (размер пула потоков) и на магазин (число потоков,
+разбирающих очередь магазина), чтобы один большой магазин не забирал
+все потоки и не упирался в лимиты WB.
+
+Перед проходом воркер проверяет изменения дёшево (probe_changes — один
+запрос на режим: число неотвеченных и дата самой новой записи) и грузит
+страницы только при расхождении с базой. Интервал опроса у каждого магазина свой (poll_interval): по
+оценке потока новых записей, от POLL_MIN до заданного максимума.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from wb_ai import BATCH_MAX
+from wb_api import MAX_ITEMS, WbApiError, get_unanswered_count, get_wb_page
+from wb_metrics import (
+    ANSWERS,
+    CYCLE_SECONDS,
+    POLL_INTERVAL,
+    POLLS,
+    QUEUE_DEPTH,
+    STAGE_SECONDS,
+    record_error,
+    register_shops,
+)
+from wb_outbox import flush
+from wb_rules import generate_answers, load_rules
+from wb_store import (
+    FULL_SYNC_EVERY,
+    count_open,
+    enqueue_answer,
+    get_poll_state,
+    get_sync_state,
+    iter_sync,
+    list_items,
+    log_event,
+    log_events,
+    parse_date,
+    queued_ids,
+    set_poll_state,
+)
+
+GLOBAL_LIMIT = 8  # одновременных задач на все магазины
+SHOP_LIMIT = 2  # одновременных задач на один магазин
+POLL_MIN = 60  # сек: чаще магазин не опрашивается
+POLL_MAX = 1800  # сек: реже — тоже, даже если записей нет неделями
+RATE_ALPHA = 0.3  # вес нового замера в оценке потока записей
+
+
+class AutoStats:
+    """
+    Итоги одного цикла авто-режима.
+    events: (магазин, режим, товар, результат) — журнал пишет UI-поток,
+    т.к. st.session_state недоступен из рабочих потоков.
+    stages: сек по этапам (fetch, generate, send), суммарно по потокам.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.answered = 0
+        self.failed = 0
+        self.templated = 0  # из них отвечено шаблоном, без ИИ
+        self.reused = 0  # из них — ответом на похожий вопрос (wb_faq)
+        self.fetched = 0  # новых записей загружено из WB
+        self.events = []
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, shop, mode, prod, result, source=None):
+        with self._lock:
+            if result == "OK":
+                self.answered += 1
+                if source == "template":
+                    self.templated += 1
+                elif source == "faq":
+                    self.reused += 1
+            else:
+                self.failed += 1
+            self.events.append((shop, mode, prod, result))
+        ANSWERS.inc(
+            shop=shop,
+            mode=mode,
+            source=source or "",
+            result="ok" if result == "OK" else "error",
+        )
+
+    def add_fetched(self, count):
+        with self._lock:
+            self.fetched += count
+
+    def add_time(self, shop, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, shop=shop, stage=stage)
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    @property
+    def items_per_minute(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return (self.answered + self.failed) * 60 / self.elapsed
+
+
+def answer_items(
+    sh_name, sh_token, groq_key, mode, items, instructions, signature, rules=None, stats=None
+):
+    """
+    Генерация (шаблонами или одним пакетом ИИ) и отправка ответов на
+    несколько записей одного режима. Возвращает [(товар, результат,
+    источник)], результат "OK" или текст ошибки, источник "template",
+    "faq" или "llm". Ответы идут через очередь отправки (wb_outbox): записи, на
+    которые ответ уже в очереди, пропускаются, а не отправленные из-за
+    временной ошибки досылаются позже без новой генерации.
+    stats (AutoStats) — куда записать время этапов.
+    """
+    done = queued_ids(sh_name, mode, [item["id"] for item in items], auto=True)
+    items = [item for item in items if str(item["id"]) not in done]
+    if not items:
+        return []
+    started = time.monotonic()
+    answers, sources = generate_answers(
+        groq_key, items, mode, instructions, signature, rules, shop=sh_name, auto=True
+    )
+    generated = time.monotonic()
+    if stats is not None:
+        stats.add_time(sh_name, "generate", generated - started)
+    share = (generated - started) / max(len(items), 1)
+    outcome, queued = {}, []
+    for item in items:
+        ans = answers.get(item["id"], "")
+        source = sources.get(item["id"], "llm")
+        if not ans or "Ошибка" in ans:
+            outcome[str(item["id"])] = ans or "Нет ответа"
+        elif enqueue_answer(
+            sh_name, mode, item["id"], ans, source if source in ("template", "faq") else "auto"
+        ):
+            queued.append(item["id"])
+    # Отправляем сразу, в этом же потоке: параллелизм уже ограничен лейнами
+    for row, res in flush({sh_name: sh_token}, mode, queued, len(queued), workers=1):
+        outcome[row["id"]] = res
+    send_share = (time.monotonic() - generated) / max(len(queued), 1)
+
+    results, events = [], []
+    for item in items:
+        res = outcome.get(str(item["id"]))
+        if res is None:
+            continue  # ответ поставил в очередь другой процесс — отправит он
+        prod = item.get("productDetails", {}).get("productName", "")
+        source = sources.get(item["id"], "llm")
+        results.append((prod, res, source))
+        events.append(
+            {
+                "source": "auto",
+                "action": source,
+                "shop": sh_name,
+                "mode": mode,
+                "item_id": item["id"],
+                "result": res,
+                "latency": round(share + send_share, 3),
+                "message": prod,
+            }
+        )
+    log_events(events)
+    if stats is not None:
+        stats.add_time(sh_name, "send", time.monotonic() - generated)
+    return results
+
+
+def run_auto_cycle(
+    shops,
+    groq_key,
+    instructions,
+    signature,
+    global_limit=GLOBAL_LIMIT,
+    shop_limit=SHOP_LIMIT,
+    limit=MAX_ITEMS,
+    batch_size=BATCH_MAX,
+    rules=None,
+    fetch=None,
+):
+    """
+    Один проход авто-режима по всем магазинам.
+
+    shops: {имя: токен}
+    instructions: {"feedbacks": ..., "questions": ...} — только включённые режимы
+    limit: не больше стольких записей каждого режима на магазин
+    batch_size: записей на один запрос к ИИ (1 — без пакетов)
+    rules: правила шаблонных ответов (None — из базы, см. wb_rules)
+    fetch: {режим: full} — что грузить из WB (см. probe_changes); режимы
+        не из fetch отвечаются только по базе. None — грузить всё.
+    """
+    stats = AutoStats()
+    rules = load_rules() if rules is None else rules
+    register_shops(shops)
+    lock = threading.Lock()
+    pending = {name: deque() for name in shops}
+    lanes = {name: 0 for name in shops}
+
+    def lane(sh_name, sh_token):
+        # Обрабатывает очередь магазина, пока она не опустеет
+        while True:
+            with lock:
+                queue = pending[sh_name]
+                if not queue:
+                    lanes[sh_name] -= 1
+                    return
+                # Пакет из записей одного режима для generate_ai_batch
+                mode = queue[0][0]
+                batch = []
+                while queue and queue[0][0] == mode and len(batch) < batch_size:
+                    batch.append(queue.popleft()[1])
+                QUEUE_DEPTH.set(len(queue), shop=sh_name)
+            try:
+                results = answer_items(
+                    sh_name,
+                    sh_token,
+                    groq_key,
+                    mode,
+                    batch,
+                    instructions[mode],
+                    signature,
+                    rules,
+                    stats,
+                )
+            except Exception as e:
+                record_error("auto.lane", e)
+                results = [("", f"Сбой: {e}", None)] * len(batch)
+                log_events(
+                    [
+                        {
+                            "source": "auto",
+                            "shop": sh_name,
+                            "mode": mode,
+                            "item_id": item["id"],
+                            "result": f"Сбой: {e}",
+                        }
+                        for item in batch
+                    ]
+                )
+            for prod, res, source in results:
+                stats.add(sh_name, mode, prod, res, source)
+
+    jobs = []
+
+    def enqueue(pool, sh_name, sh_token, mode, items):
+        with lock:
+            pending[sh_name].extend((mode, item) for item in items)
+            QUEUE_DEPTH.set(len(pending[sh_name]), shop=sh_name)
+            start = min(shop_limit - lanes[sh_name], len(pending[sh_name]))
+            lanes[sh_name] += max(start, 0)
+            for _ in range(start):
+                jobs.append(pool.submit(lane, sh_name, sh_token))
+
+    def feed(pool, sh_name, sh_token, mode):
+        # Сначала весь список из WB, потом ответы: отвеченная запись
+        # уходит из списка неотвеченных и сдвигает skip ещё не загруженных
+        # страниц. Страницы грузятся параллельно (iter_sync), а ответы по
+        # этому режиму магазина — записи из базы и новые — начинаются,
+        # когда загружены все. Другой режим — другой список, он не мешает.
+        stored = list_items(sh_name, mode, limit=limit, auto=True)
+        seen = {str(item["id"]) for item in stored}
+        fresh = []
+        try:
+            if fetch is None or mode in fetch:
+                started = time.monotonic()
+                full = fetch.get(mode) if fetch else None
+                for page in iter_sync(sh_name, sh_token, mode, limit=limit, full=full):
+                    new = [item for item in page if str(item["id"]) not in seen]
+                    seen.update(str(item["id"]) for item in new)
+                    fresh.extend(new)
+                stats.add_time(sh_name, "fetch", time.monotonic() - started)
+                stats.add_fetched(len(fresh))
+        except WbApiError as e:
+            stats.add(sh_name, mode, "загрузка", e.result.error or e.result.status)
+            log_event(
+                "Загрузка",
+                source="auto",
+                action="fetch",
+                shop=sh_name,
+                mode=mode,
+                result=e.result.error or e.result.status,
+            )
+        enqueue(pool, sh_name, sh_token, mode, stored + fresh)
+
+    with ThreadPoolExecutor(max_workers=global_limit) as fetch_pool, ThreadPoolExecutor(
+        max_workers=global_limit
+    ) as pool:
+        # На магазин не больше shop_limit потоков, чтобы потоки пула
+        # не простаивали в ожидании чужого лимита.
+        fetches = [
+            fetch_pool.submit(feed, pool, sh_name, sh_token, mode)
+            for sh_name, sh_token in shops.items()
+            for mode in instructions
+        ]
+        for fut in fetches:
+            fut.result()
+        for fut in list(jobs):
+            fut.result()
+
+    stats.finished = time.monotonic()
+    if len(shops) == 1:
+        CYCLE_SECONDS.observe(stats.elapsed, shop=next(iter(shops)))
+    else:
+        CYCLE_SECONDS.observe(stats.elapsed, shop="*")
+    return stats
+
+
+# ==========================================
+# ОПРОС ИЗМЕНЕНИЙ
+# ==========================================
+
+
+def probe_changes(sh_name, sh_token, modes):
+    """
+    Какие режимы магазина грузить из WB: {режим: full}, full — как в
+    iter_sync (None — по расписанию, True — полная сверка).
+
+    Проверка — одна страница из самой новой неотвеченной записи (take=1):
+    в ответе и её дата, и число неотвеченных. Страницы не запрашиваются,
+    только если совпадают оба признака: число — с базой, дата — с меткой
+    синхронизации. По одному числу не видно, если за интервал столько же
+    новых пришло, сколько ответили в кабинете WB. Запись новее метки —
+    пришло новое, грузим по расписанию; иначе число разошлось без новых
+    записей (ответили в другом месте или запись вернулась в неотвеченные)
+    — нужна полная сверка. Без прежней синхронизации, при ошибке проверки
+    или когда подошла плановая сверка (FULL_SYNC_EVERY) режим грузится
+    как раньше.
+    """
+    fetch = {}
+    for mode in modes:
+        sync = get_sync_state(sh_name, mode)
+        if sync is None or time.time() - sync["full_at"] > FULL_SYNC_EVERY:
+            fetch[mode] = None
+            POLLS.inc(shop=sh_name, mode=mode, result="full")
+            continue
+        res = get_wb_page(sh_token, mode, take=1)
+        remote = res.meta.get("total") if res.ok else None
+        if res.ok and remote is None:
+            counted = get_unanswered_count(sh_token, mode)
+            remote = counted.data if counted.ok else None
+        if remote is None:
+            fetch[mode] = None
+            POLLS.inc(shop=sh_name, mode=mode, result="error")
+            continue
+        newest = parse_date(res.data[0].get("createdDate")) if res.data else 0.0
+        local = count_open(sh_name, mode)
+        if remote == local and newest <= sync["watermark"]:
+            POLLS.inc(shop=sh_name, mode=mode, result="unchanged")
+            continue
+        fetch[mode] = None if newest > sync["watermark"] else True
+        POLLS.inc(shop=sh_name, mode=mode, result="changed")
+    return fetch
+
+
+def poll_interval(sh_name, fetched, max_interval=POLL_MAX):
+    """
+    Сек до следующей проверки магазина. fetched — новых записей с прошлой
+    проверки. Поток записей (шт/сек) сглаживается экспоненциально и
+    хранится в базе, интервал — время до следующей ожидаемой записи
+    в пределах POLL_MIN..max_interval. Новый магазин начинает с POLL_MIN.
+    """
+    now = time.time()
+    state = get_poll_state(sh_name)
+    if state is None or not state["probed_at"]:
+        rate = 1 / POLL_MIN
+    else:
+        sample = fetched / max(now - state["probed_at"], 1)
+        rate = RATE_ALPHA * sample + (1 - RATE_ALPHA) * state["rate"]
+    interval = max_interval if rate <= 0 else min(max(1 / rate, POLL_MIN), max_interval)
+    set_poll_state(sh_name, rate, interval, now)
+    POLL_INTERVAL.set(interval, shop=sh_name)
+    return interval
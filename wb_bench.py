@@ -0,0 +1,648 @@
+"""
+Нагрузочный прогон без боевых WB и Groq.
+
+Поднимает в отдельном процессе заглушки feedbacks-api (отзывы, вопросы,
+архив, ответы) и OpenAI-совместимого /chat/completions с настраиваемыми
+задержкой, долей ошибок 5xx и лимитом запросов (429), направляет на них
+бот через WB_API_URL / GROQ_BASE_URL и прогоняет сценарий. Отчёт:
+записей в минуту, p50/p95/p99 по этапам, пиковая память процесса бота.
+
+Запуск:
+    python wb_bench.py                          — сценарий smoke
+    python wb_bench.py --scenario shops20       — 20 магазинов × 1000 отзывов
+    python wb_bench.py --shops 5 --items 300 --llm-latency 1.5 --error-rate 0.02
+    python wb_bench.py --min-rate 600           — код выхода 1, если медленнее
+    python wb_bench.py --serve                  — только заглушки (для UI/воркера)
+
+Лимит WB на стороне бота (3 запроса/с на токен) по умолчанию боевой —
+--wb-rps позволяет его поднять и мерить накладные расходы самого бота.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+FIRST_TOKEN = 0.15  # сек до первого куска в потоковом ответе заглушки ИИ
+SMALL_MODEL_SPEED = 0.4  # малая модель (…-instant) отвечает быстрее
+
+SCENARIOS = {
+    # магазинов, отзывов и вопросов на магазин, отзывов в архиве магазина
+    "smoke": {"shops": 3, "items": 100, "questions": 20, "archive": 0},
+    "shops20": {"shops": 20, "items": 1000, "questions": 0, "archive": 0},
+    "archive": {"shops": 1, "items": 0, "questions": 0, "archive": 50000},
+}
+
+# ==========================================
+# ЗАГЛУШКИ
+# ==========================================
+
+
+class Limiter:
+    """Token bucket по ключу (токен магазина или ключ Groq)."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """(пропущен ли запрос, остаток, сек до восстановления)."""
+        if not self.rate:
+            return True, self.capacity, 0.0
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            reset = max(cost - tokens, 0) / self.rate
+            return allowed, max(int(tokens), 0), reset
+
+
+def iso(ts):
+    return (
+        datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+        .isoformat()
+        .replace("+00:00", "Z")
+    )
+
+
+def make_item(mode, i, rng, trivial):
+    """Отзыв/вопрос в формате WB. trivial — доля 5★ без текста."""
+    nm = 100_000_000 + i % 50
+    item = {
+        "id": f"{mode[0]}{i}",
+        "createdDate": iso(1_700_000_000 + i * 60),
+        "userName": rng.choice(["Анна", "Игорь", "", "Клиент", "Мария"]),
+        "productDetails": {
+            "nmId": nm,
+            "productName": f"Товар {nm % 1000}",
+            "brandName": "Bench",
+            "supplierArticle": f"A-{nm % 1000}",
+        },
+    }
+    if mode == "questions":
+        item["text"] = f"Подойдёт ли товар {i} для подарка?"
+    elif rng.random() < trivial:
+        item.update(productValuation=5, text="", pros="", cons="")
+    else:
+        item.update(
+            productValuation=rng.randint(1, 5),
+            text=f"Отзыв номер {i}: качество среднее, доставка быстрая."
+            # Каждый пятый — длинный, чтобы шёл в большую модель
+            + (" Подробно: товар пришёл с дефектом, упаковка порвана." * 4 if i % 5 == 0 else ""),
+            pros="удобный" if i % 3 else "",
+            cons="запах, брак упаковки" if i % 4 == 0 else "",
+        )
+    return item
+
+
+class FakeWb:
+    """Состояние заглушки feedbacks-api: записи по токенам магазинов."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.rng = random.Random(cfg["seed"])
+        self.limiter = Limiter(cfg["wb_limit"], cfg["wb_limit"] * 2)
+        self.open = {}  # (токен, режим) -> {id: запись}
+        self.archive = {}  # токен -> [записи], от старых к новым
+        self.answered = {}  # (токен, режим, id) -> запись с ответом
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+        for n in range(cfg["shops"]):
+            token = f"bench-token-{n}"
+            for mode, count in (("feedbacks", cfg["items"]), ("questions", cfg["questions"])):
+                items = [make_item(mode, i, self.rng, cfg["trivial"]) for i in range(count)]
+                self.open[(token, mode)] = {it["id"]: it for it in items}
+            self.archive[token] = [
+                dict(
+                    make_item("feedbacks", i, self.rng, 0),
+                    id=f"a{i}",
+                    answer={"text": "Спасибо!", "createDate": iso(1_700_000_000 + i * 60 + 7200)},
+                )
+                for i in range(cfg["archive"])
+            ]
+
+    def unanswered(self, token, mode, q):
+        with self._lock:
+            rows = list(self.open.get((token, mode), {}).values())
+        if "dateFrom" in q:
+            since = iso(int(q["dateFrom"]))
+            rows = [r for r in rows if r["createdDate"] >= since]
+        rows.sort(key=lambda r: r["createdDate"], reverse=q.get("order") != "dateAsc")
+        skip, take = int(q.get("skip", 0)), int(q.get("take", 50))
+        total = len(self.open.get((token, mode), {}))
+        return {"data": {mode: rows[skip : skip + take], "countUnanswered": total}}
+
+    def answer(self, token, mode, item_id, text):
+        with self._lock:
+            item = self.open.get((token, mode), {}).pop(str(item_id), None)
+            if item is None:
+                self.counts["duplicate"] += 1  # второй ответ на ту же запись
+                return False
+            self.answered[(token, mode, str(item_id))] = dict(item, answer={"text": text})
+            return True
+
+    def find(self, token, mode, item_id):
+        with self._lock:
+            key = (token, mode, str(item_id))
+            return self.answered.get(key) or self.open.get((token, mode), {}).get(str(item_id))
+
+
+class WbHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, obj=None, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode() if obj is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def gate(self, kind):
+        """Лимит, задержка и случайная ошибка. False — ответ уже отправлен."""
+        wb = self.server.wb
+        cfg = wb.cfg
+        wb.counts[kind] += 1
+        allowed, _, reset = wb.limiter.take(self.headers.get("Authorization", ""))
+        if not allowed:
+            wb.counts["429"] += 1
+            self.send(429, {"title": "too many requests"}, {"X-Ratelimit-Retry": f"{reset:.2f}"})
+            return False
+        time.sleep(cfg["wb_latency"] * wb.rng.uniform(0.5, 1.5))
+        if wb.rng.random() < cfg["error_rate"]:
+            wb.counts["5xx"] += 1
+            self.send(503, {"title": "unavailable"})
+            return False
+        return True
+
+    def body(self):
+        size = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(size) or b"{}")
+
+    def do_GET(self):
+        wb = self.server.wb
+        url = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        token = self.headers.get("Authorization", "")
+        if url.path == "/bench/stats":
+            return self.send(200, {"wb": wb.counts, "llm": self.server.llm_counts})
+        if url.path == "/api/v1/feedbacks/archive":
+            if not self.gate("archive"):
+                return
+            rows = wb.archive.get(token, [])
+            if q.get("order") != "dateAsc":
+                rows = rows[::-1]
+            if "nmId" in q:
+                rows = [r for r in rows if str(r["productDetails"]["nmId"]) == q["nmId"]]
+            skip, take = int(q.get("skip", 0)), int(q.get("take", 50))
+            return self.send(200, {"data": {"feedbacks": rows[skip : skip + take]}})
+        if url.path in ("/api/v1/feedback", "/api/v1/question"):
+            if not self.gate("item"):
+                return
+            mode = url.path.rsplit("/", 1)[-1] + "s"
+            return self.send(200, {"data": wb.find(token, mode, q.get("id"))})
+        if url.path in ("/api/v1/feedbacks/count-unanswered", "/api/v1/questions/count-unanswered"):
+            if not self.gate("count"):
+                return
+            with wb._lock:
+                total = len(wb.open.get((token, url.path.split("/")[3]), {}))
+            return self.send(200, {"data": {"countUnanswered": total}})
+        mode = url.path.rsplit("/", 1)[-1]
+        if mode in ("feedbacks", "questions"):
+            if not self.gate("list"):
+                return
+            return self.send(200, wb.unanswered(token, mode, q))
+        self.send(404, {"title": "not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/api/v1/feedbacks/answer":
+            return self.send(404, {"title": "not found"})
+        payload = self.body()
+        if not self.gate("answer"):
+            return
+        token = self.headers.get("Authorization", "")
+        self.server.wb.answer(token, "feedbacks", payload.get("id"), payload.get("text"))
+        self.send(204)
+
+    def do_PATCH(self):
+        if urlparse(self.path).path != "/api/v1/questions":
+            return self.send(404, {"title": "not found"})
+        payload = self.body()
+        if not self.gate("answer"):
+            return
+        token = self.headers.get("Authorization", "")
+        self.server.wb.answer(
+            token, "questions", payload.get("id"), (payload.get("answer") or {}).get("text")
+        )
+        self.send(204)
+
+
+class LlmHandler(BaseHTTPRequestHandler):
+    """OpenAI-совместимый /chat/completions с заголовками лимитов как у Groq."""
+
+    protocol_version = "HTTP/1.1"
+    log_message = WbHandler.log_message
+    send = WbHandler.send
+
+    def do_POST(self):
+        srv = self.server
+        cfg = srv.cfg
+        size = int(self.headers.get("Content-Length") or 0)
+        req = json.loads(self.rfile.read(size) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self.send(404, {"error": {"message": "not found"}})
+        prompt = req["messages"][-1]["content"]
+        rows = batch_rows(prompt)
+        prompt_tokens = len(prompt) // 3 + 1
+        completion_tokens = 60 * max(len(rows), 1)
+
+        # Лимиты Groq — на ключ и модель
+        model = req.get("model", "")
+        key = (self.headers.get("Authorization", ""), model)
+        srv.counts["chat"] += 1
+        srv.counts[f"model {model}"] += 1
+        ok_req, left_req, reset_req = srv.rpm.take(key)
+        ok_tok, left_tok, reset_tok = srv.tpm.take(key, prompt_tokens + completion_tokens)
+        headers = {}
+        if cfg["llm_rpm"]:
+            headers["x-ratelimit-limit-requests"] = str(cfg["llm_rpm"])
+            headers["x-ratelimit-remaining-requests"] = str(left_req)
+            headers["x-ratelimit-reset-requests"] = f"{reset_req:.2f}s"
+        if cfg["llm_tpm"]:
+            headers["x-ratelimit-limit-tokens"] = str(cfg["llm_tpm"])
+            headers["x-ratelimit-remaining-tokens"] = str(left_tok)
+            headers["x-ratelimit-reset-tokens"] = f"{reset_tok:.2f}s"
+        if not (ok_req and ok_tok):
+            srv.counts["429"] += 1
+            headers["retry-after"] = f"{max(reset_req, reset_tok):.2f}"
+            return self.send(429, {"error": {"message": "rate limit"}}, headers)
+        delay = (cfg["llm_latency"] + cfg["llm_per_item"] * len(rows)) * srv.rng.uniform(0.7, 1.3)
+        if "instant" in model:
+            delay *= SMALL_MODEL_SPEED
+        # Поток: первый кусок быстро, остальное время — между кусками
+        first = min(delay, FIRST_TOKEN) if req.get("stream") else delay
+        time.sleep(first)
+        if srv.rng.random() < cfg["error_rate"]:
+            srv.counts["5xx"] += 1
+            return self.send(500, {"error": {"message": "internal"}}, headers)
+
+        if rows:
+            content = json.dumps(
+                {
+                    "answers": [
+                        {"id": r["id"], "answer": f"{r['greeting']}\n\nСпасибо за отзыв о товаре {r['product']}!"}
+                        for r in rows
+                    ]
+                },
+                ensure_ascii=False,
+            )
+        else:
+            m = re.search(r'Начни с: "(.*?)"', prompt)
+            content = f"{m.group(1) if m else 'Здравствуйте!'}\n\nСпасибо за ваше сообщение!"
+        if req.get("stream"):
+            return self.stream(req, content, delay - first, headers)
+        self.send(
+            200,
+            {
+                "id": f"bench-{srv.counts['chat']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": req.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+            headers,
+        )
+
+
+    def stream(self, req, content, rest, headers):
+        """Ответ потоком SSE, как stream=True у OpenAI/Groq."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        pieces = re.findall(r"\S+\s*", content)
+        for i, piece in enumerate(pieces):
+            chunk = {
+                "id": "bench-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": req.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": piece},
+                        "finish_reason": "stop" if i == len(pieces) - 1 else None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(rest / max(len(pieces), 1))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def batch_rows(prompt):
+    """Записи пакетного запроса (строка JSON-массива в промпте) или []."""
+    for line in prompt.splitlines():
+        line = line.strip()
+        if line.startswith("[{"):
+            try:
+                return json.loads(line)
+            except ValueError:
+                pass
+    return []
+
+
+def serve_fakes(cfg, ready):
+    """Тело процесса заглушек: (url WB, url Groq) -> ready, дальше — обслуживание."""
+    wb_srv = ThreadingHTTPServer(("127.0.0.1", 0), WbHandler)
+    wb_srv.daemon_threads = True
+    wb_srv.wb = FakeWb(cfg)
+    llm_srv = ThreadingHTTPServer(("127.0.0.1", 0), LlmHandler)
+    llm_srv.daemon_threads = True
+    llm_srv.cfg = cfg
+    llm_srv.rng = random.Random(cfg["seed"] + 1)
+    llm_srv.counts = defaultdict(int)
+    llm_srv.rpm = Limiter(cfg["llm_rpm"] / 60, cfg["llm_rpm"])
+    llm_srv.tpm = Limiter(cfg["llm_tpm"] / 60, cfg["llm_tpm"])
+    wb_srv.llm_counts = llm_srv.counts
+    threading.Thread(target=llm_srv.serve_forever, daemon=True).start()
+    ready.put(
+        (
+            f"http://127.0.0.1:{wb_srv.server_port}",
+            f"http://127.0.0.1:{llm_srv.server_port}/openai/v1",
+        )
+    )
+    wb_srv.serve_forever()
+
+
+# ==========================================
+# ЗАМЕРЫ
+# ==========================================
+
+
+class Timings:
+    """Длительности вызовов по этапам."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.samples[stage].append(elapsed)
+
+        return timed
+
+    def report(self):
+        out = {}
+        with self._lock:
+            for stage, values in sorted(self.samples.items()):
+                values = sorted(values)
+                out[stage] = {
+                    "count": len(values),
+                    "p50": percentile(values, 0.50),
+                    "p95": percentile(values, 0.95),
+                    "p99": percentile(values, 0.99),
+                    "max": values[-1],
+                }
+        return out
+
+
+def percentile(values, q):
+    """Перцентиль по отсортированному списку (nearest rank)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(int(q * len(values) + 0.5) - 1, 0))]
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — КБ
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def instrument(timings):
+    """Оборачивает этапы бота замерами времени."""
+    import wb_ai
+    import wb_api
+    import wb_archive
+    import wb_auto
+    import wb_outbox
+
+    wb_api.get_wb_page = timings.wrap("wb_page", wb_api.get_wb_page)
+    wb_archive.get_wb_archive_page = timings.wrap("archive_page", wb_archive.get_wb_archive_page)
+    wb_ai._generate_one = timings.wrap("llm_one", wb_ai._generate_one)
+    wb_ai._generate_batch_once = timings.wrap("llm_batch", wb_ai._generate_batch_once)
+    wb_auto.generate_answers = timings.wrap("generate", wb_auto.generate_answers)
+    wb_outbox.send_wb_answer = timings.wrap("send", wb_outbox.send_wb_answer)
+    wb_auto.answer_items = timings.wrap("batch_total", wb_auto.answer_items)
+
+
+# ==========================================
+# ПРОГОН
+# ==========================================
+
+
+def run_bench(cfg):
+    """Прогон сценария. Возвращает отчёт (dict)."""
+    ready = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(cfg, ready), daemon=True)
+    fakes.start()
+    wb_url, llm_url = ready.get(timeout=120)
+
+    workdir = tempfile.mkdtemp(prefix="wb_bench_")
+    # До импорта модулей бота: адреса и пути читаются при импорте
+    os.environ["WB_API_URL"] = wb_url
+    os.environ["GROQ_BASE_URL"] = llm_url
+    os.environ["WB_STORE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["WB_ARCHIVE_DIR"] = os.path.join(workdir, "archive")
+    os.environ.pop("WB_ANSWER_CACHE", None)
+
+    import wb_api
+
+    if cfg["wb_rps"]:
+        wb_api.RATE_PER_SEC = cfg["wb_rps"]
+        wb_api.RATE_BURST = cfg["wb_rps"] * 2
+
+    timings = Timings()
+    instrument(timings)
+    from wb_archive import export_archive
+    from wb_auto import run_auto_cycle
+
+    shops = {f"Магазин {n}": f"bench-token-{n}" for n in range(cfg["shops"])}
+    instructions = {}
+    if cfg["items"]:
+        instructions["feedbacks"] = "Благодари за покупку."
+    if cfg["questions"]:
+        instructions["questions"] = "Отвечай коротко."
+
+    rss_before = peak_rss_mb()
+    started = time.monotonic()
+    report = {"config": cfg}
+    if instructions:
+        stats = run_auto_cycle(
+            shops,
+            "bench-key",
+            instructions,
+            "С уважением, Bench",
+            global_limit=cfg["workers"],
+            limit=max(cfg["items"], cfg["questions"]),
+        )
+        report["auto"] = {
+            "answered": stats.answered,
+            "failed": stats.failed,
+            "templated": stats.templated,
+            "seconds": round(stats.elapsed, 2),
+            "items_per_minute": round(stats.items_per_minute, 1),
+        }
+    if cfg["archive"]:
+        arch_started = time.monotonic()
+        states = []
+        threads = [
+            threading.Thread(target=lambda n=name, t=token: states.append(export_archive(n, t)))
+            for name, token in shops.items()
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        seconds = time.monotonic() - arch_started
+        rows = sum(state["rows"] for state in states)
+        report["archive"] = {
+            "rows": rows,
+            "seconds": round(seconds, 2),
+            "rows_per_minute": round(rows * 60 / seconds, 1) if seconds else 0.0,
+        }
+    report["seconds"] = round(time.monotonic() - started, 2)
+    report["stages"] = timings.report()
+    report["memory_mb"] = {"before": round(rss_before, 1), "peak": round(peak_rss_mb(), 1)}
+    report["server"] = requests.get(wb_url + "/bench/stats", timeout=10).json()
+    fakes.terminate()
+    return report
+
+
+def print_report(report):
+    print(f"Время: {report['seconds']} сек")
+    if "auto" in report:
+        a = report["auto"]
+        print(
+            f"Авто-режим: отвечено {a['answered']} (шаблоном {a['templated']}), "
+            f"ошибок {a['failed']}, {a['items_per_minute']} записей/мин"
+        )
+    if "archive" in report:
+        a = report["archive"]
+        print(f"Архив: {a['rows']} отзывов, {a['rows_per_minute']} отзывов/мин")
+    print(f"Память (RSS): до {report['memory_mb']['before']} МБ, пик {report['memory_mb']['peak']} МБ")
+    for name, counts in report["server"].items():
+        print(f"Заглушка {name}: " + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())))
+    print(f"{'этап':<14}{'вызовов':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for stage, s in report["stages"].items():
+        print(
+            f"{stage:<14}{s['count']:>9}"
+            + "".join(f"{s[k] * 1000:>10.0f}" for k in ("p50", "p95", "p99", "max"))
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон с заглушками WB и Groq")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="smoke")
+    parser.add_argument("--shops", type=int, help="магазинов")
+    parser.add_argument("--items", type=int, help="неотвеченных отзывов на магазин")
+    parser.add_argument("--questions", type=int, help="неотвеченных вопросов на магазин")
+    parser.add_argument("--archive", type=int, help="отзывов в архиве магазина")
+    parser.add_argument("--trivial", type=float, default=0.5, help="доля 5★ без текста")
+    parser.add_argument("--workers", type=int, default=8, help="потоков авто-режима")
+    parser.add_argument("--wb-latency", type=float, default=0.05, help="сек на запрос WB")
+    parser.add_argument("--wb-limit", type=float, default=0, help="лимит WB на токен, запросов/с (0 — нет)")
+    parser.add_argument("--wb-rps", type=float, default=0, help="лимит бота на токен WB (0 — боевой)")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="сек на запрос к ИИ")
+    parser.add_argument("--llm-per-item", type=float, default=0.1, help="сек на запись в пакете")
+    parser.add_argument("--llm-rpm", type=int, default=0, help="лимит ИИ, запросов/мин (0 — нет)")
+    parser.add_argument("--llm-tpm", type=int, default=0, help="лимит ИИ, токенов/мин (0 — нет)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 5xx")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать отчёт в файл")
+    parser.add_argument("--min-rate", type=float, help="минимум записей/мин, иначе код выхода 1")
+    parser.add_argument("--serve", action="store_true", help="только поднять заглушки")
+    args = parser.parse_args(argv)
+
+    cfg = dict(SCENARIOS[args.scenario])
+    for name in ("shops", "items", "questions", "archive"):
+        if getattr(args, name) is not None:
+            cfg[name] = getattr(args, name)
+    for name in (
+        "trivial", "workers", "wb_latency", "wb_limit", "wb_rps", "llm_latency",
+        "llm_per_item", "llm_rpm", "llm_tpm", "error_rate", "seed",
+    ):
+        cfg[name] = getattr(args, name)
+
+    if args.serve:
+        ready = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=serve_fakes, args=(cfg, ready), daemon=True)
+        proc.start()
+        wb_url, llm_url = ready.get(timeout=120)
+        print(f"WB_API_URL={wb_url}\nGROQ_BASE_URL={llm_url}")
+        print(f"Токены магазинов: bench-token-0 .. bench-token-{cfg['shops'] - 1}")
+        try:
+            proc.join()
+        except KeyboardInterrupt:
+            proc.terminate()
+        return 0
+
+    report = run_bench(cfg)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    rate = report.get("auto", {}).get("items_per_minute")
+    if args.min_rate is not None and rate is not None and rate < args.min_rate:
+        print(f"Медленнее порога: {rate} < {args.min_rate} записей/мин")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
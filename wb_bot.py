@@ -1,8 +1,57 @@
 import streamlit as st
-import requests
 import time
 import datetime
-from openai import OpenAI
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Отсчёт прохода скрипта — до импорта модулей бота: на холодном старте
+# это время импорта, на перезапусках модули уже загружены
+RUN_STARTED = time.perf_counter()
+
+from wb_ai import BATCH_MAX, AiStream, answer_cache, paraphrase_ai, review_text
+from wb_api import MAX_ITEMS, WbLoader
+from wb_archive import ArchiveExport, archive_count, read_archive
+from wb_faq import core_answer, faq_index, load_faq, reuse_answer
+from wb_images import (
+    PHOTO_SIZE,
+    get_images,
+    get_photo_urls,
+    item_photo_urls,
+    load_basket_table,
+    prefetch_images,
+)
+from wb_metrics import (
+    METRICS_PORT,
+    UI_SECONDS,
+    quantile,
+    record_error,
+    register_shops,
+    serve_metrics,
+    snapshot,
+)
+from wb_outbox import drain, flush
+from wb_rules import DEFAULT_RULES, check_rules, generate_answers, load_rules, rule_stats
+from wb_store import (
+    count_events,
+    count_items,
+    enqueue_answer,
+    get_drafts,
+    get_outbox,
+    get_setting,
+    iter_sync,
+    list_events,
+    list_items,
+    list_nm_ids,
+    list_workers,
+    log_event,
+    outbox_counts,
+    retry_failed,
+    save_draft,
+    set_setting,
+)
 
 # ==========================================
 # 1. НАСТРОЙКИ
@@ -43,219 +92,679 @@ def format_date(iso_date):
         return str(iso_date)
 
 
-def get_main_photo_url(nm_id):
-    try:
-        vol = int(nm_id) // 100000
-        part = int(nm_id) // 1000
-        basket = "01"
-        if 0 <= vol <= 143:
-            basket = "01"
-        elif 144 <= vol <= 287:
-            basket = "02"
-        elif 288 <= vol <= 431:
-            basket = "03"
-        elif 432 <= vol <= 719:
-            basket = "04"
-        elif 720 <= vol <= 1007:
-            basket = "05"
-        elif 1008 <= vol <= 1061:
-            basket = "06"
-        elif 1062 <= vol <= 1115:
-            basket = "07"
-        elif 1116 <= vol <= 1169:
-            basket = "08"
-        elif 1170 <= vol <= 1313:
-            basket = "09"
-        elif 1314 <= vol <= 1601:
-            basket = "10"
-        elif 1602 <= vol <= 1655:
-            basket = "11"
-        elif 1656 <= vol <= 1919:
-            basket = "12"
-        elif 1920 <= vol <= 2045:
-            basket = "13"
-        elif 2046 <= vol <= 2189:
-            basket = "14"
-        elif 2190 <= vol <= 2405:
-            basket = "15"
-        else:
-            basket = "16"
-        return f"https://basket-{basket}.wbbasket.ru/vol{vol}/part{part}/{nm_id}/images/c246x328/1.webp"
-    except Exception:
-        return None
+@st.cache_resource
+def boot():
+    """
+    Один раз на процесс (общий для всех вкладок браузера): эндпоинт
+    /metrics UI и замер холодного старта. HTTP-сессии WB и клиенты Groq
+    живут в своих модулях и тоже создаются один раз на процесс.
+    """
+    # Метрики UI — на порту после воркерского (см. wb_metrics)
+    serve_metrics(METRICS_PORT + 1)
+    return {"imports": None, "first_run": None}
 
 
-def get_wb_data(wb_token, mode="feedbacks"):
+class RunTimer:
     """
-    Получение НЕОТВЕЧЕННЫХ отзывов/вопросов.
-    mode: "feedbacks" или "questions"
+    Время этапов одного прохода скрипта: Streamlit выполняет его заново
+    на каждое действие. Этапы — в /metrics (ui_run_seconds) и в сайдбаре.
     """
-    if not wb_token:
-        return []
-    headers = {"Authorization": wb_token}
-    params = {
-        "isAnswered": "false",
-        "take": 50,
-        "skip": 0,
-        "order": "dateDesc",
-    }
-    try:
-        url = f"https://feedbacks-api.wildberries.ru/api/v1/{mode}"
-        res = requests.get(url, headers=headers, params=params, timeout=15)
-        if res.status_code == 200:
-            json_data = res.json()
-            if "data" in json_data and mode in json_data["data"]:
-                return json_data["data"][mode]
-        return []
-    except Exception:
-        return []
 
+    def __init__(self, started):
+        self.started = self.last = started
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        UI_SECONDS.observe(now - self.last, stage=stage)
+        self.last = now
 
-def get_wb_archive(wb_token, take=50, skip=0, nm_id=None, order="dateDesc"):
+    def finish(self):
+        total = time.perf_counter() - self.started
+        UI_SECONDS.observe(total, stage="total")
+        return total
+
+
+WORKER_TIMEOUT = 30  # сек без heartbeat — воркер считается остановленным
+
+
+def save_worker_config(**changes):
     """
-    Архив отзывов: /api/v1/feedbacks/archive
+    Меняет только переданные поля настроек воркера (worker.config) —
+    общих для всех открытых вкладок UI.
     """
-    if not wb_token:
-        return []
-    headers = {"Authorization": wb_token}
-    params = {"take": take, "skip": skip, "order": order}
-    if nm_id:
-        params["nmId"] = nm_id
-    try:
-        url = "https://feedbacks-api.wildberries.ru/api/v1/feedbacks/archive"
-        res = requests.get(url, headers=headers, params=params, timeout=15)
-        if res.status_code == 200:
-            json_data = res.json()
-            if "data" in json_data and "feedbacks" in json_data["data"]:
-                return json_data["data"]["feedbacks"]
-        return []
-    except Exception:
-        return []
+    cfg = dict(get_setting("worker.config") or {})
+    cfg.update(changes)
+    set_setting("worker.config", cfg)
 
 
-def send_wb_smart(item_id, text, wb_token, mode="feedbacks"):
-    """
-    Отправка ответа на отзыв/вопрос WB.
+@st.fragment(run_every=5)
+def worker_panel():
+    """Статус фоновых воркеров авто-ответов и управление ими."""
+    workers = [
+        w for w in list_workers(alive=WORKER_TIMEOUT) if w["status"].get("state") == "running"
+    ]
+    alive = bool(workers)
+    if alive:
+        st.caption(
+            f"🟢 Воркеров: {len(workers)} | "
+            f"в очереди: {sum(w['status'].get('queue', 0) for w in workers)} | "
+            f"в работе: {sum(len(w['status'].get('running', [])) for w in workers)}"
+        )
+        for w in workers:
+            st.caption(
+                f"{w['host']}:{w['pid']} — магазины: "
+                f"{', '.join(w['status'].get('leased', [])) or '—'}"
+            )
+    else:
+        st.caption("⚪ Воркер остановлен")
+
+    b1, b2, b3 = st.columns(3)
+    if b1.button("▶", help="Запустить воркер (ещё один, если уже работают)"):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        with open("wb_worker.log", "a") as out:
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(base_dir, "wb_worker.py"),
+                    # /metrics на своём порту у каждого воркера
+                    "--metrics-port",
+                    str(METRICS_PORT + 1 + len(workers) if alive else METRICS_PORT),
+                ],
+                stdout=out,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        st.toast("Воркер запускается...")
+    if b2.button("⏹", help="Остановить все воркеры", disabled=not alive):
+        set_setting("worker.stop", True)
+        st.toast("Воркеры остановятся после текущих задач")
+    if b3.button("⚡", help="Пройти все магазины сейчас", disabled=not alive):
+        set_setting("worker.run_now", time.time())
+
+    for w in workers:
+        for sh_name, last in w["status"].get("shops", {}).items():
+            st.caption(
+                f"{sh_name}: ✅ {last['answered']} (шаблоном {last.get('templated', 0)}, "
+                f"из FAQ {last.get('reused', 0)}) | "
+                f"❌ {last['failed']} | "
+                f"{last['per_minute']} шт/мин"
+                + (f" | опрос раз в {last['interval']} с" if last.get("interval") else "")
+            )
 
-    feedbacks  -> POST  /api/v1/feedbacks/answer
-    questions  -> PATCH /api/v1/questions (обязателен state="answered")
-    """
-    headers = {
-        "Authorization": wb_token,
-        "Content-Type": "application/json",
-    }
 
+def paginate(items, key, page_size):
+    """
+    Переключатель страниц. Возвращает (записи текущей страницы,
+    записи следующей — для фоновой подгрузки).
+    """
+    pages = max(1, -(-len(items) // page_size))
+    if st.session_state.get(key, 1) > pages:
+        st.session_state[key] = pages
+    page = 1
+    if pages > 1:
+        pc1, pc2 = st.columns([1, 4])
+        page = pc1.number_input("Страница", min_value=1, max_value=pages, key=key)
+        pc2.caption(f"из {pages} | всего {len(items)}")
+    start = (page - 1) * page_size
+    return items[start : start + page_size], items[start + page_size : start + 2 * page_size]
+
+
+def stream_draft(stream, area_key, shop, mode, item_id):
+    """
+    Показывает ответ ИИ по мере генерации и кладёт итог в черновик.
+    «Остановить» перезапускает фрагмент — поток закрывается, в
+    черновике остаётся уже пришедший текст.
+    """
+    box = st.empty()
+    box.caption("Пишу ответ...")
+    st.button("⏹ Остановить", key=f"stop_{area_key}")
+    chunks = iter(stream)
+    shown = 0.0
+    try:
+        for _ in chunks:
+            # Не чаще 20 раз в секунду — каждая перерисовка идёт в браузер
+            if time.monotonic() - shown > 0.05:
+                box.markdown(stream.text + "▌")
+                shown = time.monotonic()
+    finally:
+        chunks.close()
+        ans = stream.result()
+        st.session_state[area_key] = ans
+        if ans:
+            save_draft(shop, mode, item_id, ans)
+    box.empty()
+
+
+def send_answer(shop, wb_token, mode, item_id, text, prod_name):
+    """
+    Ответ через очередь отправки (wb_outbox): "OK", "queued" — ответ на
+    эту запись уже в очереди или отправлен, "sending" — запись забрал
+    воркер и отправит сам (итог — sending_result), иначе текст ошибки.
+    """
     if not text or len(text.strip()) < 2:
         return "Текст пустой"
+    started = time.monotonic()
+    if not enqueue_answer(shop, mode, item_id, text, "manual"):
+        return "queued"
+    done = flush({shop: wb_token}, mode, [item_id], 1)
+    # Запись уже забрал воркер — отправит он
+    res = done[0][1] if done else "sending"
+    log_event(
+        prod_name,
+        source="ui",
+        action="send",
+        shop=shop,
+        mode=mode,
+        item_id=item_id,
+        result=res,
+        latency=round(time.monotonic() - started, 3),
+    )
+    return res
 
-    try:
-        if mode == "feedbacks":
-            # Ответ на отзыв
-            url = "https://feedbacks-api.wildberries.ru/api/v1/feedbacks/answer"
-            payload = {
-                "id": item_id,
-                "text": text,
-            }
-            res = requests.post(url, headers=headers, json=payload, timeout=15)
-            if res.status_code in (200, 204):
-                return "OK"
-            return f"Ошибка {res.status_code}: {res.text}"
-
-        elif mode == "questions":
-            # Ответ на вопрос (обязательно state="answered")
-            url = "https://feedbacks-api.wildberries.ru/api/v1/questions"
-            payload = {
-                "id": item_id,
-                "state": "answered",
-                "answer": {
-                    "text": text,
-                },
-            }
-            res = requests.patch(url, headers=headers, json=payload, timeout=15)
-            if res.status_code in (200, 204):
-                return "OK"
-            return f"Ошибка {res.status_code}: {res.text}"
 
-        else:
-            return "Неизвестный режим"
+def sending_result(shop, mode, item_id):
+    """
+    Итог отправки, которую забрал воркер: "OK", текст ошибки или
+    "sending", пока запись в работе.
+    """
+    row = get_outbox(shop, mode, item_id)
+    if row is None or row["state"] in ("pending", "sending"):
+        return "sending"
+    if row["state"] == "failed":
+        return row["error"] or "Ошибка отправки"
+    return "OK"
+
+
+def send_result(res, kind):
+    """Итог отправки в карточке (в том числе после массовой отправки)."""
+    if res is None or res == "OK":
+        return
+    if res == "queued":
+        st.warning(f"Ответ на этот {kind} уже в очереди или отправлен.")
+    elif res == "sending":
+        st.info("Ответ в очереди, его отправляет воркер. Итог появится в карточке.")
+    else:
+        st.error(res)
+
+
+BULK_WORKERS = 4  # одновременных задач массовой генерации и отправки
 
-    except Exception as e:
-        return f"Сбой сети: {e}"
 
+def selected_items(items, prefix, fallback=True):
+    """Отмеченные в карточках записи, а если не отмечено ничего — все (fallback)."""
+    chosen = [it for it in items if st.session_state.get(f"sel_{prefix}_{it['id']}")]
+    return chosen or (items if fallback else [])
 
-def generate_ai(api_key, text, item_name, user_name, instructions, signature):
+
+def bulk_generate(items, mode, prefix, shop, groq_key, instructions, signature):
+    """
+    Черновики для записей без черновика: пакеты generate_answers
+    (шаблоны, FAQ + пакетный ИИ) параллельно, с прогрессом по готовым пакетам.
     """
-    Генерация ответа через Groq (совместимый OpenAI клиент).
+    todo = [it for it in items if not st.session_state.get(f"area_{prefix}_{it['id']}")]
+    if not todo:
+        st.toast("Черновики уже есть")
+        return
+    rules = load_rules()
+    chunks = [todo[i : i + BATCH_MAX] for i in range(0, len(todo), BATCH_MAX)]
+    bar = st.progress(0.0, text=f"Черновики: 0 из {len(todo)}")
+    done = 0
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+        futures = [
+            pool.submit(
+                generate_answers, groq_key, chunk, mode, instructions, signature, rules, shop
+            )
+            for chunk in chunks
+        ]
+        for fut in as_completed(futures):
+            try:
+                answers, _ = fut.result()
+            except Exception as e:
+                record_error("ui.bulk_generate", e)
+                answers = {}
+            for item_id, ans in answers.items():
+                st.session_state[f"area_{prefix}_{item_id}"] = ans
+                save_draft(shop, mode, item_id, ans)
+            done += len(answers)
+            bar.progress(min(done / len(todo), 1.0), text=f"Черновики: {done} из {len(todo)}")
+    bar.empty()
+
+
+def bulk_send(items, mode, prefix, shop, wb_token):
+    """
+    Отправка черновиков через очередь (send_answer) параллельно.
+    Итог по каждой записи — в её карточке (res_<prefix>_<id>).
+    """
+    todo = [
+        (it, st.session_state.get(f"area_{prefix}_{it['id']}", "").strip())
+        for it in items
+        if not st.session_state.get(f"sent_{prefix}_{it['id']}")
+    ]
+    todo = [(it, text) for it, text in todo if text]
+    if not todo:
+        st.toast("Нечего отправлять: нет черновиков")
+        return
+    bar = st.progress(0.0, text=f"Отправка: 0 из {len(todo)}")
+    ok = 0
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+        futures = {
+            pool.submit(
+                send_answer,
+                shop,
+                wb_token,
+                mode,
+                it["id"],
+                text,
+                it.get("productDetails", {}).get("productName", ""),
+            ): it
+            for it, text in todo
+        }
+        for n, fut in enumerate(as_completed(futures), 1):
+            it = futures[fut]
+            try:
+                res = fut.result()
+            except Exception as e:
+                record_error("ui.bulk_send", e)
+                res = f"Сбой: {e}"
+            st.session_state[f"res_{prefix}_{it['id']}"] = res
+            if res == "OK":
+                ok += 1
+                st.session_state[f"sent_{prefix}_{it['id']}"] = True
+            bar.progress(n / len(todo), text=f"Отправка: {n} из {len(todo)}")
+    bar.empty()
+    st.toast(f"Отправлено: {ok} из {len(todo)}")
+
+
+def send_selected(col, items, mode, prefix, shop, wb_token):
     """
-    if not api_key:
-        return "Нет ключа Groq"
-    client = OpenAI(api_key=api_key, base_url="https://api.groq.com/openai/v1")
-
-    safe_user = user_name if user_name else "Покупатель"
-    greeting = (
-        f"Здравствуйте, {safe_user}!"
-        if len(safe_user) > 2 and safe_user.lower() != "клиент"
-        else "Здравствуйте!"
+    Кнопка массовой отправки: только отмеченные карточки и только после
+    подтверждения с числом ответов — всю страницу разом не отправить.
+    """
+    chosen = selected_items(items, prefix, fallback=False)
+    key = f"confirm_send_{prefix}"
+    if col.button(
+        f"📤 Отправить отмеченные ({len(chosen)})",
+        key=f"send_all_{prefix}",
+        disabled=not chosen,
+    ):
+        st.session_state[key] = [it["id"] for it in chosen]
+    ids = st.session_state.get(key)
+    if not ids:
+        return
+    todo = [it for it in items if it["id"] in ids]
+    ready = sum(
+        1
+        for it in todo
+        if st.session_state.get(f"area_{prefix}_{it['id']}", "").strip()
+        and not st.session_state.get(f"sent_{prefix}_{it['id']}")
     )
-    user_msg = text if text else "Без текста."
+    note = "" if ready == len(todo) else " (у остальных нет черновика)"
+    st.warning(f"Отправить в WB ответы: {ready} из {len(todo)} отмеченных{note}?")
+    yes, no, _ = st.columns([2, 1, 4])
+    if yes.button(f"Да, отправить {ready}", key=f"send_yes_{prefix}", disabled=not ready):
+        del st.session_state[key]
+        bulk_send(todo, mode, prefix, shop, wb_token)
+    elif no.button("Отмена", key=f"send_no_{prefix}"):
+        del st.session_state[key]
+        st.rerun()
 
-    prompt = f"""
-    Ты менеджер Wildberries.
-    ТОВАР: {item_name}
-    СООБЩЕНИЕ: "{user_msg}"
-    ИНСТРУКЦИЯ: "{instructions}"
-    
-    ПРАВИЛА:
-    1. НЕ используй нумерацию.
-    2. Начни с: "{greeting}"
-    3. Разделяй абзацы пустой строкой.
-    4. В конце: "{signature}"
+
+@st.fragment
+def review_card(rev, draft, photo, client_photos, shop, wb_token, groq_key, instructions, signature):
+    """
+    Карточка отзыва. Фрагмент: генерация и отправка перерисовывают
+    только эту карточку, а не всю страницу.
     """
+    sent_key = f"sent_rev_{rev['id']}"
+    prod_name = rev.get("productDetails", {}).get("productName", "Товар")
+    if st.session_state.get(sent_key):
+        st.success(f"Ответ отправлен: {prod_name}")
+        return
+    try:
+        nm_id = rev.get("productDetails", {}).get("nmId", 0)
+        brand = rev.get("productDetails", {}).get("brandName", "")
+        rating = rev.get("productValuation", 5)
+        user = rev.get("userName", "Покупатель")
+
+        pros = rev.get("pros", "")
+        cons = rev.get("cons", "")
+        comment = rev.get("text", "")
+        full_text_ai = review_text(rev)
+
+        with st.container(border=True):
+            cols = st.columns([1, 4])
+
+            with cols[0]:
+                if photo:
+                    st.image(photo, width="stretch")
+                else:
+                    st.write("📦")
+
+            with cols[1]:
+                st.markdown(f"**{prod_name}**")
+                st.caption(f"Арт: {nm_id} | {brand}")
+                st.write(
+                    f"{'⭐' * int(rating)} | **{user}** | {format_date(rev.get('createdDate'))}"
+                )
+                st.markdown("---")
+
+                if pros:
+                    st.markdown(f":green[**Достоинства:**] {pros}")
+                if cons:
+                    st.markdown(f":red[**Недостатки:**] {cons}")
+                if comment:
+                    st.markdown(f"**Комментарий:** {comment}")
+                if not (pros or cons or comment):
+                    st.caption("*(Оценка без текста)*")
+
+                if client_photos:
+                    st.write("**Фото от клиента:**")
+                    p_cols = st.columns(6)
+                    for i, (p_url, p_img) in enumerate(client_photos.items()):
+                        p_cols[i].image(p_img or p_url)
+
+                st.markdown("---")
+
+                area_key = f"area_rev_{rev['id']}"
+                if area_key not in st.session_state:
+                    st.session_state[area_key] = draft
+
+                if st.button("✨ Сгенерировать ответ", key=f"btn_{rev['id']}"):
+                    stream_draft(
+                        AiStream(
+                            groq_key,
+                            full_text_ai,
+                            prod_name,
+                            user,
+                            instructions,
+                            signature,
+                            rating=rating,
+                            nm_id=nm_id,
+                        ),
+                        area_key,
+                        shop,
+                        "feedbacks",
+                        rev["id"],
+                    )
 
+                final_txt = st.text_area(
+                    "Ваш ответ:",
+                    key=area_key,
+                )
+
+                sc1, sc2 = st.columns([1, 4])
+                sc2.checkbox("Выбрать", key=f"sel_rev_{rev['id']}")
+                if sc1.button("Отправить", key=f"snd_{rev['id']}"):
+                    res = send_answer(
+                        shop, wb_token, "feedbacks", rev["id"], final_txt, prod_name
+                    )
+                    st.session_state[f"res_rev_{rev['id']}"] = res
+                    if res == "OK":
+                        st.session_state[sent_key] = True
+                        st.rerun(scope="fragment")
+                res = st.session_state.get(f"res_rev_{rev['id']}")
+                if res == "sending":
+                    res = sending_result(shop, "feedbacks", rev["id"])
+                    st.session_state[f"res_rev_{rev['id']}"] = res
+                    # Воркер уже отправил — карточка свернётся при следующей перерисовке
+                    st.session_state[sent_key] = res == "OK"
+                send_result(res, "отзыв")
+    except Exception as e:
+        record_error("ui.review_card", e)
+
+
+@st.fragment
+def question_card(q, draft, photo, shop, wb_token, groq_key, instructions, signature):
+    """Карточка вопроса (фрагмент, как review_card)."""
+    sent_key = f"sent_q_{q['id']}"
+    prod_name = q.get("productDetails", {}).get("productName", "Товар")
+    if st.session_state.get(sent_key):
+        st.success(f"Ответ на вопрос отправлен: {prod_name}")
+        return
     try:
-        response = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.6,
-            max_tokens=500,
-        )
-        return response.choices[0].message.content
+        nm_id = q.get("productDetails", {}).get("nmId", 0)
+        text = q.get("text", "")
+
+        with st.container(border=True):
+            cols = st.columns([1, 4])
+
+            with cols[0]:
+                if photo:
+                    st.image(photo, width="stretch")
+                else:
+                    st.write("❓")
+
+            with cols[1]:
+                st.markdown(f"**{prod_name}**")
+                st.caption(f"Арт: {nm_id}")
+                st.info(f"❓ {text}")
+                st.caption(format_date(q.get("createdDate")))
+
+                area_q_key = f"area_q_{q['id']}"
+                if area_q_key not in st.session_state:
+                    st.session_state[area_q_key] = draft
+
+                faq = load_faq()
+                hit = None
+                if faq["enabled"] and not st.session_state[area_q_key]:
+                    hit = faq_index.lookup(shop, nm_id, text, faq["threshold"], count=False)
+                if hit:
+                    st.caption(
+                        f"💡 Похожий вопрос уже отвечен ({hit['score']:.0%}): «{hit['question']}»"
+                    )
+                    fc1, fc2 = st.columns([1, 4])
+                    ans = ""
+                    if fc1.button("Взять ответ", key=f"qfaq_{q['id']}"):
+                        ans = reuse_answer(hit, signature)
+                    if fc2.button("✍️ Переписать под вопрос", key=f"qpar_{q['id']}"):
+                        with st.spinner("Переписываю..."):
+                            ans = paraphrase_ai(
+                                groq_key,
+                                core_answer(hit["answer"], signature),
+                                text,
+                                prod_name,
+                                signature,
+                            )
+                        if "Ошибка" in ans:
+                            st.error(ans)
+                            ans = ""
+                    if ans:
+                        # До text_area — поле покажет ответ в этом же проходе
+                        st.session_state[area_q_key] = ans
+                        save_draft(shop, "questions", q["id"], ans)
+
+                if st.button("✨ Ответ", key=f"qbtn_{q['id']}"):
+                    stream_draft(
+                        AiStream(
+                            groq_key,
+                            text,
+                            prod_name,
+                            "Покупатель",
+                            instructions,
+                            signature,
+                            nm_id=nm_id,
+                        ),
+                        area_q_key,
+                        shop,
+                        "questions",
+                        q["id"],
+                    )
+
+                final_q = st.text_area(
+                    "Ваш ответ:",
+                    key=area_q_key,
+                )
+
+                sc1, sc2 = st.columns([1, 4])
+                sc2.checkbox("Выбрать", key=f"sel_q_{q['id']}")
+                if sc1.button("Отправить", key=f"qsnd_{q['id']}"):
+                    res = send_answer(shop, wb_token, "questions", q["id"], final_q, prod_name)
+                    st.session_state[f"res_q_{q['id']}"] = res
+                    if res == "OK":
+                        st.session_state[sent_key] = True
+                        st.rerun(scope="fragment")
+                res = st.session_state.get(f"res_q_{q['id']}")
+                if res == "sending":
+                    res = sending_result(shop, "questions", q["id"])
+                    st.session_state[f"res_q_{q['id']}"] = res
+                    # Воркер уже отправил — карточка свернётся при следующей перерисовке
+                    st.session_state[sent_key] = res == "OK"
+                send_result(res, "вопрос")
     except Exception as e:
-        return f"Ошибка AI: {e}"
+        record_error("ui.question_card", e)
+
 
+def metrics_dashboard(snap):
+    """Сводка снимка wb_metrics: где тратится время и что падает."""
+    if not snap:
+        st.info("Метрик пока нет.")
+        return
 
-def log_event(message, type="info"):
-    timestamp = datetime.datetime.now().strftime("%H:%M")
-    entry = f"{timestamp} | {message}"
-    if "action_log" in st.session_state:
-        st.session_state["action_log"].insert(0, entry)
+    seconds = {
+        (r["labels"]["shop"], r["labels"]["endpoint"]): r
+        for r in snap.get("wb_request_seconds", [])
+    }
+    wb_rows = {}
+    for r in snap.get("wb_requests_total", []):
+        key = (r["labels"]["shop"], r["labels"]["endpoint"])
+        row = wb_rows.setdefault(
+            key, {"магазин": key[0], "запрос": key[1], "всего": 0, "429": 0, "ошибок": 0}
+        )
+        row["всего"] += r["value"]
+        code = r["labels"]["code"]
+        if code == "429":
+            row["429"] += r["value"]
+        elif not code.startswith("2"):
+            row["ошибок"] += r["value"]
+    for key, row in wb_rows.items():
+        h = seconds.get(key)
+        if h and h["count"]:
+            row["среднее, с"] = round(h["sum"] / h["count"], 2)
+            row["p95, с"] = quantile(h, 0.95)
+    waits = {r["labels"]["shop"]: r for r in snap.get("wb_ratelimit_wait_seconds", [])}
+    for (shop, _), row in wb_rows.items():
+        if shop in waits:
+            row["ожидание лимита (магазин), с"] = round(waits[shop]["sum"], 1)
+    if wb_rows:
+        st.caption("Запросы к WB")
+        st.dataframe(list(wb_rows.values()), width="stretch")
+
+    llm = {}
+
+    def llm_row(labels):
+        key = (labels["kind"], labels.get("model", ""))
+        return llm.setdefault(key, {"вид": key[0], "модель": key[1]})
+
+    for r in snap.get("llm_requests_total", []):
+        llm_row(r["labels"])[r["labels"]["status"]] = r["value"]
+    for r in snap.get("llm_tokens_total", []):
+        llm_row(r["labels"])[f"токены: {r['labels']['type']}"] = r["value"]
+    for r in snap.get("llm_request_seconds", []):
+        if r["count"]:
+            row = llm_row(r["labels"])
+            row["среднее, с"] = round(r["sum"] / r["count"], 2)
+            row["p95, с"] = quantile(r, 0.95)
+    if llm:
+        st.caption("Запросы к ИИ")
+        st.dataframe(list(llm.values()), width="stretch")
+        limits = {r["labels"]["model"]: r["value"] for r in snap.get("llm_concurrency_limit", [])}
+        waits = {r["labels"]["model"]: r for r in snap.get("llm_schedule_wait_seconds", [])}
+        st.caption(
+            " | ".join(
+                f"{model}: окно {limits.get(model, '—')}, ожидание p95 "
+                f"{quantile(waits[model], 0.95) if model in waits else '—'} с"
+                for model in sorted(set(limits) | set(waits))
+            )
+        )
+
+    stages = [
+        {
+            "магазин": r["labels"]["shop"],
+            "этап": r["labels"]["stage"],
+            "вызовов": r["count"],
+            "всего, с": round(r["sum"], 1),
+            "p95, с": quantile(r, 0.95),
+        }
+        for r in snap.get("auto_stage_seconds", [])
+    ]
+    if stages:
+        st.caption("Этапы авто-режима")
+        st.dataframe(stages, width="stretch")
+
+    queues = {r["labels"]["shop"]: r["value"] for r in snap.get("auto_queue_depth", [])}
+    cycles = {
+        r["labels"]["shop"]: r for r in snap.get("auto_cycle_seconds", []) if r["count"]
+    }
+    if queues or cycles:
+        st.caption("Очереди и проходы")
+        st.dataframe(
+            [
+                {
+                    "магазин": shop,
+                    "в очереди": queues.get(shop, 0),
+                    "проходов": cycles[shop]["count"] if shop in cycles else 0,
+                    "средний проход, с": round(cycles[shop]["sum"] / cycles[shop]["count"], 1)
+                    if shop in cycles
+                    else None,
+                }
+                for shop in sorted(set(queues) | set(cycles))
+            ],
+            width="stretch",
+        )
+
+    ui_rows = [
+        {
+            "этап": r["labels"]["stage"],
+            "проходов": r["count"],
+            "среднее, мс": round(r["sum"] / r["count"] * 1000),
+            "p95, с": quantile(r, 0.95),
+        }
+        for r in snap.get("ui_run_seconds", [])
+        if r["count"]
+    ]
+    if ui_rows:
+        st.caption("Проходы скрипта UI")
+        st.dataframe(ui_rows, width="stretch")
+
+    errors = [
+        {"где": r["labels"]["where"], "ошибка": r["labels"]["error"], "раз": r["value"]}
+        for r in snap.get("errors_total", [])
+    ]
+    if errors:
+        st.caption("Перехваченные ошибки")
+        st.dataframe(errors, width="stretch")
 
 
 # ==========================================
 # 3. ИНИЦИАЛИЗАЦИЯ
 # ==========================================
 
-if "feedbacks" not in st.session_state:
-    st.session_state["feedbacks"] = []
-if "questions" not in st.session_state:
-    st.session_state["questions"] = []
-if "action_log" not in st.session_state:
-    st.session_state["action_log"] = []
-if "history" not in st.session_state:
-    st.session_state["history"] = []
-
-# Загрузка магазинов из secrets
-if "shops" not in st.session_state:
-    st.session_state["shops"] = {}
+timer = RunTimer(RUN_STARTED)
+timer.mark("import")
+boot_info = boot()
+if boot_info["imports"] is None:
+    boot_info["imports"] = timer.stages[0][1]
+
+# Настройки воркера общие для всех вкладок: магазины и промпты берутся
+# из базы, а из secrets — только пока там ничего не сохранено
+saved_config = get_setting("worker.config") or {}
+st.session_state["shops"] = dict(saved_config.get("shops") or {})
+if not st.session_state["shops"]:
     if hasattr(st, "secrets") and "shops" in st.secrets:
         for name, token in st.secrets["shops"].items():
             st.session_state["shops"][name] = token
     elif hasattr(st, "secrets") and "WB_API_TOKEN" in st.secrets:
         st.session_state["shops"]["Основной"] = st.secrets["WB_API_TOKEN"]
 
-default_groq = ""
-if hasattr(st, "secrets"):
+default_groq = saved_config.get("groq_key", "")
+if not default_groq and hasattr(st, "secrets"):
     default_groq = st.secrets.get("GROQ_API_KEY", "")
+saved_prompts = {**saved_config.get("instructions", {}), **saved_config.get("prompts", {})}
+
+register_shops(st.session_state["shops"])
+timer.mark("init")
 
 # ==========================================
 # 4. САЙДБАР
@@ -273,7 +782,7 @@ with st.sidebar:
         new_tk = st.text_input("Токен", type="password")
         if st.button("Сохранить"):
             if new_sh and new_tk:
-                st.session_state["shops"][new_sh] = new_tk
+                save_worker_config(shops={**st.session_state["shops"], new_sh: new_tk})
                 st.rerun()
     else:
         selected_shop = st.selectbox(
@@ -286,11 +795,13 @@ with st.sidebar:
             add_t = st.text_input("Токен магазина", type="password")
             if st.button("ОК"):
                 if add_n and add_t:
-                    st.session_state["shops"][add_n] = add_t
+                    save_worker_config(shops={**st.session_state["shops"], add_n: add_t})
                     st.rerun()
 
         if st.button("Удалить текущий магазин"):
-            del st.session_state["shops"][selected_shop]
+            shops = dict(st.session_state["shops"])
+            del shops[selected_shop]
+            save_worker_config(shops=shops)
             st.rerun()
 
     st.divider()
@@ -299,29 +810,167 @@ with st.sidebar:
     with st.expander("Настройки ИИ"):
         prompt_rev = st.text_area(
             "Инструкция для ответов на отзывы:",
-            value="Благодари за покупку.",
+            value=saved_prompts.get("feedbacks", "Благодари за покупку."),
             height=70,
         )
         prompt_quest = st.text_area(
             "Инструкция для ответов на вопросы:",
-            value="Отвечай коротко.",
+            value=saved_prompts.get("questions", "Отвечай коротко."),
             height=70,
         )
         signature = st.text_input(
             "Подпись в конце ответа:",
-            value="С уважением, представитель бренда",
+            value=saved_config.get("signature", "С уважением, представитель бренда"),
+        )
+
+    with st.expander("Настройки загрузки"):
+        max_items = st.number_input(
+            "Максимум записей за скан:",
+            min_value=50,
+            max_value=20000,
+            value=int(saved_config.get("limit", MAX_ITEMS)),
+            step=50,
+        )
+        full_sync = st.checkbox(
+            "Полная сверка с WB",
+            help="Загрузить весь список заново и закрыть то, на что ответили в кабинете WB",
         )
+        page_size = st.number_input(
+            "Карточек на странице:", min_value=5, max_value=100, value=20, step=5
+        )
+        if st.button("Перечитать таблицу корзин фото"):
+            st.toast(f"Диапазонов корзин: {load_basket_table()}")
 
     st.divider()
+    saved_modes = saved_config.get("instructions", {})
     col1, col2 = st.columns(2)
-    auto_reviews = col1.toggle("Авто-ответы на отзывы")
-    auto_questions = col2.toggle("Авто-ответы на вопросы")
+    auto_reviews = col1.toggle("Авто-ответы на отзывы", value="feedbacks" in saved_modes)
+    auto_questions = col2.toggle(
+        "Авто-ответы на вопросы", value="questions" in saved_modes
+    )
+    # Воркеру уходят только явно применённые настройки: иначе любая
+    # открытая вкладка затирала бы их своими значениями по умолчанию
+    auto_instructions = {}
+    if auto_reviews:
+        auto_instructions["feedbacks"] = prompt_rev
+    if auto_questions:
+        auto_instructions["questions"] = prompt_quest
+    worker_changes = {
+        "groq_key": groq_key,
+        "instructions": auto_instructions,
+        "prompts": {"feedbacks": prompt_rev, "questions": prompt_quest},
+        "signature": signature,
+        "limit": int(max_items),
+    }
+    pending = any(saved_config.get(k) != v for k, v in worker_changes.items())
+    if st.button(
+        "Применить для воркера",
+        type="primary" if pending else "secondary",
+        disabled=not pending,
+        help="Ключ, инструкции, подпись и включённые режимы — для всех вкладок и воркеров",
+    ):
+        save_worker_config(shops=dict(st.session_state["shops"]), **worker_changes)
+        st.rerun()
+    worker_panel()
+
+    with st.expander("Кэш ответов ИИ"):
+        cache_stats = answer_cache.stats()
+        st.caption(
+            f"Попаданий: {cache_stats['hits']} | Промахов: {cache_stats['misses']} "
+            f"({cache_stats['hit_rate']:.0%})"
+        )
+        st.caption(
+            f"Сэкономлено: {cache_stats['saved_seconds']:.0f} сек Groq, "
+            f"{cache_stats['saved_tokens']} токенов"
+        )
+        if st.button("Очистить кэш ответов"):
+            answer_cache.clear()
+            st.rerun()
+
+    with st.expander("Очередь отправки"):
+        ob = outbox_counts()
+        st.caption(
+            f"Ждут: {ob.get('pending', 0) + ob.get('sending', 0)} | "
+            f"отправлено: {ob.get('sent', 0)} | подтверждено: {ob.get('confirmed', 0)} | "
+            f"ошибок: {ob.get('failed', 0)}"
+        )
+        oc1, oc2 = st.columns(2)
+        if oc1.button("Отправить сейчас", disabled=not st.session_state["shops"]):
+            sent = drain(st.session_state["shops"])
+            st.toast(f"Отправлено: {sum(res == 'OK' for _, res in sent)} из {len(sent)}")
+        if oc2.button("Повторить ошибки", disabled=not ob.get("failed")):
+            st.toast(f"Снова в очереди: {retry_failed()}")
+            st.rerun()
+
+    with st.expander("Похожие вопросы (FAQ)"):
+        faq_stats = faq_index.stats()
+        st.caption(
+            f"Ответов из FAQ: {rule_stats.stats()['faq']} | "
+            f"найдено похожих: {faq_stats['hits']} из {faq_stats['hits'] + faq_stats['misses']} "
+            f"| артикулов в индексе: {faq_stats['articles']}"
+        )
+        saved_faq = load_faq()
+        faq_enabled = st.checkbox(
+            "Подсказывать ответ на повторные вопросы",
+            value=saved_faq["enabled"],
+            help="Ответ на похожий вопрос по тому же артикулу — в карточке и черновиках",
+        )
+        faq_auto = st.checkbox(
+            "Отвечать из FAQ в авто-режиме",
+            value=saved_faq["auto"],
+            disabled=not faq_enabled,
+            help="Ответ уйдёт покупателю без проверки",
+        )
+        faq_threshold = st.slider(
+            "Порог похожести", 0.5, 1.0, float(saved_faq["threshold"]), 0.05
+        )
+        faq_paraphrase = st.checkbox(
+            "Переписывать ответ под вопрос (малая модель)", value=saved_faq["paraphrase"]
+        )
+        faq_new = {
+            "enabled": faq_enabled,
+            "auto": faq_auto,
+            "threshold": faq_threshold,
+            "paraphrase": faq_paraphrase,
+        }
+        if faq_new != saved_faq:
+            set_setting("faq", faq_new)
+        if st.button("Перестроить индекс"):
+            faq_index.clear()
+            st.toast("Индекс соберётся заново при следующем вопросе")
+
+    with st.expander("Шаблонные ответы"):
+        r_stats = rule_stats.stats()
+        st.caption(
+            f"Шаблоном: {r_stats['template']} | через ИИ: {r_stats['llm']} "
+            f"({r_stats['template_rate']:.0%} без ИИ)"
+        )
+        rules_text = st.text_area(
+            "Правила (JSON):",
+            value=json.dumps(load_rules(), ensure_ascii=False, indent=2),
+            height=200,
+            help="Описание полей — в wb_rules.py",
+        )
+        rc1, rc2 = st.columns(2)
+        if rc1.button("Сохранить правила"):
+            try:
+                rules = json.loads(rules_text)
+                check_rules(rules)
+                set_setting("rules", rules)
+                st.toast(f"Правил: {len(rules)}")
+            except ValueError as e:
+                st.error(f"Ошибка в правилах: {e}")
+        if rc2.button("По умолчанию"):
+            set_setting("rules", DEFAULT_RULES)
+            st.rerun()
 
     st.markdown("---")
     if st.button("Сброс кэша"):
         st.session_state.clear()
         st.rerun()
 
+timer.mark("sidebar")
+
 if not current_wb_token or not groq_key:
     st.info("Нужны ключи WB и Groq в sidebar.")
     st.stop()
@@ -332,274 +981,344 @@ if not current_wb_token or not groq_key:
 
 st.title(f"🛍️ {st.session_state.shop_select}")
 
-if st.button("🔄 Сканировать магазин", type="primary", use_container_width=True):
+if st.button("🔄 Сканировать магазин", type="primary", width="stretch"):
     with st.spinner("Загрузка отзывов и вопросов..."):
-        st.session_state["feedbacks"] = get_wb_data(current_wb_token, "feedbacks")
-        st.session_state["questions"] = get_wb_data(current_wb_token, "questions")
-        log_event(f"Обновление: {selected_shop}")
+        # Из WB берём только новое, остальные страницы догружаются в фоне
+        loaders = {
+            mode: WbLoader(
+                iter_sync(
+                    selected_shop,
+                    current_wb_token,
+                    mode,
+                    limit=max_items,
+                    full=True if full_sync else None,
+                )
+            )
+            for mode in ("feedbacks", "questions")
+        }
+        for loader in loaders.values():
+            loader.wait_first()
+        st.session_state["loaders"] = loaders
+        log_event(
+            f"Обновление: {selected_shop}", source="ui", action="scan", shop=selected_shop
+        )
+
+for loader in st.session_state.get("loaders", {}).values():
+    if loader.error is not None:
+        if loader.error.status == "throttled":
+            st.warning("WB ограничил частоту запросов, загружено не всё.")
+        else:
+            st.error(loader.error.error)
+loading = [
+    loader for loader in st.session_state.get("loaders", {}).values() if not loader.done
+]
+if loading:
+    lc1, lc2 = st.columns([4, 1])
+    lc1.caption("⏳ Загрузка остальных страниц продолжается...")
+    if lc2.button("Обновить", width="stretch"):
+        st.rerun()
+
+# Записи читаются из базы постранично в открытой вкладке, здесь — только счётчики
+count_rev = min(count_items(selected_shop, "feedbacks"), max_items)
+count_quest = min(count_items(selected_shop, "questions"), max_items)
 
 c1, c2, c3 = st.columns(3)
-count_rev = len(st.session_state.get("feedbacks", []))
-count_quest = len(st.session_state.get("questions", []))
 c1.metric("Новых отзывов", count_rev)
 c2.metric("Новых вопросов", count_quest)
-c3.metric("Записей в журнале", len(st.session_state["action_log"]))
+c3.metric("Записей в журнале", count_events())
 
 st.write("")
-
-tab_rev, tab_quest, tab_log, tab_arch = st.tabs(
-    [
-        f"⭐ Отзывы ({count_rev})",
-        f"❓ Вопросы ({count_quest})",
-        "📜 Журнал",
-        "🗄️ Архив",
-    ]
+timer.mark("scan")
+
+# Выполняется только открытая вкладка (on_change="rerun"). Названия без
+# счётчиков: по названию Streamlit помнит, какая вкладка открыта
+tab_rev, tab_quest, tab_log, tab_arch, tab_metrics = st.tabs(
+    ["⭐ Отзывы", "❓ Вопросы", "📜 Журнал", "🗄️ Архив", "📈 Метрики"],
+    key="main_tab",
+    on_change="rerun",
 )
 
 # --- ОТЗЫВЫ ---
 with tab_rev:
-    reviews = st.session_state.get("feedbacks", [])
-    if not reviews:
-        st.info("Нет новых отзывов.")
-    else:
-        for rev in reviews:
-            try:
-                prod_name = rev.get("productDetails", {}).get("productName", "Товар")
-                nm_id = rev.get("productDetails", {}).get("nmId", 0)
-                brand = rev.get("productDetails", {}).get("brandName", "")
-                rating = rev.get("productValuation", 5)
-                user = rev.get("userName", "Покупатель")
-
-                pros = rev.get("pros", "")
-                cons = rev.get("cons", "")
-                comment = rev.get("text", "")
-                full_text_ai = f"Плюсы: {pros}. Минусы: {cons}. Текст: {comment}"
-                if not (pros or cons or comment):
-                    full_text_ai = ""
-
-                with st.container(border=True):
-                    cols = st.columns([1, 4])
-
-                    with cols[0]:
-                        main_photo = get_main_photo_url(nm_id)
-                        if main_photo:
-                            st.image(main_photo, use_container_width=True)
-                        else:
-                            st.write("📦")
-
-                    with cols[1]:
-                        st.markdown(f"**{prod_name}**")
-                        st.caption(f"Арт: {nm_id} | {brand}")
-                        st.write(
-                            f"{'⭐' * int(rating)} | **{user}** | {format_date(rev.get('createdDate'))}"
-                        )
-                        st.markdown("---")
-
-                        if pros:
-                            st.markdown(f":green[**Достоинства:**] {pros}")
-                        if cons:
-                            st.markdown(f":red[**Недостатки:**] {cons}")
-                        if comment:
-                            st.markdown(f"**Комментарий:** {comment}")
-                        if not (pros or cons or comment):
-                            st.caption("*(Оценка без текста)*")
-
-                        if rev.get("photoLinks"):
-                            st.write("**Фото от клиента:**")
-                            p_cols = st.columns(6)
-                            for i, p in enumerate(rev["photoLinks"][:6]):
-                                p_url = p.get("smallSize") or p.get("fullSize")
-                                if p_url:
-                                    p_cols[i].image(p_url)
-
-                        st.markdown("---")
-
-                        area_key = f"area_rev_{rev['id']}"
-                        if area_key not in st.session_state:
-                            st.session_state[area_key] = ""
-
-                        if st.button("✨ Сгенерировать ответ", key=f"btn_{rev['id']}"):
-                            with st.spinner("Пишу ответ..."):
-                                ans = generate_ai(
-                                    groq_key,
-                                    full_text_ai,
-                                    prod_name,
-                                    user,
-                                    prompt_rev,
-                                    signature,
-                                )
-                                st.session_state[area_key] = ans
-
-                        final_txt = st.text_area(
-                            "Ваш ответ:",
-                            key=area_key,
-                        )
-
-                        if st.button("Отправить", key=f"snd_{rev['id']}"):
-                            res = send_wb_smart(
-                                rev["id"], final_txt, current_wb_token, "feedbacks"
-                            )
-                            if res == "OK":
-                                st.success("Ответ отправлен!")
-                                st.session_state["feedbacks"].remove(rev)
-                                time.sleep(0.5)
-                                st.rerun()
-                            else:
-                                st.error(res)
-            except Exception:
-                pass
+    if tab_rev.open:
+        if not count_rev:
+            st.info("Нет новых отзывов.")
+        else:
+            # Из базы — только текущая и следующая (для prefetch) страницы
+            page_idx, _ = paginate(range(count_rev), "page_rev", page_size)
+            rows = list_items(
+                selected_shop, "feedbacks", limit=2 * len(page_idx), offset=min(page_idx)
+            )
+            page_revs, next_revs = rows[: len(page_idx)], rows[len(page_idx) :]
+            drafts = get_drafts(selected_shop, "feedbacks")
+            photos = get_photo_urls(
+                rev.get("productDetails", {}).get("nmId", 0)
+                for rev in page_revs + next_revs
+            )
+            card_imgs = get_images(
+                photos[rev.get("productDetails", {}).get("nmId", 0)] for rev in page_revs
+            )
+            client_imgs = get_images(
+                [url for rev in page_revs for url in item_photo_urls(rev)], PHOTO_SIZE
+            )
+            # Следующая страница — в фоне, чтобы листание было мгновенным
+            prefetch_images(
+                photos[rev.get("productDetails", {}).get("nmId", 0)] for rev in next_revs
+            )
+            prefetch_images(
+                [url for rev in next_revs for url in item_photo_urls(rev)], PHOTO_SIZE
+            )
+
+            bc1, bc2, bc3 = st.columns([2, 2, 3])
+            bc3.caption("Черновики — для отмеченных карточек или всей страницы, отправка — только отмеченных")
+            if bc1.button("✨ Сгенерировать черновики", key="gen_all_rev"):
+                bulk_generate(
+                    selected_items(page_revs, "rev"),
+                    "feedbacks",
+                    "rev",
+                    selected_shop,
+                    groq_key,
+                    prompt_rev,
+                    signature,
+                )
+            send_selected(bc2, page_revs, "feedbacks", "rev", selected_shop, current_wb_token)
+
+            for rev in page_revs:
+                main_photo = photos.get(rev.get("productDetails", {}).get("nmId", 0))
+                review_card(
+                    rev,
+                    drafts.get(str(rev["id"]), ""),
+                    card_imgs.get(main_photo) or main_photo,
+                    {url: client_imgs.get(url) for url in item_photo_urls(rev)},
+                    selected_shop,
+                    current_wb_token,
+                    groq_key,
+                    prompt_rev,
+                    signature,
+                )
+        timer.mark("tab_reviews")
 
 # --- ВОПРОСЫ ---
 with tab_quest:
-    quests = st.session_state.get("questions", [])
-    if not quests:
-        st.info("Нет новых вопросов.")
-    else:
-        for q in quests:
-            try:
-                prod_name = q.get("productDetails", {}).get("productName", "Товар")
-                nm_id = q.get("productDetails", {}).get("nmId", 0)
-                text = q.get("text", "")
-
-                with st.container(border=True):
-                    cols = st.columns([1, 4])
-
-                    with cols[0]:
-                        main_photo = get_main_photo_url(nm_id)
-                        if main_photo:
-                            st.image(main_photo, use_container_width=True)
-                        else:
-                            st.write("❓")
-
-                    with cols[1]:
-                        st.markdown(f"**{prod_name}**")
-                        st.caption(f"Арт: {nm_id}")
-                        st.info(f"❓ {text}")
-                        st.caption(format_date(q.get("createdDate")))
-
-                        area_q_key = f"area_q_{q['id']}"
-                        if area_q_key not in st.session_state:
-                            st.session_state[area_q_key] = ""
-
-                        if st.button("✨ Ответ", key=f"qbtn_{q['id']}"):
-                            with st.spinner("Пишу ответ..."):
-                                ans = generate_ai(
-                                    groq_key,
-                                    text,
-                                    prod_name,
-                                    "Покупатель",
-                                    prompt_quest,
-                                    signature,
-                                )
-                                st.session_state[area_q_key] = ans
-
-                        final_q = st.text_area(
-                            "Ваш ответ:",
-                            key=area_q_key,
-                        )
-
-                        if st.button("Отправить", key=f"qsnd_{q['id']}"):
-                            res = send_wb_smart(
-                                q["id"], final_q, current_wb_token, "questions"
-                            )
-                            if res == "OK":
-                                st.success("Ответ на вопрос отправлен!")
-                                st.session_state["questions"].remove(q)
-                                time.sleep(0.5)
-                                st.rerun()
-                            else:
-                                st.error(res)
-            except Exception:
-                pass
-
-# --- ЛОГИ ---
-with tab_log:
-    if not st.session_state["action_log"]:
-        st.info("Журнал пуст.")
-    else:
-        for log in st.session_state["action_log"]:
-            st.write(log)
-
-# --- АРХИВ ---
-with tab_arch:
-    if st.button("📥 Загрузить историю отзывов"):
-        with st.spinner("Загружаю архив..."):
-            st.session_state["history"] = get_wb_archive(
-                current_wb_token, take=50, skip=0
+    if tab_quest.open:
+        if not count_quest:
+            st.info("Нет новых вопросов.")
+        else:
+            page_idx, _ = paginate(range(count_quest), "page_q", page_size)
+            rows = list_items(
+                selected_shop, "questions", limit=2 * len(page_idx), offset=min(page_idx)
+            )
+            page_qs, next_qs = rows[: len(page_idx)], rows[len(page_idx) :]
+            drafts = get_drafts(selected_shop, "questions")
+            photos = get_photo_urls(
+                q.get("productDetails", {}).get("nmId", 0) for q in page_qs + next_qs
+            )
+            card_imgs = get_images(
+                photos[q.get("productDetails", {}).get("nmId", 0)] for q in page_qs
+            )
+            prefetch_images(
+                photos[q.get("productDetails", {}).get("nmId", 0)] for q in next_qs
             )
 
-    if not st.session_state.get("history"):
-        st.info("Архив ещё не загружен.")
-    else:
-        for item in st.session_state.get("history", []):
-            try:
-                name = item.get("productDetails", {}).get("productName", "Товар")
-                txt = item.get("text", "")
-                created = format_date(item.get("createdDate"))
-                header = f"{name} ({created})"
-                with st.expander(header):
-                    st.write(txt if txt else "Без текста")
-                    if item.get("answer") and item["answer"].get("text"):
-                        st.info(item["answer"]["text"])
-            except Exception:
-                pass
-
-# --- АВТО-РЕЖИМ ---
-if (auto_reviews or auto_questions) and st.session_state["shops"]:
-    st.toast(f"⚡ Авто-режим активен для: {selected_shop}")
-
-    for sh_name, sh_token in st.session_state["shops"].items():
-        # Авто-ответы на отзывы
-        if auto_reviews:
-            items = get_wb_data(sh_token, "feedbacks")
-            for item in items:
-                prod = item.get("productDetails", {}).get("productName", "")
-                pros = item.get("pros", "")
-                cons = item.get("cons", "")
-                comm = item.get("text", "")
-                full = f"Плюсы: {pros}. Минусы: {cons}. Текст: {comm}"
-                if not full.strip():
-                    full = "Оценка без текста"
-
-                ans = generate_ai(
+            bc1, bc2, bc3 = st.columns([2, 2, 3])
+            bc3.caption("Черновики — для отмеченных карточек или всей страницы, отправка — только отмеченных")
+            if bc1.button("✨ Сгенерировать черновики", key="gen_all_q"):
+                bulk_generate(
+                    selected_items(page_qs, "q"),
+                    "questions",
+                    "q",
+                    selected_shop,
                     groq_key,
-                    full,
-                    prod,
-                    item.get("userName", ""),
-                    prompt_rev,
+                    prompt_quest,
                     signature,
                 )
-                if "Ошибка" not in ans:
-                    send_res = send_wb_smart(
-                        item["id"], ans, sh_token, "feedbacks"
-                    )
-                    if send_res == "OK":
-                        log_event(f"[{sh_name}] Отзыв: {prod}", "success")
-                        time.sleep(2)
-
-        # Авто-ответы на вопросы
-        if auto_questions:
-            quests = get_wb_data(sh_token, "questions")
-            for q in quests:
-                prod = q.get("productDetails", {}).get("productName", "")
-                ans = generate_ai(
+            send_selected(bc2, page_qs, "questions", "q", selected_shop, current_wb_token)
+
+            for q in page_qs:
+                main_photo = photos.get(q.get("productDetails", {}).get("nmId", 0))
+                question_card(
+                    q,
+                    drafts.get(str(q["id"]), ""),
+                    card_imgs.get(main_photo) or main_photo,
+                    selected_shop,
+                    current_wb_token,
                     groq_key,
-                    q.get("text", ""),
-                    prod,
-                    "Покупатель",
                     prompt_quest,
                     signature,
                 )
-                if "Ошибка" not in ans:
-                    send_res = send_wb_smart(
-                        q["id"], ans, sh_token, "questions"
-                    )
-                    if send_res == "OK":
-                        log_event(f"[{sh_name}] Вопрос: {prod}", "success")
-                        time.sleep(2)
+        timer.mark("tab_questions")
 
-        time.sleep(1)
+# --- ЛОГИ ---
+with tab_log:
+    if tab_log.open:
+        lc1, lc2, lc3, lc4 = st.columns(4)
+        log_shop = lc1.selectbox("Магазин", ["Все"] + shop_list, key="log_shop")
+        log_mode = lc2.selectbox(
+            "Тип",
+            ["Все", "feedbacks", "questions"],
+            key="log_mode",
+            format_func=lambda m: {"feedbacks": "Отзывы", "questions": "Вопросы"}.get(m, m),
+        )
+        log_result = lc3.selectbox("Результат", ["Все", "Успешно", "Ошибки"], key="log_result")
+        log_search = lc4.text_input("Поиск", key="log_search")
+        filters = {
+            "shop": None if log_shop == "Все" else log_shop,
+            "mode": None if log_mode == "Все" else log_mode,
+            "ok": {"Успешно": True, "Ошибки": False}.get(log_result),
+            "search": log_search.strip() or None,
+        }
+        total_events = count_events(**filters)
+        if not total_events:
+            st.info("Журнал пуст.")
+        else:
+            # Страница читается из базы, в памяти — только она
+            page_idx, _ = paginate(range(total_events), "page_log", 100)
+            events = list_events(**filters, limit=len(page_idx), offset=min(page_idx))
+            for ev in events:
+                ev["ts"] = datetime.datetime.fromtimestamp(ev["ts"]).strftime("%d.%m %H:%M:%S")
+                ev["ok"] = "✅" if ev["ok"] else "❌"
+            st.dataframe(
+                events,
+                width="stretch",
+                hide_index=True,
+                column_config={
+                    "ts": "Время",
+                    "source": "Источник",
+                    "action": "Действие",
+                    "shop": "Магазин",
+                    "mode": "Тип",
+                    "item_id": "ID",
+                    "ok": "",
+                    "result": "Результат",
+                    "latency": st.column_config.NumberColumn("Сек", format="%.2f"),
+                    "message": "Товар / сообщение",
+                },
+            )
+        timer.mark("tab_log")
 
-    # Пауза, потом перезапуск приложения
-    time.sleep(600)
-    st.rerun()
+# --- АРХИВ ---
+with tab_arch:
+    if tab_arch.open:
+        export = st.session_state.get("archive_export")
+        if export is not None and export.shop != selected_shop:
+            export = None
+
+        ac1, ac2 = st.columns([3, 2])
+        per_nm = ac2.checkbox(
+            "По каждому артикулу",
+            help="Для очень больших архивов: WB ограничивает глубину листания",
+        )
+        running = export is not None and not export.done
+        if ac1.button("📥 Выгрузить архив отзывов", disabled=running):
+            st.session_state["archive_export"] = export = ArchiveExport(
+                selected_shop,
+                current_wb_token,
+                nm_ids=list_nm_ids(selected_shop) if per_nm else None,
+            )
+            running = True
+
+        if running:
+            xc1, xc2 = st.columns([4, 1])
+            xc1.caption(f"⏳ Выгрузка: {export.rows} отзывов...")
+            if xc2.button("Обновить", key="arch_refresh"):
+                st.rerun()
+            if st.button("⏹ Прервать выгрузку"):
+                export.stop_event.set()
+        elif export is not None and export.error:
+            st.error(f"Выгрузка прервана: {export.error}. Повторный запуск продолжит с места остановки.")
+
+        total = archive_count(selected_shop)
+        if not total:
+            st.info("Архив ещё не загружен.")
+        else:
+            # pandas нужен только аналитике архива — импорт при первом показе
+            from wb_analytics import (
+                latency_summary,
+                negative_rate,
+                rating_table,
+                top_terms,
+                update_analytics,
+            )
+
+            # Агрегаты досчитываются только по новым частям выгрузки
+            agg = update_analytics(selected_shop)
+            lat = latency_summary(agg)
+            ratings = rating_table(agg)
+            neg = negative_rate(agg)
+            sc1, sc2, sc3, sc4 = st.columns(4)
+            sc1.metric("Отзывов в архиве", agg["rows"])
+            if not neg.empty and neg["total"].sum():
+                sc2.metric("Доля негатива", f"{neg['negative'].sum() / neg['total'].sum():.0%}")
+            if lat["count"]:
+                sc3.metric("Ответ в среднем", f"{lat['mean']:.1f} ч")
+                sc4.metric("90% ответов быстрее", f"{lat['p90']:g} ч")
+            with st.expander("📊 Аналитика архива"):
+                if not neg.empty:
+                    st.caption("Доля негатива (1–3 ★) по неделям")
+                    st.line_chart(neg["rate"])
+                if not ratings.empty:
+                    st.caption("Оценки по артикулам")
+                    st.dataframe(ratings, width="stretch")
+                terms = top_terms(agg)
+                if not terms.empty:
+                    st.caption("Частые слова в недостатках")
+                    st.bar_chart(terms)
+
+            # Новые сверху: в файлах порядок от старых к новым
+            page_idx, _ = paginate(range(total - 1, -1, -1), "page_arch", page_size)
+            rows = read_archive(selected_shop, min(page_idx), len(page_idx))
+            for item in reversed(rows):
+                try:
+                    name = item.get("product") or "Товар"
+                    txt = item.get("text", "")
+                    created = format_date(item.get("created_at"))
+                    header = f"{name} ({created})"
+                    with st.expander(header):
+                        st.write(txt if txt else "Без текста")
+                        if item.get("answer"):
+                            st.info(item["answer"])
+                except Exception as e:
+                    record_error("ui.archive", e)
+        timer.mark("tab_archive")
+
+# --- МЕТРИКИ ---
+with tab_metrics:
+    if tab_metrics.open:
+        workers = list_workers()
+        sources = [f"Воркер {w['host']}:{w['pid']}" for w in workers] + ["Этот процесс"]
+        source = st.radio("Источник", sources, horizontal=True)
+        if source != "Этот процесс":
+            worker = workers[sources.index(source)]
+            cycles = []
+            for name, last in worker["status"].get("shops", {}).items():
+                row = {"магазин": name, "проход, с": last.get("seconds")}
+                row.update({f"{k}, с": v for k, v in last.get("stages", {}).items()})
+                row["шт/мин"] = last.get("per_minute")
+                cycles.append(row)
+            if cycles:
+                st.caption("Последний проход по магазинам")
+                st.dataframe(cycles, width="stretch")
+            metrics_dashboard(worker["metrics"])
+        else:
+            metrics_dashboard(snapshot())
+        st.caption(
+            f"Prometheus: http://127.0.0.1:{METRICS_PORT}/metrics (воркер), "
+            f"http://127.0.0.1:{METRICS_PORT + 1}/metrics (UI)"
+        )
+        timer.mark("tab_metrics")
+
+# --- СКОРОСТЬ ---
+run_total = timer.finish()
+if boot_info["first_run"] is None:
+    boot_info["first_run"] = run_total
+with st.sidebar:
+    with st.expander("⏱ Скорость интерфейса"):
+        st.caption(
+            f"Холодный старт: {boot_info['first_run']:.2f} с "
+            f"(импорт модулей {boot_info['imports']:.2f} с)"
+        )
+        st.caption(
+            f"Этот проход: {run_total:.2f} с — "
+            + ", ".join(f"{name} {sec * 1000:.0f} мс" for name, sec in timer.stages)
+        )
+        st.caption("По всем проходам — вкладка «Метрики»")
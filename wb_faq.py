@@ -0,0 +1,241 @@
+"""
+Повторное использование ответов на похожие вопросы (FAQ по артикулу).
+
+По каждому артикулу (nmId) из уже отправленных ответов на вопросы
+строится локальный индекс: слова и символьные триграммы хешируются в
+вектор фиксированной длины, взвешиваются TF-IDF по вопросам артикула,
+похожесть — косинус (numpy, без внешних сервисов). Если новый вопрос
+похож на отвеченный не меньше порога, его ответ предлагается сразу —
+как есть или переписанным малой моделью (paraphrase_ai).
+
+Вопросы с разными числами («рост 170» и «рост 180») повтором не
+считаются, как бы ни были похожи остальные слова.
+
+Индекс строится при первом обращении к артикулу и перестраивается,
+когда в базе появились новые ответы (проверка не чаще FAQ_REFRESH).
+Настройки — в локальной базе (wb_store, ключ "faq"), общие для UI и
+воркера: {"enabled", "auto", "threshold", "paraphrase"}. enabled —
+подсказка в карточке вопроса и черновики, auto — ответ из FAQ в
+авто-режиме без проверки человеком (по умолчанию выключен).
+"""
+import math
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from wb_ai import finish_answer, make_greeting, paraphrase_ai
+from wb_metrics import FAQ
+from wb_store import faq_entries, faq_version, get_setting
+
+DIM = 1 << 18  # длина хешированного вектора
+FAQ_THRESHOLD = 0.8  # косинус: не меньше — вопрос считаем повтором
+FAQ_REFRESH = 60  # сек между проверками базы на новые ответы
+FAQ_MAX = 500  # последних отвеченных вопросов на артикул
+FAQ_ARTICLES = 2000  # артикулов в памяти
+
+DEFAULT_FAQ = {"enabled": True, "auto": False, "threshold": FAQ_THRESHOLD, "paraphrase": False}
+
+STOP_WORDS = {
+    "а", "в", "и", "к", "на", "по", "с", "у", "о", "от", "до", "за", "из",
+    "не", "же", "ну", "то", "это", "как", "что", "для", "или", "при",
+    "какой", "какая", "какое", "какие", "есть", "будет", "можно", "ли",
+    "здравствуйте", "добрый", "день", "спасибо", "пожалуйста", "подскажите",
+}
+
+
+def load_faq():
+    """Настройки FAQ из базы поверх DEFAULT_FAQ."""
+    return {**DEFAULT_FAQ, **(get_setting("faq") or {})}
+
+
+def numbers(text):
+    """Числа вопроса: у повтора они должны совпадать все."""
+    return frozenset(re.findall(r"\d+", text or ""))
+
+
+def features(text):
+    """
+    {номер признака: вес} для текста. Слова обрезаются до 6 букв (грубая
+    замена стемминга: «размер», «размеры», «размера» совпадут), триграммы
+    ловят опечатки и другие формы слова. Числа — одним признаком целиком,
+    без триграмм; разные числа отсекает ArticleIndex.search.
+    """
+    counts = {}
+    for word in re.findall(r"[a-zа-яё0-9]+", (text or "").lower().replace("ё", "е")):
+        if word in STOP_WORDS:
+            continue
+        grams = [f"w:{word[:6]}"]
+        if not word.isdigit():
+            padded = f" {word} "
+            grams += [f"c:{padded[i : i + 3]}" for i in range(len(padded) - 2)]
+        for gram in grams:
+            idx = zlib.crc32(gram.encode("utf-8")) % DIM
+            counts[idx] = counts.get(idx, 0) + 1
+    return counts
+
+
+def core_answer(text, signature=""):
+    """Ответ без приветствия и подписи — их подставим заново."""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text.strip()) if p.strip()]
+    if paragraphs and paragraphs[0].lower().startswith("здравствуйте"):
+        paragraphs = paragraphs[1:]
+    if paragraphs and signature and paragraphs[-1] == signature.strip():
+        paragraphs = paragraphs[:-1]
+    return "\n\n".join(paragraphs)
+
+
+class ArticleIndex:
+    """
+    TF-IDF индекс вопросов одного артикула. Векторы документов лежат
+    подряд в плоских массивах (номера признаков, веса, начала строк),
+    поиск — одна свёртка с плотным вектором запроса.
+    """
+
+    def __init__(self, entries):
+        docs = [(e, features(e["question"])) for e in entries]
+        docs = [(e, f) for e, f in docs if f]
+        self.entries = [e for e, _ in docs]
+        self.numbers = [numbers(e["question"]) for e in self.entries]
+        df = {}
+        for _, f in docs:
+            for idx in f:
+                df[idx] = df.get(idx, 0) + 1
+        self.n = len(docs)
+        self.idf = {idx: math.log((1 + self.n) / (1 + c)) + 1 for idx, c in df.items()}
+        cols, weights, starts = [], [], []
+        for _, f in docs:
+            starts.append(len(cols))
+            vec = self._weigh(f)
+            cols += vec.keys()
+            weights += vec.values()
+        self.cols = np.array(cols, dtype=np.int64)
+        self.weights = np.array(weights, dtype=np.float32)
+        self.starts = np.array(starts, dtype=np.int64)
+
+    def _weigh(self, counts):
+        # Неизвестный артикулу признак весит как самый редкий
+        rare = math.log(1 + self.n) + 1
+        vec = {idx: (1 + math.log(c)) * self.idf.get(idx, rare) for idx, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in vec.values())) or 1.0
+        return {idx: w / norm for idx, w in vec.items()}
+
+    def search(self, question):
+        """
+        (похожесть, запись) ближайшего вопроса с теми же числами или
+        (0.0, None).
+        """
+        counts = features(question)
+        if not self.entries or not counts:
+            return 0.0, None
+        query = np.zeros(DIM, dtype=np.float32)
+        for idx, w in self._weigh(counts).items():
+            query[idx] = w
+        scores = np.add.reduceat(query[self.cols] * self.weights, self.starts)
+        wanted = numbers(question)
+        scores[[i for i, nums in enumerate(self.numbers) if nums != wanted]] = 0.0
+        best = int(scores.argmax())
+        if scores[best] <= 0:
+            return 0.0, None
+        return float(scores[best]), self.entries[best]
+
+
+class FaqIndex:
+    """Индексы по (магазин, артикул) с перестройкой при новых ответах."""
+
+    def __init__(self, max_articles=FAQ_ARTICLES, refresh=FAQ_REFRESH):
+        self.max_articles = max_articles
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._articles = {}  # (магазин, nmId) -> [проверено, версия, ArticleIndex]
+        self._lock = threading.Lock()
+
+    def _index(self, shop, nm_id):
+        key = (shop, nm_id)
+        with self._lock:
+            entry = self._articles.get(key)
+        now = time.time()
+        if entry is not None and now - entry[0] < self.refresh:
+            return entry[2]
+        version = faq_version(shop, nm_id)
+        if entry is not None and entry[1] == version:
+            entry[0] = now
+            return entry[2]
+        index = ArticleIndex(faq_entries(shop, nm_id, FAQ_MAX)) if version[0] else None
+        with self._lock:
+            self._articles.pop(key, None)
+            self._articles[key] = [now, version, index]
+            while len(self._articles) > self.max_articles:
+                self._articles.pop(next(iter(self._articles)))
+        return index
+
+    def lookup(self, shop, nm_id, question, threshold=FAQ_THRESHOLD, count=True):
+        """
+        Похожий отвеченный вопрос артикула: {"score", "id", "question",
+        "answer"} или None. count=False — не учитывать в статистике
+        (подсказка в карточке UI при каждой перерисовке).
+        """
+        index = self._index(shop, nm_id) if nm_id else None
+        score, entry = index.search(question) if index is not None else (0.0, None)
+        hit = entry is not None and score >= threshold
+        if count:
+            with self._lock:
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            FAQ.inc(result="hit" if hit else "miss")
+        return {**entry, "score": score} if hit else None
+
+    def clear(self):
+        with self._lock:
+            self._articles.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "articles": len(self._articles),
+        }
+
+
+faq_index = FaqIndex()
+
+
+def reuse_answer(hit, signature):
+    """Ответ из FAQ с текущими приветствием и подписью."""
+    greeting = make_greeting("Покупатель")
+    return finish_answer(core_answer(hit["answer"], signature), greeting, signature)
+
+
+def faq_answer(api_key, shop, item, signature, settings=None, auto=False):
+    """
+    Ответ на вопрос WB из FAQ артикула или None, если похожих нет.
+    С settings["paraphrase"] ответ переписывается под вопрос; при ошибке
+    ИИ отдаётся как есть. auto=True — ответ уйдёт без проверки, нужен
+    settings["auto"].
+    """
+    settings = load_faq() if settings is None else settings
+    if not settings.get("enabled") or (auto and not settings.get("auto")):
+        return None
+    details = item.get("productDetails", {})
+    question = item.get("text", "")
+    hit = faq_index.lookup(
+        shop, details.get("nmId"), question, settings.get("threshold", FAQ_THRESHOLD)
+    )
+    if hit is None:
+        return None
+    answer = reuse_answer(hit, signature)
+    if settings.get("paraphrase") and api_key:
+        text = paraphrase_ai(
+            api_key, core_answer(hit["answer"], signature), question,
+            details.get("productName", ""), signature,
+        )
+        if "Ошибка" not in text:
+            answer = text
+    return answer
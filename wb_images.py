@@ -0,0 +1,268 @@
+"""
+Фото товаров WB.
+
+Номер корзины (basket-NN) по vol = nmId // 100000 берётся из таблицы
+диапазонов (бинарный поиск). Таблицу можно обновить без правки кода:
+JSON-файл WB_BASKETS_PATH (по умолчанию baskets.json) со списком пар
+[последний vol корзины, "номер"], например [[143, "01"], [287, "02"]].
+
+Фото товаров и покупателей скачиваются параллельно, уменьшаются до
+размера карточки и хранятся на диске (WB_IMAGE_CACHE, по умолчанию
+.image_cache) — UI отдаёт браузеру готовые байты, а не ссылки на CDN.
+"""
+import bisect
+import functools
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BASKETS_PATH = os.environ.get("WB_BASKETS_PATH", "baskets.json")
+IMAGE_CACHE_DIR = os.environ.get("WB_IMAGE_CACHE", ".image_cache")
+IMAGE_CACHE_MAX_BYTES = 300 * 1024 * 1024
+IMAGE_WORKERS = 8
+IMAGE_WAIT = 3  # сек ждём загрузку для текущей страницы, дальше — ссылкой
+IMAGE_RETRY = 600  # сек: не скачавшуюся картинку раньше не пробуем
+
+CARD_SIZE = (246, 328)  # главное фото товара
+PHOTO_SIZE = (160, 160)  # фото покупателя
+
+# (последний vol корзины, корзина)
+DEFAULT_BASKETS = [
+    (143, "01"),
+    (287, "02"),
+    (431, "03"),
+    (719, "04"),
+    (1007, "05"),
+    (1061, "06"),
+    (1115, "07"),
+    (1169, "08"),
+    (1313, "09"),
+    (1601, "10"),
+    (1655, "11"),
+    (1919, "12"),
+    (2045, "13"),
+    (2189, "14"),
+    (2405, "15"),
+    (2621, "16"),
+    (2837, "17"),
+    (3053, "18"),
+    (3269, "19"),
+    (3485, "20"),
+    (3701, "21"),
+    (3917, "22"),
+    (4133, "23"),
+    (4349, "24"),
+    (4565, "25"),
+    (4877, "26"),
+    (5189, "27"),
+    (5501, "28"),
+    (5813, "29"),
+    (6125, "30"),
+    (6437, "31"),
+]
+
+_bounds = []
+_baskets = []
+
+
+def load_basket_table(path=None):
+    """
+    Загружает таблицу корзин из JSON (если файл есть), иначе —
+    встроенную. Сбрасывает кэш ссылок. Возвращает число диапазонов.
+    """
+    table = DEFAULT_BASKETS
+    path = path or BASKETS_PATH
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                table = [(int(v), str(b).zfill(2)) for v, b in json.load(f)]
+        except (OSError, ValueError, TypeError):
+            table = DEFAULT_BASKETS
+    table = sorted(table)
+    _bounds[:] = [v for v, _ in table]
+    _baskets[:] = [b for _, b in table]
+    get_main_photo_url.cache_clear()
+    return len(table)
+
+
+def basket_for_vol(vol):
+    """Корзина для vol; выше таблицы — последняя известная."""
+    i = bisect.bisect_left(_bounds, vol)
+    return _baskets[min(i, len(_baskets) - 1)]
+
+
+@functools.lru_cache(maxsize=100_000)
+def get_main_photo_url(nm_id):
+    try:
+        vol = int(nm_id) // 100000
+        part = int(nm_id) // 1000
+        basket = basket_for_vol(vol)
+        return f"https://basket-{basket}.wbbasket.ru/vol{vol}/part{part}/{nm_id}/images/c246x328/1.webp"
+    except Exception:
+        return None
+
+
+def get_photo_urls(nm_ids):
+    """Ссылки на главное фото для целой страницы: {nmId: url или None}."""
+    return {nm_id: get_main_photo_url(nm_id) for nm_id in set(nm_ids)}
+
+
+# ==========================================
+# КЭШ КАРТИНОК
+# ==========================================
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=IMAGE_WORKERS))
+_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+_inflight = {}  # путь -> Future
+_failed = {}  # путь -> когда не удалось скачать
+_lock = threading.Lock()
+_writes = 0
+
+
+def _cache_path(url, size):
+    key = hashlib.sha1(f"{url}|{size[0]}x{size[1]}".encode("utf-8")).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], key + ".jpg")
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # для вытеснения: давно не показанные — первыми
+        return data
+    except OSError:
+        return None
+
+
+def _download(url, size, path):
+    """Скачивает, уменьшает до size и кладёт в кэш. Байты JPEG или None."""
+    global _writes
+    # PIL нужен только здесь, в фоновом потоке, — не грузим его при старте
+    from PIL import Image
+
+    try:
+        res = _session.get(url, timeout=15)
+        if res.status_code != 200:
+            _failed[path] = time.time()
+            return None
+        img = Image.open(io.BytesIO(res.content))
+        img.thumbnail(size)
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=82, optimize=True)
+        data = out.getvalue()
+    except Exception:
+        _failed[path] = time.time()
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    with _lock:
+        _writes += 1
+        check = _writes % 50 == 0
+    if check:
+        evict_images()
+    return data
+
+
+def _schedule(url, size):
+    path = _cache_path(url, size)
+    with _lock:
+        fut = _inflight.get(path)
+        if fut is None:
+            fut = _pool.submit(_download, url, size, path)
+            _inflight[path] = fut
+            fut.add_done_callback(lambda _, p=path: _inflight.pop(p, None))
+    return fut
+
+
+def get_images(urls, size=CARD_SIZE, timeout=IMAGE_WAIT):
+    """
+    Картинки для текущей страницы: {url: байты или None}.
+    Из кэша — сразу, остальные качаются параллельно; что не успело за
+    timeout — None (UI покажет ссылку), загрузка продолжится в фоне.
+    Ждём только новые загрузки: начатые раньше (прошлой перерисовкой или
+    prefetch) и недавно не скачавшиеся перерисовку не задерживают.
+    """
+    result, pending = {}, {}
+    now = time.time()
+    for url in set(filter(None, urls)):
+        path = _cache_path(url, size)
+        data = _read(path)
+        if data is not None:
+            result[url] = data
+        elif now - _failed.get(path, 0) < IMAGE_RETRY:
+            result[url] = None
+        else:
+            with _lock:
+                started = path in _inflight
+            fut = _schedule(url, size)
+            if started:
+                result[url] = fut.result() if fut.done() else None
+            else:
+                pending[url] = fut
+    if pending:
+        wait(list(pending.values()), timeout=timeout)
+    for url, fut in pending.items():
+        result[url] = fut.result() if fut.done() else None
+    return result
+
+
+def prefetch_images(urls, size=CARD_SIZE):
+    """Фоновая загрузка в кэш (например, для следующей страницы)."""
+    now = time.time()
+    for url in set(filter(None, urls)):
+        path = _cache_path(url, size)
+        if not os.path.exists(path) and now - _failed.get(path, 0) >= IMAGE_RETRY:
+            _schedule(url, size)
+
+
+def evict_images(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    """Удаляет давно не показанные картинки, пока кэш больше max_bytes."""
+    files = []
+    for root, _, names in os.walk(IMAGE_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    if total <= max_bytes:
+        return 0
+    removed = 0
+    # Чистим с запасом до 90%, чтобы не запускаться на каждой записи
+    for _, size, path in sorted(files):
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def item_photo_urls(item):
+    """Ссылки на фото покупателя из отзыва (до 6)."""
+    urls = []
+    for p in (item.get("photoLinks") or [])[:6]:
+        url = p.get("smallSize") or p.get("fullSize")
+        if url:
+            urls.append(url)
+    return urls
+
+
+load_basket_table()
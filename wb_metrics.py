@@ -0,0 +1,294 @@
+"""
+Метрики запросов к WB и ИИ, авто-режима и ошибок UI.
+
+Счётчики, gauge и гистограммы хранятся в памяти процесса (без внешних
+зависимостей) и отдаются в текстовом формате Prometheus:
+    serve_metrics(port) -> http://127.0.0.1:<port>/metrics
+Воркер поднимает эндпоинт на WB_METRICS_PORT (по умолчанию 9108), UI —
+на следующем порту, дополнительные воркеры — на портах после UI. Для
+вкладки «Метрики» каждый воркер ещё и кладёт снимок (snapshot) в
+таблицу workers рядом со статусом.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("WB_METRICS_PORT", "9108"))
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+log = logging.getLogger("wb_metrics")
+
+REGISTRY = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """[(суффикс имени, {метка: значение}, число)]"""
+        with self._lock:
+            items = list(self.values.items())
+        return [("", dict(zip(self.label_names, k)), v) for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[0][i] += 1
+                    break
+            row[1] += value
+            row[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(k, (list(c), s, n)) for k, (c, s, n) in self.values.items()]
+        out = []
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.label_names, key))
+            cum = 0
+            for bound, c in zip(self.buckets, counts):
+                cum += c
+                out.append(("_bucket", dict(labels, le=f"{bound:g}"), cum))
+            out.append(("_bucket", dict(labels, le="+Inf"), count))
+            out.append(("_sum", labels, total))
+            out.append(("_count", labels, count))
+        return out
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+
+# ==========================================
+# МЕТРИКИ
+# ==========================================
+
+WB_REQUESTS = Counter(
+    "wb_requests_total", "Запросы к feedbacks-api по кодам ответа", ("shop", "endpoint", "code")
+)
+WB_SECONDS = Histogram(
+    "wb_request_seconds", "Длительность одного запроса к WB", ("shop", "endpoint")
+)
+WB_WAIT = Histogram(
+    "wb_ratelimit_wait_seconds", "Ожидание своего лимита запросов перед запросом к WB", ("shop",)
+)
+WB_RETRIES = Counter("wb_retries_total", "Повторы запросов к WB", ("shop", "endpoint", "reason"))
+
+LLM_REQUESTS = Counter("llm_requests_total", "Запросы к ИИ", ("kind", "model", "status"))
+LLM_SECONDS = Histogram(
+    "llm_request_seconds", "Длительность запроса к ИИ", ("kind", "model")
+)
+LLM_FIRST_TOKEN = Histogram(
+    "llm_first_token_seconds",
+    "Время до первого куска текста при потоковой генерации",
+    ("kind", "model"),
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Токены ИИ", ("kind", "model", "type"))
+LLM_WAIT = Histogram(
+    "llm_schedule_wait_seconds", "Ожидание бюджета и слота планировщика ИИ", ("model",)
+)
+LLM_CONCURRENCY = Gauge(
+    "llm_concurrency_limit", "Окно параллельных запросов к модели (AIMD)", ("model",)
+)
+
+ANSWERS = Counter(
+    "answers_total", "Ответы авто-режима", ("shop", "mode", "source", "result")
+)
+STAGE_SECONDS = Histogram(
+    "auto_stage_seconds", "Этапы авто-режима: fetch, generate, send", ("shop", "stage")
+)
+QUEUE_DEPTH = Gauge("auto_queue_depth", "Записей в очереди магазина", ("shop",))
+CYCLE_SECONDS = Histogram(
+    "auto_cycle_seconds",
+    "Длительность прохода авто-режима",
+    ("shop",),
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 3600),
+)
+POLLS = Counter(
+    "auto_polls_total",
+    "Проверки изменений перед проходом: changed/unchanged/error",
+    ("shop", "mode", "result"),
+)
+POLL_INTERVAL = Gauge("auto_poll_interval_seconds", "Интервал опроса магазина", ("shop",))
+OUTBOX = Counter("outbox_total", "Переходы очереди отправки (wb_outbox)", ("shop", "state"))
+FAQ = Counter("faq_lookups_total", "Поиск похожих вопросов (wb_faq): hit/miss", ("result",))
+UI_SECONDS = Histogram(
+    "ui_run_seconds",
+    "Проход скрипта UI по этапам (импорт, сайдбар, вкладки) и целиком (total)",
+    ("stage",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+ERRORS = Counter("errors_total", "Перехваченные исключения", ("where", "error"))
+
+# ==========================================
+# МАГАЗИНЫ
+# ==========================================
+
+_shop_names = {}  # токен -> имя магазина
+
+
+def register_shops(shops):
+    """{имя: токен} — чтобы метки были по имени магазина, а не по токену."""
+    for name, token in shops.items():
+        _shop_names[token] = name
+
+
+def shop_label(wb_token):
+    name = _shop_names.get(wb_token)
+    if name:
+        return name
+    return f"…{str(wb_token)[-4:]}" if wb_token else ""
+
+
+def record_error(where, exc):
+    """Учёт исключения, которое дальше не пробрасывается."""
+    ERRORS.inc(where=where, error=type(exc).__name__)
+    log.warning("%s: %s", where, exc, exc_info=exc)
+
+
+# ==========================================
+# ЭКСПОРТ
+# ==========================================
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            body = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            name = f"{metric.name}{suffix}{{{body}}}" if body else metric.name + suffix
+            lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """Значения для JSON: {имя: [{"labels", "value"} или {"labels", "count", "sum", "buckets"}]}."""
+    out = {}
+    for metric in REGISTRY:
+        rows = []
+        with metric._lock:
+            items = [
+                (k, [list(v[0]), v[1], v[2]] if metric.kind == "histogram" else v)
+                for k, v in metric.values.items()
+            ]
+        for key, value in items:
+            labels = dict(zip(metric.label_names, key))
+            if metric.kind == "histogram":
+                counts, total, count = value
+                rows.append(
+                    {
+                        "labels": labels,
+                        "count": count,
+                        "sum": total,
+                        "buckets": dict(zip((f"{b:g}" for b in metric.buckets), counts)),
+                    }
+                )
+            else:
+                rows.append({"labels": labels, "value": value})
+        out[metric.name] = rows
+    return out
+
+
+def quantile(row, q):
+    """Оценка перцентиля по корзинам гистограммы из snapshot (верхняя граница)."""
+    if not row["count"]:
+        return None
+    target, cum = q * row["count"], 0
+    for bound, c in row["buckets"].items():
+        cum += c
+        if cum >= target:
+            return float(bound)
+    return float("inf")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server = None
+_busy = set()  # порты, которые не удалось занять — не пробуем на каждом rerun
+
+
+def serve_metrics(port=METRICS_PORT, host="127.0.0.1"):
+    """
+    Поднимает /metrics в фоновом потоке (один раз на процесс).
+    Возвращает порт или None, если он занят.
+    """
+    global _server
+    if _server is not None:
+        return _server.server_port
+    if port in _busy:
+        return None
+    try:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        _busy.add(port)
+        log.warning("Метрики: порт %s недоступен (%s)", port, e)
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return port
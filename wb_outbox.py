@@ -0,0 +1,189 @@
+"""
+Очередь отправки ответов (outbox) в локальной базе.
+
+Сгенерированный ответ сначала записывается в таблицу outbox — одна
+строка на (магазин, режим, id), повторная постановка отклоняется
+(wb_store.enqueue_answer). Поэтому две вкладки UI, UI и воркер или
+повторный проход авто-режима не ответят на одну запись дважды, а после
+падения процесса ответы досылаются из базы без повторной генерации.
+
+Состояния записи:
+    pending   — ждёт отправки, не раньше next_at
+    sending   — взята отправителем (claim_outbox) до next_at
+    sent      — WB принял ответ, next_at — когда проверить
+    confirmed — ответ виден в WB при проверке по id
+    failed    — WB отклонил ответ или кончились попытки
+
+Пакетного ответа в feedbacks-api нет, поэтому пакет — это несколько
+записей, взятых одним запросом к базе и отправленных параллельно в
+пределах лимита токена (wb_api).
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from wb_api import get_wb_item, has_answer, send_wb_answer
+from wb_metrics import OUTBOX, record_error
+from wb_store import (
+    claim_outbox,
+    list_outbox,
+    log_events,
+    mark_answered,
+    set_outbox_state,
+)
+
+BATCH = 20  # записей за один claim
+WORKERS = 4  # параллельных отправок
+MAX_ATTEMPTS = 8  # после стольких неудачных попыток — failed
+RETRY_BASE = 30  # сек до первого повтора, удваивается
+RETRY_MAX = 3600
+LEASE = 600  # сек: дольше в sending — отправитель упал
+CONFIRM_AFTER = 60  # сек после отправки до проверки в WB
+CONFIRM_TIMEOUT = 6 * 3600  # сек после отправки: ответ так и не появился — failed
+
+
+def retry_at(attempts):
+    """Время следующей попытки: экспоненциальный backoff с jitter."""
+    delay = min(RETRY_MAX, RETRY_BASE * 2 ** max(attempts - 1, 0))
+    return time.time() + random.uniform(delay / 2, delay)
+
+
+def deliver(row, wb_token):
+    """
+    Отправка одной взятой (sending) записи. Возвращает "OK" или текст
+    ошибки. Временные ошибки (429, сбой соединения) оставляют запись в
+    очереди до следующей попытки. Если WB мог принять ответ (5xx, обрыв
+    после отправки), запись остаётся в sending: recover сначала проверит
+    её в WB и только потом отправит снова.
+    """
+    shop, mode, item_id = row["shop"], row["mode"], row["id"]
+    res = send_wb_answer(item_id, row["text"], wb_token, mode)
+    if res.ok:
+        mark_answered(shop, mode, item_id, row["text"], row["source"] or "manual")
+        set_outbox_state(shop, mode, item_id, "sent", next_at=time.time() + CONFIRM_AFTER)
+        OUTBOX.inc(shop=shop, state="sent")
+        return "OK"
+    if res.uncertain:
+        set_outbox_state(shop, mode, item_id, "sending", res.error, time.time() + CONFIRM_AFTER)
+        OUTBOX.inc(shop=shop, state="uncertain")
+        return f"{res.error} (проверим в WB, не ушёл ли ответ)"
+    if res.retryable and row["attempts"] < MAX_ATTEMPTS:
+        set_outbox_state(shop, mode, item_id, "pending", res.error, retry_at(row["attempts"]))
+        OUTBOX.inc(shop=shop, state="retry")
+        return f"{res.error} (повтор позже)"
+    set_outbox_state(shop, mode, item_id, "failed", res.error)
+    OUTBOX.inc(shop=shop, state="failed")
+    return res.error
+
+
+def flush(shops, mode=None, ids=None, limit=BATCH, workers=WORKERS):
+    """
+    Отправка записей очереди, у которых подошло время.
+    shops: {имя: токен}; mode и ids — только эти записи одного магазина.
+    Возвращает [(запись, результат)].
+    """
+    rows = claim_outbox(shops, mode, ids, limit, LEASE)
+    if not rows:
+        return []
+
+    def send(row):
+        try:
+            return row, deliver(row, shops[row["shop"]])
+        except Exception as e:
+            record_error("outbox.deliver", e)
+            set_outbox_state(
+                row["shop"], row["mode"], row["id"], "pending", str(e), retry_at(row["attempts"])
+            )
+            return row, f"Сбой: {e}"
+
+    if len(rows) == 1 or workers <= 1:
+        return [send(row) for row in rows]
+    with ThreadPoolExecutor(max_workers=min(workers, len(rows))) as pool:
+        return list(pool.map(send, rows))
+
+
+def drain(shops, limit=BATCH, workers=WORKERS):
+    """Отправляет всё, что подошло по времени. Возвращает [(запись, результат)]."""
+    total = []
+    while True:
+        done = flush(shops, limit=limit, workers=workers)
+        total += done
+        log_events(
+            [
+                {
+                    "source": "outbox",
+                    "action": "send",
+                    "shop": row["shop"],
+                    "mode": row["mode"],
+                    "item_id": row["id"],
+                    "result": res,
+                    "message": f"Попытка {row['attempts']}",
+                }
+                for row, res in done
+            ]
+        )
+        if len(done) < limit:
+            return total
+
+
+def recover(shops):
+    """
+    Записи, застрявшие в sending дольше LEASE (отправитель упал) или с
+    неизвестным итогом отправки (см. deliver): если ответ уже виден в
+    WB — sent, иначе обратно в pending. Текст ответа берётся из очереди,
+    заново ничего не генерируется.
+    """
+    count = 0
+    for row in list_outbox("sending", shops):
+        res = get_wb_item(shops[row["shop"]], row["mode"], row["id"])
+        if not res.ok:
+            continue  # проверим в следующий раз
+        if has_answer(res.data):
+            mark_answered(row["shop"], row["mode"], row["id"], row["text"], row["source"])
+            set_outbox_state(row["shop"], row["mode"], row["id"], "sent", next_at=time.time())
+        elif row["attempts"] >= MAX_ATTEMPTS:
+            set_outbox_state(row["shop"], row["mode"], row["id"], "failed", row["error"])
+            OUTBOX.inc(shop=row["shop"], state="failed")
+        else:
+            set_outbox_state(
+                row["shop"], row["mode"], row["id"], "pending", row["error"],
+                retry_at(row["attempts"]),
+            )
+        count += 1
+    return count
+
+
+def confirm(shops, limit=BATCH):
+    """
+    sent -> confirmed, если ответ виден в WB. Не появился за
+    CONFIRM_TIMEOUT — failed (заново не отправляем, чтобы не ответить
+    дважды; повтор — retry_failed из UI).
+    """
+    count = 0
+    for row in list_outbox("sent", shops, limit=limit):
+        key = (row["shop"], row["mode"], row["id"])
+        res = get_wb_item(shops[row["shop"]], row["mode"], row["id"])
+        if not res.ok:
+            # Проверить не удалось — это не повод считать ответ потерянным
+            set_outbox_state(*key, "sent", res.error, time.time() + CONFIRM_AFTER * 5)
+        elif has_answer(res.data):
+            set_outbox_state(*key, "confirmed")
+            OUTBOX.inc(shop=row["shop"], state="confirmed")
+            count += 1
+        elif time.time() - (row["claimed_at"] or 0) > CONFIRM_TIMEOUT:
+            set_outbox_state(*key, "failed", "Ответ не появился в WB")
+            OUTBOX.inc(shop=row["shop"], state="failed")
+        else:
+            # Модерация WB может занять время — проверим позже
+            set_outbox_state(*key, "sent", next_at=time.time() + CONFIRM_AFTER * 5)
+    return count
+
+
+def service(shops):
+    """Один шаг обслуживания очереди: восстановление, отправка, проверка."""
+    try:
+        recover(shops)
+        drain(shops)
+        confirm(shops)
+    except Exception as e:
+        record_error("outbox.service", e)
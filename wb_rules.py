@@ -0,0 +1,218 @@
+"""
+Шаблонные ответы без ИИ для простых записей.
+
+Перед запросом к Groq запись проверяется по правилам (по порядку, первое
+подходящее): режим, оценка, пустой текст, товар/бренд, ключевые слова.
+Подошло — ответ берётся из шаблонов правила по очереди, с тем же
+приветствием и подписью, что у ответов ИИ. Вопрос, похожий на уже
+отвеченный по тому же артикулу, получает тот ответ (wb_faq; в
+авто-режиме — только если это включено). Остальное уходит в ИИ.
+
+Правила хранятся в локальной базе (wb_store, ключ "rules"), общие для
+UI и воркера. Поля правила (все, кроме templates, необязательны):
+    name        — название для статистики
+    mode        — "feedbacks" или "questions"
+    ratings     — список оценок, например [4, 5]
+    empty_text  — true: только без текста, false: только с текстом
+    products    — подстроки названия товара
+    brands      — подстроки бренда
+    keywords    — регулярные выражения, хотя бы одно должно найтись в тексте
+    exclude     — регулярные выражения, при которых правило не применяется
+    templates   — тексты; {greeting}, {user}, {product}, {brand}
+"""
+import functools
+import re
+import threading
+
+from wb_ai import ai_item, finish_answer, generate_ai_batch, make_greeting, review_text
+from wb_faq import faq_answer, load_faq
+from wb_store import get_setting
+
+DEFAULT_RULES = [
+    {
+        "name": "5★ без текста",
+        "mode": "feedbacks",
+        "ratings": [5],
+        "empty_text": True,
+        "templates": [
+            "{greeting}\n\nСпасибо за высокую оценку! Рады, что покупка вам понравилась.",
+            "{greeting}\n\nБлагодарим за пять звёзд! Будем рады видеть вас снова.",
+            "{greeting}\n\nСпасибо, что выбрали нас и оценили товар! Приятных покупок.",
+        ],
+    },
+    {
+        "name": "4★ без текста",
+        "mode": "feedbacks",
+        "ratings": [4],
+        "empty_text": True,
+        "templates": [
+            "{greeting}\n\nСпасибо за оценку! Будем рады, если расскажете, что нам улучшить.",
+            "{greeting}\n\nБлагодарим за отзыв! Стараемся, чтобы каждая покупка радовала.",
+        ],
+    },
+]
+
+_turns = {}  # название правила -> номер следующего шаблона
+_lock = threading.Lock()
+
+
+def load_rules():
+    """Правила из базы; если их не сохраняли — DEFAULT_RULES."""
+    rules = get_setting("rules")
+    return DEFAULT_RULES if rules is None else rules
+
+
+@functools.lru_cache(maxsize=256)
+def _rx(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _strings(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def check_rules(rules):
+    """Проверка правил перед сохранением; ошибка — ValueError с номером правила."""
+    if not isinstance(rules, list):
+        raise ValueError("нужен список правил")
+    for n, rule in enumerate(rules, 1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"правило {n}: нужен объект")
+        name = f"правило {n} ({rule['name']})" if rule.get("name") else f"правило {n}"
+        if not rule.get("templates") or not _strings(rule["templates"]):
+            raise ValueError(f"{name}: templates — непустой список строк")
+        ratings = rule.get("ratings", [])
+        if not isinstance(ratings, list) or not all(
+            isinstance(r, int) and not isinstance(r, bool) for r in ratings
+        ):
+            raise ValueError(f"{name}: ratings — список целых оценок")
+        for field in ("keywords", "exclude"):
+            if not _strings(rule.get(field, [])):
+                raise ValueError(f"{name}: {field} — список регулярных выражений")
+            for pattern in rule.get(field, []):
+                try:
+                    _rx(pattern)
+                except re.error as e:
+                    raise ValueError(f"{name}: {field} «{pattern}» — {e}") from None
+
+
+def _has(patterns, text):
+    return any(_rx(p).search(text) for p in patterns)
+
+
+def _contains(parts, value):
+    value = (value or "").lower()
+    return any(p.lower() in value for p in parts)
+
+
+def match_rule(item, mode, rules):
+    """Первое подходящее правило для записи WB или None."""
+    details = item.get("productDetails", {})
+    text = review_text(item) if mode == "feedbacks" else item.get("text", "")
+    rating = item.get("productValuation")
+    for rule in rules:
+        if not rule.get("templates"):
+            continue
+        if rule.get("mode") and rule["mode"] != mode:
+            continue
+        if rule.get("ratings") and rating not in rule["ratings"]:
+            continue
+        if "empty_text" in rule and bool(rule["empty_text"]) == bool(text.strip()):
+            continue
+        if rule.get("products") and not _contains(rule["products"], details.get("productName")):
+            continue
+        if rule.get("brands") and not _contains(rule["brands"], details.get("brandName")):
+            continue
+        if rule.get("keywords") and not _has(rule["keywords"], text):
+            continue
+        if rule.get("exclude") and _has(rule["exclude"], text):
+            continue
+        return rule
+    return None
+
+
+def render(rule, item, mode, signature):
+    """Ответ по следующему шаблону правила."""
+    with _lock:
+        turn = _turns.get(rule.get("name", ""), 0)
+        _turns[rule.get("name", "")] = turn + 1
+    template = rule["templates"][turn % len(rule["templates"])]
+    it = ai_item(item, mode)
+    details = item.get("productDetails", {})
+    greeting = make_greeting(it["user"])
+    values = {
+        "{greeting}": greeting,
+        "{user}": it["user"] or "",
+        "{product}": it["product"] or "товар",
+        "{brand}": details.get("brandName", ""),
+    }
+    answer = template
+    for mark, value in values.items():
+        answer = answer.replace(mark, value)
+    return finish_answer(answer.strip(), greeting, signature)
+
+
+class RuleStats:
+    """Сколько ответов дали шаблоны и FAQ, а сколько ушло в ИИ."""
+
+    def __init__(self):
+        self.template = 0
+        self.faq = 0
+        self.llm = 0
+        self.by_rule = {}
+        self._lock = threading.Lock()
+
+    def add(self, template=0, llm=0, rule=None, faq=0):
+        with self._lock:
+            self.template += template
+            self.faq += faq
+            self.llm += llm
+            if rule is not None:
+                self.by_rule[rule] = self.by_rule.get(rule, 0) + template
+
+    def stats(self):
+        with self._lock:
+            total = self.template + self.faq + self.llm
+            return {
+                "template": self.template,
+                "faq": self.faq,
+                "llm": self.llm,
+                "template_rate": (self.template + self.faq) / total if total else 0.0,
+                "by_rule": dict(self.by_rule),
+            }
+
+
+rule_stats = RuleStats()
+
+
+def generate_answers(
+    api_key, items, mode, instructions, signature, rules=None, shop=None, auto=False
+):
+    """
+    Ответы на записи WB: сначала шаблоны, для вопросов магазина shop —
+    FAQ артикула, остальное — пакетно через ИИ. auto=True — авто-режим:
+    FAQ только если он включён для авто-ответов (см. wb_faq).
+    Возвращает ({id: ответ}, {id: "template", "faq" или "llm"}).
+    """
+    rules = load_rules() if rules is None else rules
+    faq = load_faq() if shop and mode == "questions" else None
+    answers, sources, todo = {}, {}, []
+    for item in items:
+        rule = match_rule(item, mode, rules)
+        if rule is not None:
+            answers[item["id"]] = render(rule, item, mode, signature)
+            sources[item["id"]] = "template"
+            rule_stats.add(template=1, rule=rule.get("name", ""))
+            continue
+        reused = faq_answer(api_key, shop, item, signature, faq, auto) if faq else None
+        if reused:
+            answers[item["id"]] = reused
+            sources[item["id"]] = "faq"
+            rule_stats.add(faq=1)
+            continue
+        todo.append(ai_item(item, mode))
+    if todo:
+        rule_stats.add(llm=len(todo))
+        answers.update(generate_ai_batch(api_key, todo, instructions, signature))
+        sources.update({it["id"]: "llm" for it in todo})
+    return answers, sources
@@ -0,0 +1,787 @@
+"""
+Локальное хранилище (SQLite): отзывы и вопросы, черновики ответов,
+очередь отправки и отправленные ответы, журнал действий, метки
+синхронизации по магазинам, воркеры и аренда магазинов между ними.
+
+Скан и авто-режим забирают из WB только новое (dateFrom от последней
+метки), UI читает записи из индексированных таблиц. Через settings
+UI и фоновый воркер (wb_worker.py) обмениваются настройками и статусом.
+Файл базы — WB_STORE_PATH (по умолчанию wb_bot.db рядом с запуском).
+"""
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from wb_api import MAX_ITEMS, PAGE_WORKERS, iter_wb_data
+
+STORE_PATH = os.environ.get("WB_STORE_PATH", "wb_bot.db")
+
+OUTBOX_OPEN = "('pending', 'sending', 'sent', 'confirmed')"  # ответ уже есть
+# Для авто-режима ещё и failed: их повторяют только retry_failed и ручная
+# отправка, иначе каждый проход генерировал бы и слал ответ заново
+OUTBOX_AUTO = "('pending', 'sending', 'sent', 'confirmed', 'failed')"
+EVENTS_MAX = 20000  # записей журнала, старые удаляются
+FULL_SYNC_EVERY = 6 * 3600  # сек между полными сверками с WB
+WATERMARK_OVERLAP = 300  # сек перекрытия, чтобы не терять записи на границе
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    shop TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    id TEXT NOT NULL,
+    nm_id INTEGER,
+    product TEXT,
+    created_at REAL,
+    answered INTEGER NOT NULL DEFAULT 0,
+    raw TEXT NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (shop, mode, id)
+);
+CREATE INDEX IF NOT EXISTS items_open
+    ON items (shop, mode, answered, created_at DESC);
+CREATE INDEX IF NOT EXISTS items_nm ON items (shop, nm_id);
+
+CREATE TABLE IF NOT EXISTS drafts (
+    shop TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (shop, mode, id)
+);
+
+CREATE TABLE IF NOT EXISTS answers (
+    shop TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    source TEXT,
+    sent_at REAL,
+    PRIMARY KEY (shop, mode, id)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    shop TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    source TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL,
+    PRIMARY KEY (shop, mode, id)
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_at);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    source TEXT,
+    action TEXT,
+    shop TEXT,
+    mode TEXT,
+    item_id TEXT,
+    ok INTEGER NOT NULL DEFAULT 1,
+    result TEXT,
+    latency REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS events_shop ON events (shop, seq);
+
+CREATE TABLE IF NOT EXISTS workers (
+    owner TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    started_at REAL,
+    heartbeat REAL NOT NULL,
+    status TEXT,
+    metrics TEXT
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    shop TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    acquired_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    shop TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    watermark REAL NOT NULL DEFAULT 0,
+    full_at REAL NOT NULL DEFAULT 0,
+    synced_at REAL,
+    PRIMARY KEY (shop, mode)
+);
+
+CREATE TABLE IF NOT EXISTS poll_state (
+    shop TEXT PRIMARY KEY,
+    rate REAL NOT NULL DEFAULT 0,
+    interval REAL,
+    probed_at REAL
+);
+"""
+
+_local = threading.local()
+
+
+def get_db(path=None):
+    """Соединение на поток (sqlite3 нельзя делить между потоками)."""
+    path = path or STORE_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if path not in conns:
+        db = sqlite3.connect(path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        conns[path] = db
+    return conns[path]
+
+
+def parse_date(iso_date):
+    """ISO-дата WB -> unix time (0, если не разобрать)."""
+    if not iso_date:
+        return 0.0
+    try:
+        dt = datetime.datetime.fromisoformat(str(iso_date).replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        return 0.0
+
+
+# ==========================================
+# ЗАПИСИ
+# ==========================================
+
+
+def upsert_items(shop, mode, items, answered=False):
+    if not items:
+        return
+    now = time.time()
+    rows = []
+    for item in items:
+        details = item.get("productDetails", {})
+        rows.append(
+            (
+                shop,
+                mode,
+                str(item["id"]),
+                details.get("nmId"),
+                details.get("productName", ""),
+                parse_date(item.get("createdDate")),
+                int(answered),
+                json.dumps(item, ensure_ascii=False),
+                now,
+            )
+        )
+    db = get_db()
+    with db:
+        # Запись с нашим ответом (отправленным или в очереди) не
+        # «воскрешаем». Закрытую без него — например, пропущенную при
+        # полной сверке — открываем снова, раз WB отдаёт её неотвеченной
+        db.executemany(
+            "INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (shop, mode, id) DO UPDATE SET "
+            "nm_id = excluded.nm_id, product = excluded.product, "
+            "created_at = excluded.created_at, raw = excluded.raw, "
+            "answered = CASE WHEN excluded.answered = 0 "
+            "AND NOT EXISTS (SELECT 1 FROM answers a WHERE a.shop = items.shop "
+            "AND a.mode = items.mode AND a.id = items.id) "
+            "AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.shop = items.shop "
+            f"AND o.mode = items.mode AND o.id = items.id AND o.state IN {OUTBOX_OPEN}) "
+            "THEN 0 ELSE MAX(items.answered, excluded.answered) END, "
+            "updated_at = excluded.updated_at",
+            rows,
+        )
+
+
+def _items_where(answered, auto=False):
+    sql = "shop = ? AND mode = ? AND answered = ?"
+    if not answered:
+        # Ответ в очереди отправки — запись уже не ждёт ответа
+        states = OUTBOX_AUTO if auto else OUTBOX_OPEN
+        sql += (
+            " AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.shop = items.shop "
+            f"AND o.mode = items.mode AND o.id = items.id AND o.state IN {states})"
+        )
+    return sql
+
+
+def list_items(shop, mode, answered=False, limit=None, offset=0, auto=False):
+    """
+    Записи магазина (новые сверху) как исходные dict из WB.
+    auto=True — без записей с неотправленным ответом (failed).
+    """
+    sql = (
+        f"SELECT raw FROM items WHERE {_items_where(answered, auto)} "
+        "ORDER BY created_at DESC"
+    )
+    params = [shop, mode, int(answered)]
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    return [json.loads(r["raw"]) for r in get_db().execute(sql, params)]
+
+
+def count_items(shop, mode, answered=False, auto=False):
+    row = get_db().execute(
+        f"SELECT COUNT(*) FROM items WHERE {_items_where(answered, auto)}",
+        (shop, mode, int(answered)),
+    ).fetchone()
+    return row[0]
+
+
+def list_nm_ids(shop):
+    """Артикулы магазина, известные по локальной базе."""
+    rows = get_db().execute(
+        "SELECT DISTINCT nm_id FROM items WHERE shop = ? AND nm_id IS NOT NULL",
+        (shop,),
+    )
+    return [r[0] for r in rows]
+
+
+# Отвеченные вопросы артикула; повторно использованные (faq) не берём,
+# чтобы индекс не состоял из копий одного ответа
+_FAQ_FROM = (
+    "FROM items i JOIN answers a ON a.shop = i.shop AND a.mode = i.mode AND a.id = i.id "
+    "WHERE i.shop = ? AND i.mode = 'questions' AND i.nm_id = ? "
+    "AND COALESCE(a.source, '') != 'faq'"
+)
+
+
+def faq_version(shop, nm_id):
+    """(число ответов, время последнего) — изменилось ли FAQ артикула."""
+    row = get_db().execute(
+        f"SELECT COUNT(*), MAX(a.sent_at) {_FAQ_FROM}", (shop, nm_id)
+    ).fetchone()
+    return row[0], row[1] or 0
+
+
+def faq_entries(shop, nm_id, limit=500):
+    """Отвеченные вопросы артикула (новые сверху): [{id, question, answer}]."""
+    rows = get_db().execute(
+        f"SELECT i.id, json_extract(i.raw, '$.text') AS question, a.text AS answer "
+        f"{_FAQ_FROM} ORDER BY a.sent_at DESC LIMIT ?",
+        (shop, nm_id, limit),
+    )
+    return [dict(r) for r in rows if r["question"]]
+
+
+def mark_answered(shop, mode, item_id, text, source="manual"):
+    """Ответ отправлен: запись закрыта, ответ сохранён, черновик удалён."""
+    db = get_db()
+    key = (shop, mode, str(item_id))
+    with db:
+        db.execute(
+            "UPDATE items SET answered = 1, updated_at = ? "
+            "WHERE shop = ? AND mode = ? AND id = ?",
+            (time.time(), *key),
+        )
+        db.execute(
+            "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, text, source, time.time()),
+        )
+        db.execute("DELETE FROM drafts WHERE shop = ? AND mode = ? AND id = ?", key)
+
+
+# ==========================================
+# ЧЕРНОВИКИ
+# ==========================================
+
+
+def save_draft(shop, mode, item_id, text):
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO drafts VALUES (?, ?, ?, ?, ?)",
+            (shop, mode, str(item_id), text, time.time()),
+        )
+
+
+def get_drafts(shop, mode):
+    """{id: текст черновика}"""
+    rows = get_db().execute(
+        "SELECT id, text FROM drafts WHERE shop = ? AND mode = ?", (shop, mode)
+    )
+    return {r["id"]: r["text"] for r in rows}
+
+
+# ==========================================
+# ОЧЕРЕДЬ ОТПРАВКИ
+# ==========================================
+
+
+def enqueue_answer(shop, mode, item_id, text, source="manual"):
+    """
+    Ответ в очередь отправки (см. wb_outbox). False — на запись уже
+    есть ответ в очереди или отправленный, повтор не ставится. Запись
+    в состоянии failed ставится заново.
+    """
+    now = time.time()
+    key = (shop, mode, str(item_id))
+    db = get_db()
+    with db:
+        cur = db.execute(
+            "INSERT INTO outbox (shop, mode, id, text, source, state, attempts, next_at, "
+            "error, created_at, updated_at) "
+            "SELECT ?, ?, ?, ?, ?, 'pending', 0, ?, '', ?, ? WHERE NOT EXISTS "
+            "(SELECT 1 FROM answers WHERE shop = ? AND mode = ? AND id = ?) "
+            "ON CONFLICT (shop, mode, id) DO UPDATE SET text = excluded.text, "
+            "source = excluded.source, state = 'pending', attempts = 0, "
+            "next_at = excluded.next_at, error = '', updated_at = excluded.updated_at "
+            "WHERE outbox.state = 'failed'",
+            (*key, text, source, now, now, now, *key),
+        )
+        return cur.rowcount > 0
+
+
+def queued_ids(shop, mode, ids, auto=False):
+    """
+    Из ids — те, на которые ответ уже в очереди или отправлен.
+    auto=True — и те, ответ на которые отправить не удалось (failed).
+    """
+    ids = [str(i) for i in ids]
+    found = set()
+    db = get_db()
+    for i in range(0, len(ids), 900):  # лимит параметров SQLite
+        chunk = ids[i : i + 900]
+        marks = ",".join("?" * len(chunk))
+        rows = db.execute(
+            f"SELECT id FROM outbox WHERE shop = ? AND mode = ? AND id IN ({marks}) "
+            f"AND state IN {OUTBOX_AUTO if auto else OUTBOX_OPEN} UNION SELECT id FROM answers "
+            f"WHERE shop = ? AND mode = ? AND id IN ({marks})",
+            (shop, mode, *chunk, shop, mode, *chunk),
+        )
+        found.update(r["id"] for r in rows)
+    return found
+
+
+def claim_outbox(shops, mode=None, ids=None, limit=20, lease=600):
+    """
+    Забирает на отправку до limit записей pending, у которых подошло
+    время: одним UPDATE, поэтому две отправки не возьмут одну запись.
+    ids — только эти записи (вместе с mode, для одного магазина).
+    Через lease сек незавершённая отправка считается упавшей.
+    """
+    shops = list(shops)
+    if not shops:
+        return []
+    now = time.time()
+    sql = (
+        f"state = 'pending' AND next_at <= ? AND shop IN ({','.join('?' * len(shops))})"
+    )
+    params = [now, *shops]
+    if mode:
+        sql += " AND mode = ?"
+        params.append(mode)
+    if ids is not None:
+        ids = [str(i) for i in ids]
+        if not ids:
+            return []
+        sql += f" AND id IN ({','.join('?' * len(ids))})"
+        params += ids
+    db = get_db()
+    with db:
+        rows = db.execute(
+            "UPDATE outbox SET state = 'sending', attempts = attempts + 1, "
+            "next_at = ?, claimed_at = ?, updated_at = ? WHERE rowid IN "
+            f"(SELECT rowid FROM outbox WHERE {sql} ORDER BY next_at LIMIT ?) "
+            "RETURNING shop, mode, id, text, source, attempts, created_at",
+            (now + lease, now, now, *params, limit),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def set_outbox_state(shop, mode, item_id, state, error="", next_at=0):
+    db = get_db()
+    with db:
+        db.execute(
+            "UPDATE outbox SET state = ?, error = ?, next_at = ?, updated_at = ? "
+            "WHERE shop = ? AND mode = ? AND id = ?",
+            (state, error, next_at, time.time(), shop, mode, str(item_id)),
+        )
+
+
+def list_outbox(state, shops=None, limit=100):
+    """Записи очереди в состоянии state, у которых подошло время (next_at)."""
+    sql, params = "state = ? AND next_at <= ?", [state, time.time()]
+    if shops is not None:
+        shops = list(shops) or [""]
+        sql += f" AND shop IN ({','.join('?' * len(shops))})"
+        params += shops
+    rows = get_db().execute(
+        "SELECT shop, mode, id, text, source, state, attempts, claimed_at, error, "
+        f"created_at, updated_at FROM outbox WHERE {sql} ORDER BY next_at LIMIT ?",
+        (*params, limit),
+    )
+    return [dict(r) for r in rows]
+
+
+def get_outbox(shop, mode, item_id):
+    """Запись очереди отправки или None."""
+    row = get_db().execute(
+        "SELECT state, attempts, error, updated_at FROM outbox "
+        "WHERE shop = ? AND mode = ? AND id = ?",
+        (shop, mode, str(item_id)),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def outbox_counts(shop=None):
+    """{состояние: число записей}"""
+    sql, params = "", []
+    if shop:
+        sql, params = " WHERE shop = ?", [shop]
+    rows = get_db().execute(
+        f"SELECT state, COUNT(*) AS n FROM outbox{sql} GROUP BY state", params
+    )
+    return {r["state"]: r["n"] for r in rows}
+
+
+def retry_failed(shop=None):
+    """Ответы failed — снова в pending. Возвращает их число."""
+    sql, params = "", []
+    if shop:
+        sql, params = " AND shop = ?", [shop]
+    db = get_db()
+    with db:
+        cur = db.execute(
+            "UPDATE outbox SET state = 'pending', attempts = 0, next_at = 0, "
+            f"updated_at = ? WHERE state = 'failed'{sql}",
+            (time.time(), *params),
+        )
+    return cur.rowcount
+
+
+# ==========================================
+# НАСТРОЙКИ
+# ==========================================
+
+
+def set_setting(key, value):
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO settings VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+
+
+def get_setting(key, default=None):
+    row = get_db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else default
+
+
+# ==========================================
+# ЖУРНАЛ
+# ==========================================
+
+_events_written = 0
+_events_lock = threading.Lock()
+
+
+def log_events(events):
+    """
+    Запись событий журнала. Событие — dict с полями message и
+    необязательными source, action, shop, mode, item_id, result
+    ("OK" или текст ошибки), latency (сек). Журнал общий для UI и
+    воркера и ограничен EVENTS_MAX последними записями.
+    """
+    global _events_written
+    if not events:
+        return
+    now = time.time()
+    rows = [
+        (
+            e.get("ts", now),
+            e.get("source", ""),
+            e.get("action", ""),
+            e.get("shop", ""),
+            e.get("mode", ""),
+            str(e.get("item_id") or ""),
+            int(e.get("result", "OK") == "OK"),
+            e.get("result", "OK"),
+            e.get("latency"),
+            e.get("message", ""),
+        )
+        for e in events
+    ]
+    db = get_db()
+    with db:
+        db.executemany(
+            "INSERT INTO events (ts, source, action, shop, mode, item_id, ok, result, "
+            "latency, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    with _events_lock:
+        _events_written += len(rows)
+        prune = _events_written >= EVENTS_MAX // 20
+        if prune:
+            _events_written = 0
+    if prune:
+        # Кольцевой буфер: раз в EVENTS_MAX/20 записей срезаем хвост
+        with db:
+            db.execute(
+                "DELETE FROM events WHERE seq <= (SELECT MAX(seq) FROM events) - ?",
+                (EVENTS_MAX,),
+            )
+
+
+def log_event(message, **fields):
+    log_events([dict(fields, message=message)])
+
+
+def _events_where(shop=None, mode=None, ok=None, search=None):
+    sql, params = [], []
+    if shop:
+        sql.append("shop = ?")
+        params.append(shop)
+    if mode:
+        sql.append("mode = ?")
+        params.append(mode)
+    if ok is not None:
+        sql.append("ok = ?")
+        params.append(int(ok))
+    if search:
+        sql.append("(message LIKE ? OR item_id = ? OR result LIKE ?)")
+        params += [f"%{search}%", search, f"%{search}%"]
+    return (" WHERE " + " AND ".join(sql) if sql else ""), params
+
+
+def list_events(shop=None, mode=None, ok=None, search=None, limit=50, offset=0):
+    """События журнала, новые сверху. ok: True/False — только успехи/ошибки."""
+    where, params = _events_where(shop, mode, ok, search)
+    rows = get_db().execute(
+        "SELECT ts, source, action, shop, mode, item_id, ok, result, latency, message "
+        f"FROM events{where} ORDER BY seq DESC LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    )
+    return [dict(r) for r in rows]
+
+
+def count_events(shop=None, mode=None, ok=None, search=None):
+    where, params = _events_where(shop, mode, ok, search)
+    return get_db().execute(f"SELECT COUNT(*) FROM events{where}", params).fetchone()[0]
+
+
+# ==========================================
+# ВОРКЕРЫ И АРЕНДА МАГАЗИНОВ
+# ==========================================
+
+
+def worker_heartbeat(owner, status=None, metrics=None):
+    """Отметка «жив» воркера owner вместе с его статусом и метриками."""
+    now = time.time()
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO workers VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (owner) DO UPDATE SET heartbeat = excluded.heartbeat, "
+            "status = excluded.status, metrics = excluded.metrics",
+            (
+                owner,
+                socket.gethostname(),
+                os.getpid(),
+                now,
+                now,
+                json.dumps(status, ensure_ascii=False),
+                json.dumps(metrics, ensure_ascii=False),
+            ),
+        )
+
+
+def list_workers(alive=None):
+    """Воркеры (status и metrics — dict); alive — только с heartbeat не старше alive сек."""
+    sql, params = "", []
+    if alive is not None:
+        sql, params = " WHERE heartbeat >= ?", [time.time() - alive]
+    rows = get_db().execute(f"SELECT * FROM workers{sql} ORDER BY started_at", params)
+    out = []
+    for r in rows:
+        row = dict(r)
+        row["status"] = json.loads(row["status"] or "null") or {}
+        row["metrics"] = json.loads(row["metrics"] or "null") or {}
+        out.append(row)
+    return out
+
+
+def remove_worker(owner):
+    """Воркер остановился: его запись и аренды удаляются."""
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+        db.execute("DELETE FROM workers WHERE owner = ?", (owner,))
+
+
+def prune_workers(older):
+    """Удаляет записи воркеров без heartbeat дольше older сек."""
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM workers WHERE heartbeat < ?", (time.time() - older,))
+
+
+def acquire_lease(shop, owner, ttl):
+    """
+    Аренда магазина на ttl сек. True — магазин свободен, аренда истекла
+    или уже у owner. Одним запросом, поэтому два воркера не возьмут
+    один магазин.
+    """
+    now = time.time()
+    db = get_db()
+    with db:
+        cur = db.execute(
+            "INSERT INTO leases VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (shop) DO UPDATE SET owner = excluded.owner, "
+            "expires_at = excluded.expires_at, acquired_at = CASE "
+            "WHEN leases.owner = excluded.owner THEN leases.acquired_at "
+            "ELSE excluded.acquired_at END "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (shop, owner, now + ttl, now, now),
+        )
+        return cur.rowcount > 0
+
+
+def renew_leases(owner, ttl):
+    """Продлевает аренды owner. Возвращает магазины, которые за ним остались."""
+    now = time.time()
+    db = get_db()
+    with db:
+        rows = db.execute(
+            "UPDATE leases SET expires_at = ? WHERE owner = ? RETURNING shop",
+            (now + ttl, owner),
+        ).fetchall()
+    return {r["shop"] for r in rows}
+
+
+def release_lease(shop, owner):
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM leases WHERE shop = ? AND owner = ?", (shop, owner))
+
+
+def list_leases():
+    """{магазин: {"owner", "expires_at", "acquired_at"}}"""
+    rows = get_db().execute("SELECT * FROM leases")
+    return {r["shop"]: dict(r) for r in rows}
+
+
+# ==========================================
+# СИНХРОНИЗАЦИЯ
+# ==========================================
+
+
+def get_sync_state(shop, mode):
+    row = get_db().execute(
+        "SELECT watermark, full_at, synced_at FROM sync_state "
+        "WHERE shop = ? AND mode = ?",
+        (shop, mode),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def count_open(shop, mode):
+    """
+    Неотвеченные записи магазина в базе, включая поставленные в очередь
+    отправки, — для сверки с числом неотвеченных в WB.
+    """
+    row = get_db().execute(
+        "SELECT COUNT(*) FROM items WHERE shop = ? AND mode = ? AND answered = 0",
+        (shop, mode),
+    ).fetchone()
+    return row[0]
+
+
+def get_poll_state(shop):
+    """
+    {"rate", "interval", "probed_at"} или None.
+    rate — оценка поступления новых записей, шт/сек.
+    """
+    row = get_db().execute(
+        "SELECT rate, interval, probed_at FROM poll_state WHERE shop = ?", (shop,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def set_poll_state(shop, rate, interval, probed_at):
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO poll_state VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (shop) DO UPDATE SET rate = excluded.rate, "
+            "interval = excluded.interval, probed_at = excluded.probed_at",
+            (shop, rate, interval, probed_at),
+        )
+
+
+def iter_sync(shop, wb_token, mode="feedbacks", limit=MAX_ITEMS, workers=PAGE_WORKERS, full=None):
+    """
+    Синхронизация неотвеченных записей магазина с локальной базой.
+    Генератор: отдаёт загруженные страницы, уже сохранённые в базу.
+
+    Обычно запрашивается только новое — с dateFrom от метки последней
+    синхронизации. Полная сверка (full=True; по умолчанию раз в
+    FULL_SYNC_EVERY) дополнительно закрывает записи, на которые ответили
+    в другом месте. При WbApiError метка не сдвигается.
+    """
+    state = get_sync_state(shop, mode)
+    if full is None:
+        full = state is None or time.time() - state["full_at"] > FULL_SYNC_EVERY
+    date_from = None
+    if not full:
+        date_from = int(max(state["watermark"] - WATERMARK_OVERLAP, 0))
+
+    newest = state["watermark"] if state else 0.0
+    seen = set()
+    for page in iter_wb_data(
+        wb_token, mode, limit=limit, workers=workers, date_from=date_from
+    ):
+        upsert_items(shop, mode, page)
+        for item in page:
+            seen.add(str(item["id"]))
+            newest = max(newest, parse_date(item.get("createdDate")))
+        yield page
+
+    now = time.time()
+    db = get_db()
+    with db:
+        # Сверка возможна, только если загрузили весь список
+        if full and len(seen) < limit:
+            open_ids = db.execute(
+                "SELECT id FROM items WHERE shop = ? AND mode = ? AND answered = 0",
+                (shop, mode),
+            ).fetchall()
+            gone = [(shop, mode, r["id"]) for r in open_ids if r["id"] not in seen]
+            db.executemany(
+                "UPDATE items SET answered = 1 WHERE shop = ? AND mode = ? AND id = ?",
+                gone,
+            )
+        db.execute(
+            "INSERT INTO sync_state VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (shop, mode) DO UPDATE SET watermark = excluded.watermark, "
+            "full_at = excluded.full_at, synced_at = excluded.synced_at",
+            (shop, mode, newest, now if full else state["full_at"], now),
+        )
+
+
+def sync_shop(shop, wb_token, mode="feedbacks", limit=MAX_ITEMS, full=None):
+    """Синхронизация целиком. Возвращает число загруженных записей."""
+    return sum(len(page) for page in iter_sync(shop, wb_token, mode, limit, full=full))
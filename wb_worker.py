@@ -0,0 +1,351 @@
+"""
+Фоновый воркер авто-ответов — работает без Streamlit и без открытой
+вкладки браузера.
+
+Запуск:
+    python wb_worker.py           — работать постоянно
+    python wb_worker.py --once    — один проход по всем магазинам и выход
+
+Воркеров можно запустить несколько (в том числе на разных машинах с
+общей базой WB_STORE_PATH на диске с рабочими блокировками SQLite).
+Магазины делятся между живыми воркерами через аренду в базе (leases):
+каждый берёт не больше своей доли, продлевает аренду каждые TICK сек
+и отдаёт лишнее, когда воркеров становится больше. Аренда умершего
+воркера истекает через LEASE_TTL, и его магазины забирают остальные.
+
+Магазин опрашивается со своим интервалом: сначала дешёвая проверка
+числа неотвеченных и даты самой новой записи (wb_auto.probe_changes),
+полная загрузка — только если что-то изменилось. Интервал подстраивается под поток новых
+записей: от минуты у активных магазинов до --interval у тихих.
+
+Настройки (магазины, ключ Groq, инструкции, подпись, включённые режимы)
+воркер читает из локальной базы (wb_store, ключ "worker.config") — их
+сохраняет UI. Если магазинов или ключа там нет, они берутся из
+.streamlit/secrets.toml. Статус и метрики каждый воркер пишет в таблицу
+workers, UI показывает их и управляет воркерами через "worker.stop" и
+"worker.run_now". Отдельный поток досылает очередь отправки (wb_outbox):
+повторы после временных ошибок, ответы, оставшиеся после падения, и
+проверка, что ответ появился в WB. Метрики —
+http://127.0.0.1:9108/metrics (--metrics-port).
+"""
+import argparse
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+import tomllib
+import uuid
+
+from wb_api import MAX_ITEMS
+from wb_auto import (
+    GLOBAL_LIMIT,
+    POLL_MAX,
+    SHOP_LIMIT,
+    poll_interval,
+    probe_changes,
+    run_auto_cycle,
+)
+from wb_metrics import METRICS_PORT, serve_metrics, snapshot
+from wb_outbox import service
+from wb_store import (
+    acquire_lease,
+    count_items,
+    get_setting,
+    list_workers,
+    outbox_counts,
+    prune_workers,
+    release_lease,
+    remove_worker,
+    renew_leases,
+    set_setting,
+    worker_heartbeat,
+)
+
+INTERVAL = POLL_MAX  # сек: наибольший интервал опроса магазина
+TICK = 5  # сек между проверками расписания и записью статуса
+LEASE_TTL = 30  # сек: аренда магазина без продления истекает
+WORKER_GONE = 24 * 3600  # сек без heartbeat — запись воркера удаляется
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+log = logging.getLogger("wb_worker")
+
+
+def load_secrets(path=SECRETS_PATH):
+    """Магазины и ключ Groq из secrets.toml (как в UI)."""
+    try:
+        with open(path, "rb") as f:
+            secrets = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError):
+        return {}, ""
+    shops = dict(secrets.get("shops", {}))
+    if not shops and secrets.get("WB_API_TOKEN"):
+        shops["Основной"] = secrets["WB_API_TOKEN"]
+    return shops, secrets.get("GROQ_API_KEY", "")
+
+
+def load_config():
+    """
+    {"shops", "groq_key", "instructions", "signature", "limit"}
+    instructions — только включённые режимы.
+    """
+    cfg = get_setting("worker.config", {}) or {}
+    shops, groq_key = load_secrets()
+    return {
+        "shops": cfg.get("shops") or shops,
+        "groq_key": cfg.get("groq_key") or groq_key,
+        "instructions": cfg.get("instructions") or {},
+        "signature": cfg.get("signature", ""),
+        "limit": cfg.get("limit", MAX_ITEMS),
+    }
+
+
+class AutoWorker:
+    """
+    Планировщик + очередь заданий. Задание — один магазин; его
+    обрабатывают shop_workers потоков, каждый — run_auto_cycle по одному
+    магазину с shop_limit параллельными запросами. В работу берутся
+    только арендованные магазины (leased).
+    """
+
+    def __init__(self, interval=INTERVAL, shop_workers=GLOBAL_LIMIT // SHOP_LIMIT):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.leased = set()
+        self.interval = interval
+        self.shop_workers = shop_workers
+        self.jobs = queue.Queue()
+        self.queued = set()
+        self.running = set()
+        self.next_run = {}
+        self.last = {}  # магазин -> итоги последнего прохода
+        self.run_now_seen = get_setting("worker.run_now", 0) or 0
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    # --- аренда магазинов ---
+
+    def rebalance(self, cfg):
+        """
+        Продлевает аренды и выравнивает доли: не больше ceil(магазинов /
+        живых воркеров) на воркер. Лишние (не в работе) отдаются,
+        свободные и просроченные — забираются до своей доли.
+        """
+        held = renew_leases(self.owner, LEASE_TTL)
+        shops = sorted(cfg["shops"])
+        alive = list_workers(alive=LEASE_TTL)
+        share = -(-len(shops) // max(len(alive), 1))
+        with self._lock:
+            busy = self.running | self.queued
+        for name in sorted(held, reverse=True):
+            if name in busy:
+                continue
+            if name not in cfg["shops"] or len(held) > share:
+                release_lease(name, self.owner)
+                held.discard(name)
+        for name in shops:
+            if len(held) >= share:
+                break
+            if name not in held and acquire_lease(name, self.owner, LEASE_TTL):
+                held.add(name)
+        with self._lock:
+            lost = self.leased - held
+            self.leased = held
+            for name in lost:
+                self.next_run.pop(name, None)
+        if lost:
+            log.info("Магазины ушли другим воркерам: %s", ", ".join(sorted(lost)))
+
+    def leased_shops(self, cfg):
+        with self._lock:
+            return {n: t for n, t in cfg["shops"].items() if n in self.leased}
+
+    # --- расписание ---
+
+    def schedule(self, cfg):
+        """Ставит в очередь магазины, у которых подошло время."""
+        if not cfg["instructions"] or not cfg["groq_key"]:
+            return
+        run_now = get_setting("worker.run_now", 0) or 0
+        force = run_now > self.run_now_seen
+        self.run_now_seen = run_now
+        now = time.time()
+        with self._lock:
+            for name, token in cfg["shops"].items():
+                if name not in self.leased:
+                    continue
+                if name in self.queued or name in self.running:
+                    continue
+                if force or now >= self.next_run.get(name, 0):
+                    self.queued.add(name)
+                    self.jobs.put((name, token, force))
+
+    def consume(self):
+        while not self.stop_event.is_set():
+            try:
+                name, token, force = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self.queued.discard(name)
+                if name not in self.leased:
+                    self.jobs.task_done()
+                    continue  # аренду отдали, пока задание ждало
+                self.running.add(name)
+            interval = self.interval
+            try:
+                interval = self.run_shop(name, token, force)
+            except Exception:
+                log.exception("[%s] сбой прохода", name)
+            finally:
+                with self._lock:
+                    self.running.discard(name)
+                    self.next_run[name] = time.time() + interval
+                self.jobs.task_done()
+
+    def run_shop(self, name, token, force=False):
+        """
+        Проход по магазину. Без force сначала проверяет изменения в WB;
+        если нового нет и в базе ничего не ждёт ответа — проход не нужен.
+        Возвращает сек до следующей проверки.
+        """
+        cfg = load_config()
+        modes = list(cfg["instructions"])
+        fetch = dict.fromkeys(modes) if force else probe_changes(name, token, modes)
+        if not fetch and not any(count_items(name, mode, auto=True) for mode in modes):
+            interval = poll_interval(name, 0, self.interval)
+            last = self.last.get(name) or {"answered": 0, "failed": 0, "per_minute": 0.0}
+            self.last[name] = dict(last, interval=round(interval), checked=time.time())
+            return interval
+        stats = run_auto_cycle(
+            {name: token},
+            cfg["groq_key"],
+            cfg["instructions"],
+            cfg["signature"],
+            global_limit=SHOP_LIMIT,
+            limit=cfg["limit"],
+            fetch=fetch,
+        )
+        interval = poll_interval(name, stats.fetched, self.interval)
+        for _, mode, prod, res in stats.events:
+            kind = "Отзыв" if mode == "feedbacks" else "Вопрос"
+            if res == "OK":
+                log.info("[%s] %s: %s", name, kind, prod)
+            else:
+                log.warning("[%s] %s: %s — %s", name, kind, prod, res)
+        self.last[name] = {
+            "answered": stats.answered,
+            "failed": stats.failed,
+            "templated": stats.templated,
+            "reused": stats.reused,
+            "stages": {k: round(v, 1) for k, v in stats.stages.items()},
+            "seconds": round(stats.elapsed, 1),
+            "per_minute": round(stats.items_per_minute, 1),
+            "fetched": stats.fetched,
+            "finished": time.time(),
+            "interval": round(interval),
+            "checked": time.time(),
+        }
+        return interval
+
+    # --- статус ---
+
+    def publish_status(self, state="running"):
+        with self._lock:
+            status = {
+                "pid": os.getpid(),
+                "state": state,
+                "heartbeat": time.time(),
+                "queue": self.jobs.qsize(),
+                "running": sorted(self.running),
+                "leased": sorted(self.leased),
+                "next_run": dict(self.next_run),
+                "shops": dict(self.last),
+            }
+        status["outbox"] = outbox_counts()
+        worker_heartbeat(self.owner, status, snapshot())
+
+    # --- очередь отправки ---
+
+    def outbox_loop(self):
+        # Очередь отправки — только своих магазинов
+        while not self.stop_event.is_set():
+            service(self.leased_shops(load_config()))
+            self.stop_event.wait(TICK)
+
+    # --- запуск ---
+
+    def run(self):
+        set_setting("worker.stop", False)
+        prune_workers(WORKER_GONE)
+        self.publish_status()
+        threads = [
+            threading.Thread(target=self.consume, daemon=True)
+            for _ in range(self.shop_workers)
+        ]
+        threads.append(threading.Thread(target=self.outbox_loop, daemon=True))
+        for t in threads:
+            t.start()
+        log.info("Воркер %s запущен", self.owner)
+        while not self.stop_event.is_set():
+            if get_setting("worker.stop", False):
+                break
+            try:
+                cfg = load_config()
+                self.rebalance(cfg)
+                self.schedule(cfg)
+            except Exception:
+                log.exception("Сбой планировщика")
+            self.publish_status()
+            self.stop_event.wait(TICK)
+        self.stop_event.set()
+        for t in threads:
+            t.join()
+        remove_worker(self.owner)
+        log.info("Воркер остановлен")
+
+    def run_once(self):
+        """Один проход по магазинам, которые сейчас никем не арендованы."""
+        cfg = load_config()
+        with self._lock:
+            self.leased = {
+                name for name in cfg["shops"] if acquire_lease(name, self.owner, LEASE_TTL)
+            }
+        try:
+            service(self.leased_shops(cfg))
+            for name, token in self.leased_shops(cfg).items():
+                # Проход может быть дольше LEASE_TTL
+                renew_leases(self.owner, INTERVAL)
+                self.run_shop(name, token)
+        finally:
+            remove_worker(self.owner)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Фоновые авто-ответы WB")
+    parser.add_argument("--once", action="store_true", help="один проход и выход")
+    parser.add_argument(
+        "--interval", type=int, default=INTERVAL, help="наибольший интервал опроса магазина, сек"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=METRICS_PORT, help="порт /metrics (0 — не поднимать)"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    worker = AutoWorker(interval=args.interval)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    if args.once:
+        worker.run_once()
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: worker.stop_event.set())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()